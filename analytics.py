@@ -0,0 +1,140 @@
+# analytics.py — данные и расчёты вкладки «Аналитика»
+#
+# Читает только агрегаты rollup.py (activityrollup, posterrollup) — по запросу на таблицу
+# для набора фильтров; рейтинги, скользящие средние и тепловая карта считаются векторно
+# в pandas. Панель кэширует результат по ключу фильтров (см. dashboard_app.py).
+
+from datetime import date, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+from sqlmodel import select
+
+from db import ActivityRollup, PosterRollup, User, get_session
+from rollup import day_start
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+def _local(col: pd.Series) -> pd.Series:
+    """aware-даты из БД -> наивное местное время Бухареста."""
+    return pd.to_datetime(col, utc=True).dt.tz_convert(BUCHAREST_TZ).dt.tz_localize(None)
+
+
+def _where(bucket_col, chat_col, chat_ids, since: date, until: date) -> list:
+    cond = [bucket_col >= day_start(since), bucket_col < day_start(until + timedelta(days=1))]
+    if chat_ids is not None:
+        cond.append(chat_col.in_(list(chat_ids)))
+    return cond
+
+
+# ------------------------------------------------------------------------------
+# Загрузка
+# ------------------------------------------------------------------------------
+def load(chat_ids, since: date, until: date, top_posters: int = 50) -> dict[str, pd.DataFrame]:
+    """Сутки по чатам, часы (сумма по чатам) и самые активные авторы за период.
+    chat_ids=None — все чаты."""
+    r = ActivityRollup
+    with get_session() as sess:
+        daily = sess.exec(
+            select(r.chat_id, r.bucket, r.messages, r.posters, r.bot_messages, r.text_chars)
+            .where(r.grain == "d", *_where(r.bucket, r.chat_id, chat_ids, since, until))
+        ).all()
+        hourly = sess.exec(
+            select(r.bucket, func.sum(r.messages))
+            .where(r.grain == "h", *_where(r.bucket, r.chat_id, chat_ids, since, until))
+            .group_by(r.bucket)
+        ).all()
+        total = func.sum(PosterRollup.messages).label("messages")
+        posters = sess.exec(
+            select(PosterRollup.user_id, User.username, User.first_name, User.last_name, total,
+                   func.count(func.distinct(PosterRollup.chat_id)), func.count(func.distinct(PosterRollup.day)))
+            .join(User, User.user_id == PosterRollup.user_id)
+            .where(*_where(PosterRollup.day, PosterRollup.chat_id, chat_ids, since, until))
+            .group_by(PosterRollup.user_id, User.username, User.first_name, User.last_name)
+            .order_by(total.desc())
+            .limit(top_posters)
+        ).all()
+
+    daily = pd.DataFrame(daily, columns=["chat_id", "day", "messages", "posters", "bot_messages", "text_chars"])
+    daily["day"] = _local(daily["day"]).dt.normalize()
+    hourly = pd.DataFrame(hourly, columns=["hour", "messages"])
+    hourly["hour"] = _local(hourly["hour"])
+    posters = pd.DataFrame(posters, columns=["user_id", "username", "first_name", "last_name",
+                                             "messages", "chats", "days"])
+    return {"daily": daily, "hourly": hourly, "posters": posters}
+
+
+# ------------------------------------------------------------------------------
+# Расчёты
+# ------------------------------------------------------------------------------
+def activity_curve(daily: pd.DataFrame, since: date, until: date, window: int = 7) -> pd.DataFrame:
+    """Сообщения по дням (все выбранные чаты) со скользящим средним; пустые дни — нули."""
+    days = pd.date_range(since, until, freq="D")
+    s = daily.groupby("day")[["messages", "bot_messages"]].sum().reindex(days, fill_value=0)
+    s["среднее"] = s["messages"].rolling(window, min_periods=1).mean()
+    s["доля ботов"] = np.where(s["messages"] > 0, s["bot_messages"] / s["messages"].where(s["messages"] > 0), 0.0)
+    return s.rename(columns={"messages": "сообщений", "bot_messages": "от ботов"})
+
+
+def hour_of_week(hourly: pd.DataFrame) -> pd.DataFrame:
+    """Сообщений в среднем за час недели: 7 строк (Пн–Вс) × 24 столбца (местное время)."""
+    if hourly.empty:
+        return pd.DataFrame(0.0, index=WEEKDAYS, columns=range(24))
+    h = hourly.assign(wd=hourly["hour"].dt.weekday, hr=hourly["hour"].dt.hour)
+    total = h.pivot_table(index="wd", columns="hr", values="messages", aggfunc="sum", fill_value=0)
+    # сколько раз каждый день недели встретился в периоде — для среднего
+    days = pd.date_range(hourly["hour"].min().normalize(), hourly["hour"].max().normalize(), freq="D")
+    weeks = pd.Series(days.weekday).value_counts().reindex(range(7), fill_value=1).clip(lower=1)
+    grid = total.reindex(index=range(7), columns=range(24), fill_value=0).div(weeks, axis=0)
+    grid.index = WEEKDAYS
+    return grid
+
+
+def chat_ranking(daily: pd.DataFrame, titles: dict, until: date, recent_days: int = 30) -> pd.DataFrame:
+    """Чаты по числу сообщений: среднее в день, длина текста, доля ботов и рост
+    за последние recent_days дней к предыдущим recent_days."""
+    if daily.empty:
+        return pd.DataFrame()
+    edge = pd.Timestamp(until) - pd.Timedelta(days=recent_days - 1)
+    prev_edge = edge - pd.Timedelta(days=recent_days)
+    d = daily.assign(
+        recent=daily["messages"].where(daily["day"] >= edge, 0),
+        prev=daily["messages"].where((daily["day"] >= prev_edge) & (daily["day"] < edge), 0),
+    )
+    g = d.groupby("chat_id").agg(
+        messages=("messages", "sum"), active_days=("day", "nunique"), bots=("bot_messages", "sum"),
+        chars=("text_chars", "sum"), recent=("recent", "sum"), prev=("prev", "sum"),
+        peak_posters=("posters", "max"),
+    )
+    out = pd.DataFrame({
+        "чат": g.index.map(lambda c: titles.get(c) or str(c)),
+        "сообщений": g["messages"],
+        "в день (актив.)": (g["messages"] / g["active_days"]).round(1),
+        "ср. длина": (g["chars"] / g["messages"]).round(0),
+        "доля ботов": (g["bots"] / g["messages"]).round(3),
+        "макс. авторов в день": g["peak_posters"],
+        f"рост {recent_days}д, %": ((g["recent"] / g["prev"].replace(0, np.nan) - 1) * 100).round(1),
+    })
+    out.index.name = "chat_id"
+    return out.sort_values("сообщений", ascending=False)
+
+
+def poster_ranking(posters: pd.DataFrame, total_messages: int) -> pd.DataFrame:
+    if posters.empty:
+        return pd.DataFrame()
+    name = posters["username"].fillna(
+        (posters["first_name"].fillna("") + " " + posters["last_name"].fillna("")).str.strip()
+    ).replace("", np.nan).fillna(posters["user_id"].astype(str))
+    return pd.DataFrame({
+        "место": posters["messages"].rank(ascending=False, method="min").astype(int),
+        "автор": name,
+        "user_id": posters["user_id"],
+        "сообщений": posters["messages"],
+        "доля, %": (posters["messages"] / max(1, total_messages) * 100).round(2),
+        "чатов": posters["chats"],
+        "дней": posters["days"],
+    }).set_index("место")
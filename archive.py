@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# archive.py — холодный архив старых сообщений в Parquet
+#
+# Сообщения старше storage.archive.older_than_days (целыми месяцами) выгружаются в
+# exports/archive/chat_id=<id>/<YYYY-MM>.parquet (zstd, по возрастанию message_id) и
+# удаляются из message пачками. manifest.json описывает каждый файл (строки, диапазоны
+# message_id и дат) — по нему запрос сразу отбрасывает лишние файлы.
+# Чтение архива — через DuckDB; панель склеивает его с «горячими» строками из БД.
+#
+# Порядок: файл -> manifest -> удаление из БД. Если процесс прервался, повторный запуск
+# дописывает тот же месяц в существующий файл без дублей (ключ — message_id).
+#
+#   python archive.py run                       # по настройкам config.yaml
+#   python archive.py run --older-than-days 365 --dry-run
+#   python archive.py list
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import delete, func
+from sqlmodel import select
+
+import migrations
+import stats
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+DEFAULTS = {"enabled": False, "older_than_days": 365, "path": "exports/archive"}
+DELETE_BATCH = 5_000
+COLUMNS = ["chat_id", "message_id", "account_id", "user_id", "date", "text", "text_hash"]
+
+
+def settings(cfg: dict) -> dict:
+    """storage.archive из config.yaml с значениями по умолчанию."""
+    return {**DEFAULTS, **((cfg.get("storage") or {}).get("archive") or {})}
+
+
+def duckdb_available() -> bool:
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# ------------------------------------------------------------------------------
+# Manifest
+# ------------------------------------------------------------------------------
+def manifest_path(root) -> Path:
+    return Path(root) / "manifest.json"
+
+
+def load_manifest(root) -> dict:
+    try:
+        return json.loads(manifest_path(root).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+def save_manifest(root, manifest: dict) -> None:
+    p = manifest_path(root)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    tmp.replace(p)
+
+
+def file_for(root, chat_id: int, year: int, month: int) -> Path:
+    return Path(root) / f"chat_id={chat_id}" / f"{year:04d}-{month:02d}.parquet"
+
+
+# ------------------------------------------------------------------------------
+# Запись
+# ------------------------------------------------------------------------------
+def _month_bounds(year: int, month: int) -> tuple[datetime, datetime]:
+    ny, nm = (year + 1, 1) if month == 12 else (year, month + 1)
+    return datetime(year, month, 1, tzinfo=BUCHAREST_TZ), datetime(ny, nm, 1, tzinfo=BUCHAREST_TZ)
+
+
+def cutoff(older_than_days: int) -> datetime:
+    """Начало месяца, в который попадает now - older_than_days: архивируются только целые месяцы."""
+    edge = datetime.now(BUCHAREST_TZ) - timedelta(days=older_than_days)
+    return datetime(edge.year, edge.month, 1, tzinfo=BUCHAREST_TZ)
+
+
+def _write_parquet(path: Path, rows: list[dict]) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("chat_id", pa.int64()), ("message_id", pa.int64()), ("account_id", pa.int64()),
+        ("user_id", pa.int64()), ("date", pa.timestamp("us", tz="UTC")),
+        ("text", pa.string()), ("text_hash", pa.string()),
+    ])
+    by_id = {}
+    if path.exists():
+        for r in pq.read_table(path).to_pylist():
+            by_id[r["message_id"]] = r
+    for r in rows:
+        by_id[r["message_id"]] = r
+    table = pa.Table.from_pylist([by_id[k] for k in sorted(by_id)], schema=schema)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(table, tmp, compression="zstd", row_group_size=100_000)
+    os.replace(tmp, path)
+    return table.num_rows
+
+
+def archive_month(engine, root, chat_id: int, year: int, month: int) -> int:
+    from db import Message, MessageText, get_session
+
+    lo, hi = _month_bounds(year, month)
+    in_month = (Message.chat_id == chat_id, Message.date >= lo, Message.date < hi)
+    with get_session() as sess:
+        res = sess.exec(
+            select(Message.chat_id, Message.message_id, Message.account_id, Message.user_id, Message.date,
+                   func.coalesce(Message.text, MessageText.text), Message.text_hash)
+            .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)
+            .where(*in_month)
+            .order_by(Message.message_id)
+        ).all()
+    if not res:
+        return 0
+    rows = [dict(zip(COLUMNS, r)) for r in res]
+    for r in rows:
+        r["date"] = r["date"].astimezone(timezone.utc)
+
+    path = file_for(root, chat_id, year, month)
+    total = _write_parquet(path, rows)
+
+    manifest = load_manifest(root)
+    key = f"{chat_id}/{year:04d}-{month:02d}"
+    prev = manifest["files"].get(key, {})
+    manifest["files"][key] = {
+        "path": str(path.relative_to(root)),
+        "chat_id": chat_id,
+        "month": f"{year:04d}-{month:02d}",
+        "rows": total,
+        "min_message_id": min(rows[0]["message_id"], prev.get("min_message_id", rows[0]["message_id"])),
+        "max_message_id": max(rows[-1]["message_id"], prev.get("max_message_id", rows[-1]["message_id"])),
+        "min_date": lo.isoformat(),
+        "max_date": hi.isoformat(),
+        "bytes": path.stat().st_size,
+        "archived_at": datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds"),
+    }
+    save_manifest(root, manifest)
+
+    # только после того, как файл и manifest на диске
+    ids = [r["message_id"] for r in rows]
+    hashes = {r["text_hash"] for r in rows if r["text_hash"]}
+    track = migrations.current_version(engine) >= 6  # chatstats
+    for i in range(0, len(ids), DELETE_BATCH):
+        with get_session() as sess:
+            n = sess.exec(delete(Message).where(Message.chat_id == chat_id,
+                                                Message.message_id.in_(ids[i:i + DELETE_BATCH]))).rowcount
+            if track:
+                stats.record_deleted(sess, chat_id, n)
+            sess.commit()
+    if hashes:
+        # тексты, на которые больше не ссылается ни одно сообщение
+        with get_session() as sess:
+            still = set(sess.exec(select(Message.text_hash).where(Message.text_hash.in_(hashes)).distinct()).all())
+            gone = list(hashes - still)
+            if gone:
+                sess.exec(delete(MessageText).where(MessageText.text_hash.in_(gone)))
+                sess.commit()
+    return len(rows)
+
+
+def candidates(engine, before: datetime) -> list[tuple[int, int, int]]:
+    """(chat_id, год, месяц) с сообщениями старше before — месяцы по Бухаресту."""
+    from db import Message, get_session
+
+    with get_session() as sess:
+        rows = sess.exec(
+            select(Message.chat_id, func.min(Message.date)).where(Message.date < before).group_by(Message.chat_id)
+        ).all()
+    out = []
+    for chat_id, first in rows:
+        first = first.astimezone(BUCHAREST_TZ)
+        y, m = first.year, first.month
+        while datetime(y, m, 1, tzinfo=BUCHAREST_TZ) < before:
+            out.append((chat_id, y, m))
+            y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+
+def run(engine, root, older_than_days: int, dry_run: bool = False) -> int:
+    before = cutoff(older_than_days)
+    moved = 0
+    for chat_id, y, m in candidates(engine, before):
+        if dry_run:
+            print(f"would archive chat {chat_id} {y:04d}-{m:02d}")
+            continue
+        n = archive_month(engine, root, chat_id, y, m)
+        if n:
+            print(f"archived chat {chat_id} {y:04d}-{m:02d}: {n}")
+        moved += n
+    return moved
+
+
+# ------------------------------------------------------------------------------
+# Чтение (DuckDB)
+# ------------------------------------------------------------------------------
+def _files(root, chat_ids=None, since=None, until=None) -> list[str]:
+    out = []
+    for f in load_manifest(root)["files"].values():
+        if chat_ids is not None and f["chat_id"] not in chat_ids:
+            continue
+        if since is not None and datetime.fromisoformat(f["max_date"]) <= since:
+            continue
+        if until is not None and datetime.fromisoformat(f["min_date"]) >= until:
+            continue
+        p = Path(root) / f["path"]
+        if p.exists():
+            out.append(str(p))
+    return out
+
+
+def _text_terms(q: str, words: bool) -> tuple[list[str], list[str]]:
+    """Подстрока целиком или (для режимов по словам) слова: обязательные и исключённые."""
+    if not words:
+        return [q], []
+    inc, exc = [], []
+    for w in q.replace('"', " ").split():
+        w = w.rstrip("*")
+        if w.startswith("-") and len(w) > 1:
+            exc.append(w[1:])
+        elif w:
+            inc.append(w)
+    return inc, exc
+
+
+def _where(chat_ids, user_id, since, until, q, words):
+    where, params = [], []
+    if chat_ids is not None:
+        where.append(f"chat_id IN ({', '.join('?' for _ in chat_ids)})")
+        params += list(chat_ids)
+    if user_id is not None:
+        where.append("user_id = ?")
+        params.append(user_id)
+    if since is not None:
+        where.append("date >= ?")
+        params.append(since.astimezone(timezone.utc).replace(tzinfo=None))
+    if until is not None:
+        where.append("date < ?")
+        params.append(until.astimezone(timezone.utc).replace(tzinfo=None))
+    if q:
+        inc, exc = _text_terms(q, words)
+        for w in inc:
+            where.append("text ILIKE ?")
+            params.append(f"%{w}%")
+        for w in exc:
+            where.append("coalesce(text, '') NOT ILIKE ?")
+            params.append(f"%{w}%")
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+
+def _source(files: list[str]) -> str:
+    return "read_parquet([" + ", ".join("'" + f.replace("'", "''") + "'" for f in files) + "])"
+
+
+def _connect():
+    import duckdb
+    con = duckdb.connect()
+    con.execute("SET TimeZone = 'UTC'")
+    return con
+
+
+def cold_query(root, *, chat_ids=None, user_id=None, since=None, until=None, q=None, words=False,
+               limit=100, key=None, older=True) -> list[dict]:
+    """Сообщения архива по ключу (date, chat_id, message_id): older — новые сверху, с ключом
+    меньше key; иначе по возрастанию, с ключом больше key. Даты — aware UTC, как из БД."""
+    if key is not None:
+        # файлы целиком по другую сторону ключа не читаются
+        if older:
+            until = min(until, key[0] + timedelta(microseconds=1)) if until else key[0] + timedelta(microseconds=1)
+        else:
+            since = max(since, key[0]) if since else key[0]
+    files = _files(root, chat_ids, since, until)
+    if not files or not duckdb_available():
+        return []
+    where, params = _where(chat_ids, user_id, since, until, q, words)
+    if key is not None:
+        where += (" AND " if where else " WHERE ") + f"(date::TIMESTAMP, chat_id, message_id) {'<' if older else '>'} (?, ?, ?)"
+        params += [key[0].astimezone(timezone.utc).replace(tzinfo=None), key[1], key[2]]
+    order = "DESC" if older else "ASC"
+    sql = (f"SELECT chat_id, message_id, account_id, user_id, date::TIMESTAMP AS date, text, text_hash "
+           f"FROM {_source(files)}{where} ORDER BY date {order}, chat_id {order}, message_id {order} LIMIT ?")
+    with _connect() as con:
+        rows = con.execute(sql, params + [int(limit)]).fetchall()
+    out = [dict(zip(COLUMNS, r)) for r in rows]
+    for r in out:
+        r["date"] = r["date"].replace(tzinfo=timezone.utc) if r["date"] else None
+    return out
+
+
+def cold_iter(root, *, chat_ids=None, user_id=None, since=None, until=None, q=None, words=False,
+              batch: int = DELETE_BATCH):
+    """Все подходящие сообщения архива по возрастанию ключа (date, chat_id, message_id),
+    пачками по batch (для потоковой выгрузки). Даты — aware UTC, как из БД."""
+    files = _files(root, chat_ids, since, until)
+    if not files or not duckdb_available():
+        return
+    where, params = _where(chat_ids, user_id, since, until, q, words)
+    sql = (f"SELECT chat_id, message_id, account_id, user_id, date::TIMESTAMP AS date, text, text_hash "
+           f"FROM {_source(files)}{where} ORDER BY date, chat_id, message_id")
+    with _connect() as con:
+        cur = con.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            out = [dict(zip(COLUMNS, r)) for r in rows]
+            for r in out:
+                r["date"] = r["date"].replace(tzinfo=timezone.utc) if r["date"] else None
+            yield out
+
+
+def cold_count(root, *, chat_ids=None, user_id=None, since=None, until=None, q=None, words=False) -> int:
+    files = _files(root, chat_ids, since, until)
+    if not files or not duckdb_available():
+        return 0
+    if not (user_id or since or until or q):
+        # без фильтров по строкам — из manifest, без чтения файлов
+        return sum(f["rows"] for f in load_manifest(root)["files"].values()
+                   if chat_ids is None or f["chat_id"] in chat_ids)
+    where, params = _where(chat_ids, user_id, since, until, q, words)
+    with _connect() as con:
+        return con.execute(f"SELECT count(*) FROM {_source(files)}{where}", params).fetchone()[0]
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Архив старых сообщений в Parquet")
+    ap.add_argument("command", choices=["run", "list"])
+    ap.add_argument("--older-than-days", type=int)
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args(argv)
+
+    s = settings(read_config())
+    if args.command == "list":
+        for key, f in sorted(load_manifest(s["path"])["files"].items()):
+            print(f"{key}: {f['rows']} строк, {f['bytes'] // 1024} KiB, message_id {f['min_message_id']}..{f['max_message_id']}")
+        return 0
+
+    from db import engine
+    days = args.older_than_days if args.older_than_days is not None else int(s["older_than_days"])
+    if args.older_than_days is None and not s["enabled"]:
+        print("storage.archive.enabled: false — задайте --older-than-days для ручного запуска.")
+        return 1
+    print(f"archived: {run(engine, s['path'], days, args.dry_run)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# browse.py — выборка сообщений для «Просмотра БД»: фильтры и keyset-пагинация
+#
+# Страницы листаются по ключу (date, chat_id, message_id): следующая — строки с ключом
+# меньше последнего на текущей, без OFFSET, поэтому страница 5000 стоит столько же,
+# сколько первая. Токены «вперёд»/«назад» — ключи крайних строк страницы.
+# Сортировка по релевантности ключа не имеет (ранг вычисляется) — там токен хранит offset.
+# Общее число строк не нужно для листания: оценка планировщика Postgres сразу,
+# точный count(*) — по запросу, панель считает его в фоне.
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, func, tuple_
+from sqlmodel import select
+
+from db import Chat, Message, MessageText
+import search
+import storage
+import textstore
+
+KEY = (Message.date, Message.chat_id, Message.message_id)
+
+
+def conditions(f: dict, tsq=None) -> list:
+    """WHERE по фильтрам: kind, chat_id, user_id, since/until (aware datetime), q, text_mode.
+    text_mode: "fts" (нужен готовый tsq), "fuzzy" или "substring"."""
+    where = []
+    if f.get("chat_id"):
+        where.append(Message.chat_id == f["chat_id"])
+    if f.get("user_id") is not None:
+        where.append(Message.user_id == f["user_id"])
+
+    kind = f.get("kind", "любой")
+    if kind == "канал":
+        where.append(Chat.is_channel == True)
+    elif kind == "группа":
+        where.append(Chat.is_group == True)
+    elif kind == "личка":
+        where.append((Chat.is_channel == False) & (Chat.is_group == False))
+
+    if f.get("since"):
+        where.append(Message.date >= f["since"])
+    if f.get("until"):
+        where.append(Message.date < f["until"])
+
+    q, mode = f.get("q"), f.get("text_mode", "substring")
+    if q and mode == "fts":
+        if tsq is not None:
+            where.append(search.match(tsq))
+    elif q and mode == "fuzzy":
+        where.append(search.message_text_match(q, fuzzy=True))
+    elif q:
+        where.append(search.message_text_match(q))
+    return where
+
+
+def messages(where=()):
+    """Сообщения с названием чата и полным текстом."""
+    stmt = select(
+        Message.message_id,
+        Message.chat_id,
+        Chat.title.label("chat_title"),
+        Message.user_id,
+        Message.date,
+        textstore.full_text().label("text"),
+        Message.text_hash,
+    ).join(Chat, Chat.chat_id == Message.chat_id).outerjoin(
+        MessageText, MessageText.text_hash == Message.text_hash
+    )
+    return stmt.where(and_(*where)) if where else stmt
+
+
+# ------------------------------------------------------------------------------
+# Токены
+# ------------------------------------------------------------------------------
+def row_key(r) -> tuple:
+    return (r.date, r.chat_id, r.message_id)
+
+
+def encode_token(token: dict) -> str:
+    raw = dict(token)
+    if "k" in raw:
+        d, c, m = raw["k"]
+        raw["k"] = [d.isoformat(), c, m]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode()
+
+
+def decode_token(s: str) -> dict:
+    """{"dir": "next"|"prev", "k": (date, chat_id, message_id)} или {"o": offset}."""
+    raw = json.loads(base64.urlsafe_b64decode(s.encode()))
+    if "k" in raw:
+        d, c, m = raw["k"]
+        raw["k"] = (datetime.fromisoformat(d), c, m)
+    return raw
+
+
+def _beyond(key, older: bool):
+    d = key[0]
+    cmp = tuple_(*KEY) < key if older else tuple_(*KEY) > key
+    # отдельное условие на date — планировщик берёт диапазон по индексу даты
+    return and_(Message.date <= d if older else Message.date >= d, cmp)
+
+
+# ------------------------------------------------------------------------------
+# Страницы
+# ------------------------------------------------------------------------------
+def page(sess, stmt, limit: int, token: str = None, cold=None) -> dict:
+    """Страница по ключу, новые сверху. cold(limit, key, older) -> строки архива в том же
+    порядке — склеиваются с БД по ключу. Возвращает {"rows", "next", "prev"} (токены или None)."""
+    tok = decode_token(token) if token else {}
+    key, older = tok.get("k"), tok.get("dir", "next") == "next"
+    s = stmt.where(_beyond(key, older)) if key else stmt
+    order = [c.desc() for c in KEY] if older else list(KEY)
+    rows = list(sess.exec(s.order_by(*order).limit(limit + 1)).all())
+    if cold is not None:
+        rows = sorted(rows + list(cold(limit + 1, key, older)), key=row_key, reverse=older)[:limit + 1]
+    more = len(rows) > limit
+    if not older and not more:
+        return page(sess, stmt, limit, None, cold)  # дошли до начала — полная первая страница
+    rows = rows[:limit]
+    if not older:
+        rows.reverse()
+    if not rows:
+        return {"rows": [], "next": None, "prev": None}
+    has_next = more if older else True
+    has_prev = key is not None if older else more
+    return {
+        "rows": rows,
+        "next": encode_token({"dir": "next", "k": row_key(rows[-1])}) if has_next else None,
+        "prev": encode_token({"dir": "prev", "k": row_key(rows[0])}) if has_prev else None,
+    }
+
+
+def page_ranked(sess, stmt, order, limit: int, token: str = None) -> dict:
+    """Страница при сортировке по релевантности — по offset."""
+    offset = decode_token(token).get("o", 0) if token else 0
+    rows = list(sess.exec(stmt.order_by(*order).limit(limit + 1).offset(offset)).all())
+    more = len(rows) > limit
+    return {
+        "rows": rows[:limit],
+        "next": encode_token({"o": offset + limit}) if more else None,
+        "prev": encode_token({"o": max(0, offset - limit)}) if offset else None,
+    }
+
+
+# ------------------------------------------------------------------------------
+# Количество
+# ------------------------------------------------------------------------------
+def count_exact(sess, stmt) -> int:
+    return sess.exec(select(func.count()).select_from(stmt.subquery())).one()
+
+
+def count_estimate(sess, stmt):
+    """Оценка числа строк планировщиком Postgres (EXPLAIN без выполнения); в SQLite — None."""
+    if not storage.is_postgres(sess):
+        return None
+    conn = sess.connection()
+    compiled = stmt.compile(bind=conn)
+    plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
@@ -0,0 +1,161 @@
+# catalog.py — «Справочник чатов»: выборка чатов с метаданными и сохранение правок
+#
+# Список строится одним запросом: chat + chatmeta + темы и языки, свёрнутые
+# string_agg/group_concat в подзапросах по chat_id. Фильтры по типу, стране и языку —
+# в WHERE, а не в Python; страницы — LIMIT/OFFSET по индексу ix_chat_title_cover.
+# Сохранение пишет только разницу: удаляет снятые темы/языки и добавляет новые — по
+# запросу на таблицу для всей пачки чатов, в одной транзакции вызывающего.
+
+from sqlalchemy import delete, func, tuple_, update
+from sqlmodel import select
+
+from db import AccountChat, Chat, ChatBot, ChatLanguage, ChatMeta, ChatTopic, User
+import search
+import storage
+
+SEP = "\x1f"  # разделитель в агрегате — не встречается в названиях тем и языков
+
+
+def _values(agg) -> list[str]:
+    return sorted(set(agg.split(SEP))) if agg else []
+
+
+def kind_condition(kind: str):
+    """Условие на тип чата («канал», «группа», «личка»); None — любой."""
+    if kind == "канал":
+        return Chat.is_channel == True
+    if kind == "группа":
+        return Chat.is_group == True
+    if kind == "личка":
+        return (Chat.is_channel == False) & (Chat.is_group == False)
+    return None
+
+
+def _filtered(stmt, kind="любой", country=None, language=None, topic=None, q=None, account_id=None):
+    cond = kind_condition(kind)
+    if cond is not None:
+        stmt = stmt.where(cond)
+    if country:
+        stmt = stmt.where(Chat.chat_id.in_(select(ChatMeta.chat_id).where(ChatMeta.country == country)))
+    if language:
+        stmt = stmt.where(Chat.chat_id.in_(select(ChatLanguage.chat_id).where(ChatLanguage.language == language)))
+    if topic:
+        stmt = stmt.where(Chat.chat_id.in_(select(ChatTopic.chat_id).where(ChatTopic.topic == topic)))
+    if q:
+        stmt = stmt.where(Chat.title.ilike(f"%{q}%"))
+    if account_id is not None:
+        stmt = stmt.where(Chat.chat_id.in_(select(AccountChat.chat_id).where(AccountChat.account_id == account_id)))
+    return stmt
+
+
+def count(sess, **filters) -> int:
+    """Число чатов под фильтрами chats()."""
+    return sess.exec(_filtered(select(func.count()).select_from(Chat), **filters)).one()
+
+
+def chats(sess, limit: int = None, offset: int = 0, **filters) -> list[dict]:
+    """Чаты с country, fts_config, topics и languages (списки), по названию.
+    Фильтры: kind, country, language, topic (точное значение), q (подстрока названия), account_id."""
+    topics = (
+        select(ChatTopic.chat_id, storage.string_agg(sess, ChatTopic.topic, SEP).label("agg"))
+        .group_by(ChatTopic.chat_id).subquery()
+    )
+    langs = (
+        select(ChatLanguage.chat_id, storage.string_agg(sess, ChatLanguage.language, SEP).label("agg"))
+        .group_by(ChatLanguage.chat_id).subquery()
+    )
+    stmt = _filtered(
+        select(Chat.chat_id, Chat.title, Chat.type, Chat.is_channel, Chat.is_group,
+               ChatMeta.country, ChatMeta.fts_config, topics.c.agg, langs.c.agg)
+        .outerjoin(ChatMeta, ChatMeta.chat_id == Chat.chat_id)
+        .outerjoin(topics, topics.c.chat_id == Chat.chat_id)
+        .outerjoin(langs, langs.c.chat_id == Chat.chat_id)
+        .order_by(Chat.title, Chat.chat_id),
+        **filters,
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit).offset(offset)
+    return [
+        {"chat_id": cid, "title": title, "type": type_, "is_channel": bool(is_ch), "is_group": bool(is_gr),
+         "country": country, "fts_config": fts, "topics": _values(t), "languages": _values(l)}
+        for cid, title, type_, is_ch, is_gr, country, fts, t, l in sess.exec(stmt).all()
+    ]
+
+
+def bots(sess, chat_ids) -> dict[int, list[str]]:
+    """Боты чатов одним запросом: chat_id -> ["@username" или user_id]."""
+    if not chat_ids:
+        return {}
+    out = {}
+    for cid, uid, username in sess.exec(
+        select(ChatBot.chat_id, User.user_id, User.username)
+        .join(User, User.user_id == ChatBot.bot_user_id)
+        .where(ChatBot.chat_id.in_(list(chat_ids)))
+        .order_by(ChatBot.chat_id, User.username)
+    ).all():
+        out.setdefault(cid, []).append(f"@{username}" if username else str(uid))
+    return out
+
+
+# ------------------------------------------------------------------------------
+# Сохранение
+# ------------------------------------------------------------------------------
+def _sync(sess, model, col: str, wanted: dict) -> set[int]:
+    """Приводит значения col у чатов к wanted (chat_id -> значения): удаляет лишние,
+    вставляет недостающие. Возвращает chat_id, у которых что-то изменилось."""
+    column = getattr(model, col)
+    current = {}
+    for cid, v in sess.exec(select(model.chat_id, column).where(model.chat_id.in_(list(wanted)))).all():
+        current.setdefault(cid, set()).add(v)
+    drop, add, changed = [], [], set()
+    for cid, values in wanted.items():
+        have, want = current.get(cid, set()), set(values)
+        if have != want:
+            changed.add(cid)
+        drop += [(cid, v) for v in have - want]
+        add += [{"chat_id": cid, col: v} for v in sorted(want - have)]
+    if drop:
+        sess.exec(delete(model).where(tuple_(model.chat_id, column).in_(drop)))
+    if add:
+        sess.connection().execute(model.__table__.insert(), add)
+    return changed
+
+
+def save_many(sess, rows: list[dict]) -> set[int]:
+    """rows — chat_id, country, topics, languages. Без commit.
+    Возвращает chat_id, у которых изменились языки (для sync_fts)."""
+    if not rows:
+        return set()
+    storage.upsert(sess, ChatMeta.__table__, [
+        {"chat_id": r["chat_id"], "country": r.get("country") or None} for r in rows
+    ], ["chat_id"], ["country"])
+    _sync(sess, ChatTopic, "topic", {r["chat_id"]: r.get("topics") or () for r in rows})
+    return _sync(sess, ChatLanguage, "language", {r["chat_id"]: r.get("languages") or () for r in rows})
+
+
+def save(sess, chat_id: int, country=None, topics=(), languages=()) -> bool:
+    """Страна, темы и языки одного чата. Без commit. True — изменились языки."""
+    return bool(save_many(sess, [{"chat_id": chat_id, "country": country, "topics": topics, "languages": languages}]))
+
+
+def sync_fts(sess, chat_ids) -> list[int]:
+    """chatmeta.fts_config по текущим языкам чатов. Только Postgres с text_tsv, без commit.
+    Сами сообщения не трогает: чаты со сменившейся конфигурацией после commit
+    переиндексирует search.reindex_pending (в фоне). Возвращает эти chat_id."""
+    chat_ids = list(chat_ids)
+    if not chat_ids or not search.fts_available(sess.get_bind()):
+        return []
+    available = search.available_configs(sess.connection())
+    langs = {}
+    for cid, lang in sess.exec(
+        select(ChatLanguage.chat_id, ChatLanguage.language).where(ChatLanguage.chat_id.in_(chat_ids))
+    ).all():
+        langs.setdefault(cid, []).append(lang)
+    current = dict(sess.exec(select(ChatMeta.chat_id, ChatMeta.fts_config).where(ChatMeta.chat_id.in_(chat_ids))).all())
+    changed = []
+    for cid in chat_ids:
+        cfg = search.fts_config_for(sorted(langs.get(cid, [])), available)
+        if current.get(cid) != cfg:
+            sess.exec(update(ChatMeta).where(ChatMeta.chat_id == cid).values(fts_config=cfg))
+            changed.append(cid)
+    return changed
@@ -3,34 +3,44 @@
 
 import os
 import sys
-import math
 import json
 import time
 import yaml
-import asyncio
 import subprocess
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
 import psutil
 
+import altair as alt
 import streamlit as st
 import pandas as pd
 from dotenv import load_dotenv
 
 # SQLModel / SQLAlchemy
-from sqlalchemy import func, delete
+from sqlalchemy import func, tuple_
 from sqlmodel import select
 
-# Telethon (для вкладки «Диалоги»)
-from telethon import TelegramClient
-from telethon.tl.types import User as TLUser, Channel, Chat as TLChat
-
 # Проектные импорты
+from utils import validate_config, json_log_path
+import logquery
+import analytics
+import archive
+import browse
+import catalog
+import dialogs
+import exporter
+import search
+import stats
+import storage
+import textstore
 from db import (
-    get_session, Account, User, Chat, Message, Cursor, Window,
-    AccountChat, ChatBot, DirectPeer, ChatMeta, ChatTopic, ChatLanguage
+    engine, get_session, Account, User, Chat, Message, Cursor, Window,
+    AccountChat, ChatBot, DirectPeer, ChatMeta, MessageText, ActivityRollup
 )
 
 # ------------------------------------------------------------------------------
@@ -41,10 +51,15 @@ ENV_PATH = ".env"
 RUNTIME_DIR = Path("runtime")
 RUNTIME_DIR.mkdir(parents=True, exist_ok=True)
 HEARTBEAT_PATH = RUNTIME_DIR / "worker_heartbeat.json"
+META_VERSION_PATH = RUNTIME_DIR / "meta_version"
 PID_FILE = RUNTIME_DIR / "worker.pid"
 DICT_COUNTRIES_PATH = "countries.yaml"
 DICT_LANGUAGES_PATH = "languages.yaml"
 DICT_TOPICS_PATH = "topics.yaml"
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+EXPORT_DOWNLOAD_MAX_MB = 200  # больше — забирать из exports/ напрямую
+EXPORT_JOBS_KEEP = 10  # завершённых выгрузок в списке вкладки «Экспорт»
+CACHE_TTL_SEC = 300  # страховка для записей мимо воркера и панели (CLI-скрипты, ручные правки)
 
 SESSIONS_DIR = Path("sessions")
 SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
@@ -111,6 +126,81 @@ def stop_worker() -> None:
             pass
 
 
+def reload_worker_config() -> bool:
+    """Просит воркер перечитать config.yaml (SIGHUP) без перезапуска."""
+    pid = get_worker_pid()
+    if not pid or not psutil.pid_exists(pid) or not hasattr(signal, "SIGHUP"):
+        return False
+    try:
+        psutil.Process(pid).send_signal(signal.SIGHUP)
+        return True
+    except psutil.Error:
+        return False
+
+
+def day_start(d) -> datetime:
+    """date из date_input -> начало суток по Бухаресту (aware datetime для фильтра по timestamptz)."""
+    return datetime(d.year, d.month, d.day, tzinfo=BUCHAREST_TZ)
+
+
+def fmt_dt(dt) -> str:
+    return dt.astimezone(BUCHAREST_TZ).strftime("%Y-%m-%d %H:%M:%S") if dt else ""
+
+
+@st.cache_resource
+def count_pool() -> ThreadPoolExecutor:
+    """Фоновый точный count(*) для «Просмотра БД» — общий на все сессии панели."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="count")
+
+
+@st.cache_resource
+def count_jobs() -> dict:
+    """Ключ фильтров «Просмотра БД» -> Future точного count(*); общий на все сессии панели,
+    поэтому готовое число переживает повторную отправку формы и обновление страницы браузера."""
+    return {}
+
+
+@st.cache_resource
+def export_pool() -> ThreadPoolExecutor:
+    """Фоновые выгрузки exporter.py — по одной за раз на всю панель."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+
+@st.cache_resource
+def reindex_pool() -> ThreadPoolExecutor:
+    """Фоновая переиндексация поиска после смены языков чата (search.reindex_pending)."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="reindex")
+
+
+@st.cache_resource
+def dialog_pool() -> ThreadPoolExecutor:
+    """Фоновые обновления диалогов из Telegram (dialogs.refresh) — по одному за раз."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="dialogs")
+
+
+@st.cache_resource
+def dialog_jobs() -> dict:
+    """session_name -> Future последнего обновления; общий на все сессии панели,
+    чтобы второй оператор не запускал то же обновление."""
+    return {}
+
+
+@st.cache_data(ttl=600, max_entries=8, show_spinner="Считаю аналитику…")
+def analytics_bundle(chat_ids, since, until, window: int, recent_days: int, titles: dict, version: str) -> dict:
+    """Все таблицы вкладки «Аналитика» для набора фильтров — кэш по этому ключу и версии данных."""
+    data = analytics.load(chat_ids, since, until)
+    daily = data["daily"]
+    return {
+        "curve": analytics.activity_curve(daily, since, until, window),
+        "heat": analytics.hour_of_week(data["hourly"]),
+        "chats": analytics.chat_ranking(daily, titles, until, recent_days),
+        "posters": analytics.poster_ranking(data["posters"], int(daily["messages"].sum())),
+        "messages": int(daily["messages"].sum()),
+        "bots": int(daily["bot_messages"].sum()),
+        "active_chats": int(daily["chat_id"].nunique()),
+    }
+
+
 def read_heartbeat():
     try:
         if HEARTBEAT_PATH.exists():
@@ -120,8 +210,117 @@ def read_heartbeat():
     return None
 
 
-def load_cfg() -> dict:
-    if not os.path.exists(CFG_PATH):
+# ------------------------------------------------------------------------------
+# Кэш чтений
+# ------------------------------------------------------------------------------
+# Чтения из БД кэшируются st.cache_data — общий кэш на все сессии панели — с ключом
+# «параметры + data_version()». Версия меняется, когда воркер что-то записал (data_version
+# в heartbeat) или в панели сохранили метаданные чатов, — тогда следующий рендер читает
+# заново; пока данные не менялись, аналитики панели в БД не ходят. Файлы (config.yaml,
+# справочники, лог) кэшируются по mtime и размеру. Записи под старой версией больше не
+# читаются, поэтому max_entries держит в памяти только последние наборы параметров.
+def file_stamp(path) -> tuple:
+    try:
+        st_ = os.stat(path)
+        return st_.st_mtime_ns, st_.st_size
+    except OSError:
+        return None
+
+
+def data_version() -> str:
+    hb = read_heartbeat() or {}
+    try:
+        meta = META_VERSION_PATH.read_text().strip()
+    except OSError:
+        meta = ""
+    return f"{hb.get('data_version', '')}|{meta}"
+
+
+def bump_meta_version() -> None:
+    """Сбросить кэш чтений у всех сессий панели после правки в БД."""
+    META_VERSION_PATH.write_text(str(time.time_ns()))
+
+
+def rerun_browser() -> None:
+    """Следующий прогон снова показывает страницу «Просмотра БД» — для виджетов внутри результатов."""
+    st.session_state["browser_run_query"] = True
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=2, show_spinner=False)
+def chat_list(version: str) -> list:
+    """Все чаты (id, название, тип) по названию — для селекторов."""
+    with get_session() as sess:
+        rows = sess.exec(
+            select(Chat.chat_id, Chat.title, Chat.type, Chat.is_group, Chat.is_channel).order_by(Chat.title)
+        ).all()
+    return [SimpleNamespace(**r._asdict()) for r in rows]
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=32, show_spinner=False)
+def chat_reference(kind: str, country, language, version: str) -> list[dict]:
+    """Чаты с метаданными для «Справочника чатов» — один запрос, фильтры в SQL."""
+    with get_session() as sess:
+        return catalog.chats(sess, kind, country, language)
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=2, show_spinner=False)
+def db_metrics(version: str) -> dict:
+    with get_session() as sess:
+        try:
+            totals = stats.totals(sess)  # одна строка chatstats по первичному ключу
+        except Exception:
+            sess.rollback()
+            totals = None  # таблицы ещё нет (до шага 6 migrations.py)
+        if totals is not None:
+            return {k: getattr(totals, k) for k in
+                    ("messages", "chats", "users", "channels", "groups", "last_message_at", "reconciled_at")}
+        return {
+            "messages": sess.exec(select(func.count()).select_from(Message)).one(),
+            "chats": sess.exec(select(func.count()).select_from(Chat)).one(),
+            "users": sess.exec(select(func.count()).select_from(User)).one(),
+            "channels": sess.exec(select(func.count()).select_from(Chat).where(Chat.is_channel == True)).one(),
+            "groups": sess.exec(select(func.count()).select_from(Chat).where(Chat.is_group == True)).one(),
+            "last_message_at": sess.exec(select(Message.date).order_by(Message.date.desc()).limit(1)).first(),
+            "reconciled_at": None,
+        }
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=8, show_spinner=False)
+def daily_activity(days: int, version: str) -> list:
+    """(сутки, сообщений) за последние days дней — из activityrollup (rollup.py)."""
+    since = datetime.now(BUCHAREST_TZ).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    with get_session() as sess:
+        return [tuple(r) for r in sess.exec(
+            select(ActivityRollup.bucket, func.sum(ActivityRollup.messages))
+            .where(ActivityRollup.grain == "d", ActivityRollup.bucket >= since)
+            .group_by(ActivityRollup.bucket)
+            .order_by(ActivityRollup.bucket)
+        ).all()]
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=32, show_spinner=False)
+def find_users(name_q: str, fuzzy: bool, version: str) -> list:
+    with get_session() as sess:
+        return [SimpleNamespace(**r._asdict()) for r in search.find_users(sess, name_q, fuzzy=fuzzy)]
+
+
+@st.cache_data(ttl=CACHE_TTL_SEC, max_entries=2, show_spinner=False)
+def tech_tables(version: str) -> tuple:
+    """Cursor и Window для вкладки «Окна/Курсоры»."""
+    with get_session() as sess:
+        cursors = [(c.chat_id, c.oldest_fetched_id, c.newest_fetched_id) for c in sess.exec(select(Cursor)).all()]
+        windows = [(w.id, w.chat_id, w.min_id, w.max_id) for w in sess.exec(select(Window)).all()]
+    return cursors, windows
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def log_tail(path: str, n: int, stamp) -> str:
+    return "\n".join(logquery.tail(path, n))  # блоками с конца файла, не весь лог
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_cfg(stamp) -> dict:
+    if stamp is None:
         # минимальный конфиг по умолчанию
         return {
             "chats": [],
@@ -146,6 +345,10 @@ def load_cfg() -> dict:
         return yaml.safe_load(f) or {}
 
 
+def load_cfg() -> dict:
+    return _read_cfg(file_stamp(CFG_PATH))
+
+
 def save_cfg(cfg: dict) -> None:
     with open(CFG_PATH, "w", encoding="utf-8") as f:
         yaml.safe_dump(cfg, f, allow_unicode=True, sort_keys=False)
@@ -169,8 +372,9 @@ def save_env(values: dict) -> None:
         f.writelines(lines)
 
 
-def load_list(path: str) -> list[str]:
-    if os.path.exists(path):
+@st.cache_data(max_entries=16, show_spinner=False)
+def _read_list(path: str, stamp) -> list[str]:
+    if stamp is not None:
         with open(path, "r", encoding="utf-8") as f:
             data = yaml.safe_load(f) or []
             if isinstance(data, list):
@@ -178,36 +382,15 @@ def load_list(path: str) -> list[str]:
     return []
 
 
+def load_list(path: str) -> list[str]:
+    return _read_list(path, file_stamp(path))
+
+
 def save_list(path: str, items: list[str]) -> None:
     with open(path, "w", encoding="utf-8") as f:
         yaml.safe_dump(items, f, allow_unicode=True, sort_keys=False)
 
 
-# ------------------------------------------------------------------------------
-# Диалоги (получение списка из Telegram)
-# ------------------------------------------------------------------------------
-async def _fetch_dialogs(session_name: str, api_id: int, api_hash: str, limit: int = 500):
-    items = []
-    async with TelegramClient(str(SESSIONS_DIR / session_name), api_id, api_hash) as client:
-        async for dlg in client.iter_dialogs(limit=limit):
-            ent = dlg.entity
-            title = getattr(ent, "title", None) or getattr(ent, "username", None) or str(ent.id)
-            username = getattr(ent, "username", None)
-            is_group = isinstance(ent, (TLChat,)) or getattr(ent, "megagroup", False)
-            is_channel = isinstance(ent, Channel) and not getattr(ent, "megagroup", False)
-            items.append({
-                "title": title,
-                "id": ent.id,
-                "username": username,
-                "вид": "канал" if is_channel else ("группа" if is_group else ("личка" if isinstance(ent, TLUser) else "другое")),
-            })
-    return items
-
-
-def fetch_dialogs_sync(session_name: str, api_id: int, api_hash: str, limit: int = 500):
-    return asyncio.run(_fetch_dialogs(session_name, api_id, api_hash, limit))
-
-
 # ------------------------------------------------------------------------------
 # Страница
 # ------------------------------------------------------------------------------
@@ -225,6 +408,7 @@ tabs = st.tabs([
     "ENV (.env)",       # 7
     "Экспорт",          # 8
     "Справочники",      # 9
+    "Аналитика",        # 10
 ])
 
 # ------------------------------------------------------------------------------
@@ -235,11 +419,14 @@ with tabs[0]:
     cfg = load_cfg()
     log_path = cfg.get("storage", {}).get("log_path", "logs/app.log")
 
-    col_run, col_stop, col_refresh = st.columns([1, 1, 1])
+    col_run, col_stop, col_reload, col_refresh = st.columns([1, 1, 1, 1])
     with col_run:
         run_btn = st.button("▶️ Запустить worker", use_container_width=True, key="state_run")
     with col_stop:
         stop_btn = st.button("⏹ Остановить worker", use_container_width=True, key="state_stop")
+    with col_reload:
+        reload_btn = st.button("♻️ Перечитать конфиг", use_container_width=True, key="state_reload_cfg",
+                               help="Воркер применит config.yaml между страницами, без переподключения к Telegram.")
     with col_refresh:
         refresh_btn = st.button("🔄 Обновить статус", use_container_width=True, key="state_refresh")
 
@@ -253,6 +440,12 @@ with tabs[0]:
         time.sleep(0.6)
         st.rerun()
 
+    if reload_btn:
+        if reload_worker_config():
+            st.success("Сигнал отправлен — воркер перечитает config.yaml.")
+        else:
+            st.warning("Воркер не запущен.")
+
     if refresh_btn:
         st.rerun()
 
@@ -284,9 +477,11 @@ with tabs[0]:
         last_action_val = hb.get('last_action') if hb else "—"
         last_chat_id_val = hb.get('last_chat_id') if hb else "—"
         saved_val = hb.get('saved_messages_total') if hb else "—"
+        cfg_applied_val = (hb.get('config_applied_at') or "—") if hb else "—"
         st.caption(
             f"PID: {pid_val} • mode: {mode_val} • last_action: {last_action_val} • "
-            f"last_chat_id: {last_chat_id_val} • saved(last batch): {saved_val}"
+            f"last_chat_id: {last_chat_id_val} • saved(last batch): {saved_val} • "
+            f"config applied: {cfg_applied_val}"
         )
 
     if hb is None:
@@ -294,34 +489,40 @@ with tabs[0]:
 
     # Метрики БД
     st.divider()
+    version = data_version()
     try:
-        with get_session() as sess:
-            total_msgs = sess.exec(select(func.count()).select_from(Message)).one()
-            total_chats = sess.exec(select(func.count()).select_from(Chat)).one()
-            total_users = sess.exec(select(func.count()).select_from(User)).one()
-            last_dt = sess.exec(select(Message.date).order_by(Message.date.desc()).limit(1)).first()
-            channels_cnt = sess.exec(select(func.count()).select_from(Chat).where(Chat.is_channel == True)).one()
-            groups_cnt = sess.exec(select(func.count()).select_from(Chat).where(Chat.is_group == True)).one()
-
+        m = db_metrics(version)
         c_m1, c_m2, c_m3, c_m4 = st.columns(4)
-        c_m1.metric("Сообщений", f"{int(total_msgs):,}".replace(",", " "))
-        c_m2.metric("Чатов (всего)", f"{int(total_chats):,}".replace(",", " "), help=f"Каналы: {channels_cnt} • Группы: {groups_cnt}")
-        c_m3.metric("Пользователей", f"{int(total_users):,}".replace(",", " "))
-        c_m4.metric("Хранилище", "Postgres")
-
-        if last_dt:
-            st.caption(f"Последнее сообщение в базе: {last_dt}")
+        c_m1.metric("Сообщений", f"{int(m['messages']):,}".replace(",", " "))
+        c_m2.metric("Чатов (всего)", f"{int(m['chats']):,}".replace(",", " "),
+                    help=f"Каналы: {m['channels']} • Группы: {m['groups']}")
+        c_m3.metric("Пользователей", f"{int(m['users']):,}".replace(",", " "))
+        c_m4.metric("Хранилище", "Postgres" if storage.is_postgres(engine) else "SQLite")
+
+        if m["last_message_at"]:
+            st.caption(f"Последнее сообщение в базе: {fmt_dt(m['last_message_at'])}"
+                       + (f" • счётчики сверены: {m['reconciled_at']}" if m["reconciled_at"] else ""))
     except Exception as e:
         st.warning(f"Нет подключения к БД: {e}")
 
+    # Активность за 30 дней — из activityrollup (rollup.py), без прохода по message
+    try:
+        act = daily_activity(30, version)
+        if act:
+            st.caption("Сообщений по дням (30 дней):")
+            st.bar_chart(pd.DataFrame(
+                {"сообщений": [int(n) for _, n in act]},
+                index=[b.astimezone(BUCHAREST_TZ).date() for b, _ in act],
+            ))
+    except Exception:
+        pass  # таблицы ещё нет (до шага 7 migrations.py)
+
     # Хвост лога воркера
     st.divider()
     st.caption("Последние строки лога воркера:")
     try:
         if os.path.exists(log_path):
-            with open(log_path, "r", encoding="utf-8", errors="ignore") as f:
-                lines = f.readlines()[-200:]
-            st.code("".join(lines) or "(лог пуст)", language="log")
+            st.code(log_tail(log_path, 200, file_stamp(log_path)) or "(лог пуст)", language="log")
         else:
             st.info(f"Лог-файл пока не создан: {log_path}")
     except Exception as e:
@@ -334,25 +535,84 @@ with tabs[1]:
     st.subheader("Логи приложения")
     cfg = load_cfg()
     log_path = cfg.get("storage", {}).get("log_path", "logs/app.log")
-    follow = st.toggle("Следить в реальном времени (1сек)", value=False, key="logs_follow")
+    lf1, lf2, lf3, lf4 = st.columns([1, 1, 1, 2])
+    with lf1:
+        lf_level = st.selectbox("Уровень (от)", ["любой", "INFO", "WARNING", "ERROR"], key="logs_level")
+    with lf2:
+        lf_chat = st.text_input("chat_id", key="logs_chat")
+    with lf3:
+        lf_lines = st.number_input("Строк", 50, 5000, 500, step=50, key="logs_lines")
+    with lf4:
+        follow = st.toggle("Следить в реальном времени (1сек)", value=False, key="logs_follow")
     placeholder = st.empty()
 
-    def render_log():
+    # читатель хранит inode и смещение между перерисовками и перезапусками скрипта:
+    # каждый опрос читает только дописанные байты
+    follower_key = (log_path, lf_level, lf_chat.strip(), int(lf_lines))
+    follower = st.session_state.get("logs_follower")
+    if follower is None or st.session_state.get("logs_follower_key") != follower_key:
         try:
-            if os.path.exists(log_path):
-                with open(log_path, "r", encoding="utf-8", errors="ignore") as f:
-                    lines = f.readlines()[-500:]
-                placeholder.code("".join(lines) or "(лог пуст)", language="log")
-            else:
+            follower = logquery.LogFollower(
+                log_path, int(lf_lines),
+                level=None if lf_level == "любой" else lf_level,
+                chat_id=int(lf_chat) if lf_chat.strip() else None,
+            )
+        except ValueError:
+            follower = None
+            st.error("chat_id должен быть числом.")
+        st.session_state["logs_follower"], st.session_state["logs_follower_key"] = follower, follower_key
+
+    def render_log(first=False):
+        try:
+            if not os.path.exists(log_path):
                 placeholder.info(f"Лог-файл пока не создан: {log_path}")
+            elif follower.poll() or first:
+                placeholder.code(follower.text() or "(нет записей)", language="log")
         except Exception as e:
             placeholder.error(f"Ошибка чтения лога: {e}")
 
-    render_log()
-    if follow:
-        for _ in range(30):  # ~30 секунд
-            render_log()
-            time.sleep(1)
+    if follower is not None:
+        render_log(first=True)
+        if follow:
+            for _ in range(30):  # ~30 секунд
+                time.sleep(1)
+                render_log()
+
+    st.divider()
+    st.markdown("### Структурированный поиск (JSONL)")
+    jsonl_path = json_log_path(log_path)
+    with st.form("logs_query_form"):
+        lq1, lq2, lq3, lq4 = st.columns(4)
+        with lq1:
+            lq_chat = st.text_input("chat_id", key="logs_q_chat")
+        with lq2:
+            lq_level = st.selectbox("Уровень (от)", ["любой", "INFO", "WARNING", "ERROR"], key="logs_q_level")
+        with lq3:
+            lq_since = st.date_input("С даты", value=None, key="logs_q_since")
+        with lq4:
+            lq_until = st.date_input("По дату", value=None, key="logs_q_until")
+        lq_text = st.text_input("Текст в сообщении", key="logs_q_text")
+        lq_limit = st.number_input("Максимум записей", 10, 10000, 500, step=10, key="logs_q_limit")
+        lq_go = st.form_submit_button("Найти")
+
+    if lq_go:
+        try:
+            recs = logquery.query(
+                jsonl_path,
+                chat_id=int(lq_chat) if lq_chat.strip() else None,
+                level=None if lq_level == "любой" else lq_level,
+                since=lq_since,
+                until=(lq_until + timedelta(days=1)) if lq_until else None,
+                text=lq_text or None,
+                limit=int(lq_limit),
+            )
+            if recs:
+                st.caption(f"Найдено записей: {len(recs)}")
+                st.dataframe(pd.DataFrame(recs), use_container_width=True)
+            else:
+                st.info("Ничего не найдено.")
+        except ValueError as e:
+            st.error(f"Некорректный фильтр: {e}")
 
 # ------------------------------------------------------------------------------
 # 2) НАСТРОЙКИ (config.yaml)
@@ -419,8 +679,8 @@ with tabs[2]:
         help=(
             "Список целевых чатов/каналов. Допустимы: @username "
             "(публичные) или числовой chat_id (для приватных, где аккаунт "
-            "уже состоит). Один пункт — одна строка. После изменения "
-            "сохраните config.yaml и перезапустите воркер."
+            "уже состоит). Один пункт — одна строка. После сохранения "
+            "config.yaml запущенный воркер подхватит изменения сам."
         )
     )
 
@@ -508,8 +768,13 @@ with tabs[2]:
         new_cfg["behavior"]["include_dialogs"] = bool(include_dialogs)
         new_cfg["behavior"]["use_takeout_for_bulk_exports"] = bool(takeout)
         new_cfg["behavior"]["warm_up_mode"] = bool(warmup)
-        save_cfg(new_cfg)
-        st.success("Сохранено. Нажмите «⟳ Обновить из config.yaml», чтобы перечитать файл.")
+        try:
+            validate_config(new_cfg)
+        except ValueError as e:
+            st.error(f"Конфиг не сохранён: {e}")
+        else:
+            save_cfg(new_cfg)
+            st.success("Сохранено. Запущенный воркер применит изменения без перезапуска.")
 with tabs[3]:
     st.subheader("Диалоги (чаты и каналы из Telegram)")
 
@@ -524,54 +789,82 @@ with tabs[3]:
     if not api_id or not api_hash:
         st.warning("Сначала заполните API_ID и API_HASH во вкладке ‘ENV (.env)’.")
     else:
-        col1, col2 = st.columns([1, 1])
+        jobs = dialog_jobs()
+        job = jobs.get(session_name)
+        running = job is not None and not job.done()
+        col1, col2, col3 = st.columns([1, 1, 1])
         with col1:
+            full = st.toggle("Полностью (не только новые)", value=False, key="dlg_full")
+        with col2:
             limit = st.number_input(
-                "Сколько диалогов подтянуть",
-                min_value=50, max_value=2000, value=500, step=50,
-                key="dlg_limit",
+                "Сколько диалогов подтянуть (полностью)",
+                min_value=50, max_value=dialogs.FULL_LIMIT, value=500, step=50,
+                key="dlg_limit", disabled=not full,
             )
-        with col2:
-            go = st.button("🔄 Обновить список чатов из Telegram", use_container_width=True, key="dlg_refresh")
+        with col3:
+            go = st.button("🔄 Обновить список чатов из Telegram", use_container_width=True,
+                           disabled=running, key="dlg_refresh")
 
         if go:
-            with st.spinner("Подключаемся к Telegram и читаем диалоги..."):
-                try:
-                    dialogs = fetch_dialogs_sync(session_name, api_id, api_hash, limit=int(limit))
-                    st.session_state["dialogs_cache"] = dialogs
-                    st.success(f"Найдено диалогов: {len(dialogs)}")
-                except Exception as e:
-                    st.error(f"Ошибка при получении диалогов: {e}")
-
-        dialogs = st.session_state.get("dialogs_cache", [])
-        if dialogs:
-            st.caption("Отметьте галочками, что добавить в config.yaml → кнопка ниже")
-            df = pd.DataFrame(dialogs)
-            options = [f"{row['вид']} | {row['title']} | id={row['id']} | @{row['username'] or '-'}" for _, row in df.iterrows()]
-            selected = st.multiselect("Выберите чаты", options=options, default=[], key="dlg_selected")
+            job = dialog_pool().submit(dialogs.refresh, session_name, api_id, api_hash, full, int(limit))
+            jobs[session_name] = job
+            running = True
+        if running:
+            st.info("Обновление идёт в фоне; ниже — сохранённый список.")
+            if st.button("🔄 Обновить статус", key="dlg_status"):
+                st.rerun()
+        elif job is not None:
+            if job.exception() is not None:
+                st.error(f"Ошибка при получении диалогов: {job.exception()}")
+            else:
+                st.success(f"Обновлено диалогов: {job.result()}")
+
+        f1, f2, f3 = st.columns([2, 1, 1])
+        with f1:
+            dlg_q = st.text_input("Поиск (название или @username)", key="dlg_q").strip()
+        with f2:
+            dlg_kind = st.selectbox("Тип", ["любой", *dialogs.KINDS], key="dlg_kind")
+        with f3:
+            dlg_size = st.selectbox("На странице", [50, 100, 200], index=1, key="dlg_size")
+        dlg_filters = {"q": dlg_q or None, "kind": None if dlg_kind == "любой" else dlg_kind}
+
+        with get_session() as sess:
+            total = dialogs.count(sess, session_name, **dlg_filters)
+            pages = max(1, -(-total // dlg_size))
+            dlg_page = st.number_input(f"Страница (из {pages})", min_value=1, max_value=pages, value=1,
+                                       key="dlg_page") if pages > 1 else 1
+            rows = dialogs.page(sess, session_name, limit=dlg_size, offset=(dlg_page - 1) * dlg_size, **dlg_filters)
+
+        if rows:
+            cfg = load_cfg()
+            existing = cfg.get("chats", []) or []
+            st.caption(f"Диалогов: {total}. Отметьте галочками, что добавить в config.yaml → кнопка ниже")
+            df = pd.DataFrame([{
+                "добавить": False,
+                "в config": dialogs.config_entry(d) in existing or d["dialog_id"] in existing,
+                "вид": d["kind"],
+                "название": d["title"],
+                "username": f"@{d['username']}" if d["username"] else "",
+                "id": d["dialog_id"],
+                "последнее сообщение": d["last_message_at"].astimezone(BUCHAREST_TZ).strftime("%Y-%m-%d %H:%M")
+                if d["last_message_at"] else "",
+            } for d in rows])
+            edited = st.data_editor(
+                df, hide_index=True, use_container_width=True, disabled=[c for c in df.columns if c != "добавить"],
+                key=f"dlg_editor_{dlg_q}_{dlg_kind}_{dlg_size}_{dlg_page}",
+            )
 
             if st.button("➕ Добавить выбранные в config.yaml", type="primary", key="dlg_add_to_cfg"):
-                to_add = []
-                for item in selected:
-                    parts = item.split("|")
-                    id_part = [p for p in parts if "id=" in p][0].strip()
-                    id_val = int(id_part.replace("id=", "").strip())
-                    uname_part = [p for p in parts if "@" in p][-1].strip()
-                    uname = uname_part[1:] if uname_part.startswith("@") else None
-                    if uname and uname != "-":
-                        to_add.append(f"@{uname}")
-                    else:
-                        to_add.append(id_val)
-                cfg = load_cfg()
-                existing = cfg.get("chats", []) or []
-                for x in to_add:
-                    if x and x not in existing:
-                        existing.append(x)
+                to_add = [dialogs.config_entry(d) for d, picked in zip(rows, edited["добавить"]) if picked]
+                added = [x for x in to_add if x not in existing]
+                existing.extend(added)
                 cfg["chats"] = existing
                 save_cfg(cfg)
-                st.success(f"Добавлено в config.yaml: {len(to_add)}. Перезапустите воркер во вкладке ‘Состояние’.")
-        else:
+                st.success(f"Добавлено в config.yaml: {len(added)}. Запущенный воркер подхватит их в текущем проходе.")
+        elif total == 0 and not (dlg_q or dlg_kind != "любой"):
             st.info("Список диалогов пуст. Нажмите ‘Обновить список чатов из Telegram’.")
+        else:
+            st.info("Ничего не найдено.")
 
 # ------------------------------------------------------------------------------
 # 4) ПРОСМОТР БД (сообщения)
@@ -580,15 +873,51 @@ with tabs[4]:
     st.subheader("Просмотр БД: сообщения по чатам")
 
     # Безопасная инициализация и хранение состояний
-    st.session_state.setdefault("browser_page", 1)
+    st.session_state.setdefault("browser_token", None)
     st.session_state.setdefault("browser_filters", {})
     st.session_state.setdefault("browser_run_query", False)
+    if "fts_available" not in st.session_state:
+        try:
+            st.session_state["fts_available"] = search.fts_available(engine)
+        except Exception:
+            st.session_state["fts_available"] = False
+    fts_on = st.session_state["fts_available"]
+    if "trgm_available" not in st.session_state:
+        try:
+            st.session_state["trgm_available"] = search.trgm_available(engine)
+        except Exception:
+            st.session_state["trgm_available"] = False
+    trgm_on = st.session_state["trgm_available"]
+
+    # Поиск контакта по имени (ID — в фильтр «ID контакта» ниже)
+    with st.expander("🔎 Найти контакт по имени"):
+        name_q = st.text_input(
+            "Username, имя или фамилия",
+            key="db_user_lookup",
+            help="Похожие написания (транслит, опечатки) — при установленном pg_trgm." if trgm_on
+                 else "Подстрока без учёта регистра.",
+        )
+        if name_q.strip():
+            found = find_users(name_q.strip(), trgm_on, data_version())
+            if found:
+                st.dataframe(pd.DataFrame([
+                    {
+                        "user_id": u.user_id,
+                        "username": u.username,
+                        "имя": " ".join(filter(None, [u.first_name, u.last_name])),
+                        "бот": "да" if u.is_bot else "",
+                        **({"похожесть": round(float(u.score), 3)} if trgm_on else {}),
+                    }
+                    for u in found
+                ]), use_container_width=True)
+            else:
+                st.info("Никого не найдено.")
 
     # Получить список чатов для селекта
-    with get_session() as sess:
-        chats_q = select(Chat).order_by(Chat.title)
-        chats = sess.exec(chats_q).all()
+    chats = chat_list(data_version())
     chat_map = {f"{c.title or c.chat_id} (id={c.chat_id})": c.chat_id for c in chats}
+    archive_root = archive.settings(load_cfg())["path"]
+    archive_on = bool(archive.load_manifest(archive_root)["files"]) and archive.duckdb_available()
 
     # Форма фильтров
     with st.form("db_browser_form"):
@@ -602,7 +931,23 @@ with tabs[4]:
         with col_top4:
             per_page = st.number_input("На страницу", min_value=10, max_value=500, value=100, step=10, key="db_per_page")
 
-        q = st.text_input("Поиск по тексту (LIKE, без регистра)", key="db_text_query")
+        col_q1, col_q2, col_q3 = st.columns([3, 1, 1])
+        with col_q1:
+            q = st.text_input(
+                "Поиск по тексту",
+                key="db_text_query",
+                help='Слова с учётом словоформ; "точная фраза", префикс*, -исключить.' if fts_on
+                     else "Подстрока без учёта регистра.",
+            )
+        with col_q2:
+            search_mode = st.selectbox(
+                "Режим поиска",
+                (["слова (FTS)"] if fts_on else []) + ["подстрока"] + (["нечётко (trgm)"] if trgm_on else []),
+                key="db_search_mode",
+            )
+        with col_q3:
+            sort_mode = st.selectbox("Сортировка", ["по дате", "по релевантности"], key="db_sort_mode",
+                                     help="Релевантность — для режимов «слова (FTS)» и «нечётко (trgm)».")
 
         chat_label = st.selectbox("Выберите чат", ["(не выбран)"] + list(chat_map.keys()), key="db_chat_select")
         chat_id = chat_map.get(chat_label) if chat_label != "(не выбран)" else None
@@ -613,14 +958,17 @@ with tabs[4]:
         except ValueError:
             user_id = None
 
-        st.divider()
-        page = st.number_input(
-            "Страница",
-            min_value=1,
-            value=int(st.session_state.get("browser_page", 1)),
-            step=1,
-            key="db_page",
+        with_archive = st.checkbox(
+            "Включая архив (Parquet)", value=archive_on, disabled=not archive_on, key="db_with_archive",
+            help="Старые сообщения, вынесенные archive.py. В архиве поиск по словам — как подстроки.",
+        )
+
+        exact_count = st.checkbox(
+            "Точное количество", key="db_exact_count",
+            help="count(*) по всем фильтрам считается в фоне; до его готовности — оценка планировщика.",
         )
+
+        st.divider()
         submitted = st.form_submit_button("Показать сообщения")
 
     if submitted:
@@ -630,10 +978,20 @@ with tabs[4]:
             "date_to": date_to,
             "per_page": per_page,
             "q": q,
+            "search_mode": search_mode,
+            "sort_mode": sort_mode,
             "chat_id": chat_id,
             "user_id": user_id,
+            "with_archive": with_archive,
+            "exact_count": exact_count,
         }
-        st.session_state["browser_page"] = int(page)
+        st.session_state["browser_token"] = None
+        # готовые и идущие count(*) остаются по ключу фильтров; неудавшиеся — считать заново
+        jobs = count_jobs()
+        for k in [k for k, f in jobs.items() if f.done() and f.exception() is not None]:
+            jobs.pop(k, None)
+        for k in [k for k, f in jobs.items() if f.done()][:max(0, len(jobs) - 256)]:  # самые старые
+            jobs.pop(k, None)
         st.session_state["browser_run_query"] = True
 
     if st.session_state.get("browser_run_query"):
@@ -646,53 +1004,84 @@ with tabs[4]:
         q = filters.get("q")
         chat_id = filters.get("chat_id")
         user_id = filters.get("user_id")
+        use_fts = bool(q) and fts_on and filters.get("search_mode") == "слова (FTS)"
+        use_fuzzy = bool(q) and trgm_on and filters.get("search_mode") == "нечётко (trgm)"
+        by_rank = (use_fts or use_fuzzy) and filters.get("sort_mode") == "по релевантности"
+        # архив склеивается с БД по ключу страницы — ранг там не считается
+        cold = archive_on and filters.get("with_archive") and not by_rank
+
+        text_mode = "fts" if use_fts else "fuzzy" if use_fuzzy else "substring"
+        bf = {
+            "kind": kind, "chat_id": chat_id, "user_id": user_id, "q": q, "text_mode": text_mode,
+            "since": day_start(date_from) if date_from else None,
+            "until": day_start(date_to + timedelta(days=1)) if date_to else None,
+        }
 
-        # WHERE-условия
-        where = []
-        if chat_id:
-            where.append(Message.chat_id == chat_id)
-
-        if user_id is not None:
-            where.append(Message.user_id == user_id)
-
-        if kind != "любой":
-            if kind == "канал":
-                where.append(Chat.is_channel == True)
-            elif kind == "группа":
-                where.append(Chat.is_group == True)
-            elif kind == "личка":
-                where.append((Chat.is_channel == False) & (Chat.is_group == False))
-
-        def to_iso(d):
-            return datetime(d.year, d.month, d.day)
-
-        if date_from:
-            where.append(Message.date >= to_iso(date_from).isoformat())
-        if date_to:
-            where.append(Message.date < (to_iso(date_to) + timedelta(days=1)).isoformat())
-
-        if q:
-            where.append(func.lower(Message.text).like(f"%{q.lower()}%"))
-
-        offset = (int(st.session_state.get("browser_page", 1)) - 1) * int(per_page)
+        tsq = None
+        if q and use_fts:
+            with get_session() as sess:
+                tsq = search.build_tsquery(q, search.configs_in_use(sess, chat_id))
+        base = browse.messages(browse.conditions(bf, tsq))
+        st.session_state["browser_query"] = {**bf, "with_archive": bool(cold)}  # для «Экспорта»
+
+        cold_filters = dict(
+            chat_ids=[chat_id] if chat_id else (
+                None if kind == "любой" else [
+                    c.chat_id for c in chats
+                    if (kind == "канал" and c.is_channel) or (kind == "группа" and c.is_group)
+                    or (kind == "личка" and not c.is_channel and not c.is_group)
+                ]
+            ),
+            user_id=user_id, since=bf["since"], until=bf["until"], q=q or None, words=use_fts or use_fuzzy,
+        )
+        titles = {c.chat_id: c.title for c in chats}
+
+        def cold_rows(limit, key, older):
+            return [
+                SimpleNamespace(**r, chat_title=titles.get(r["chat_id"]), rank=0.0)
+                for r in archive.cold_query(archive_root, limit=limit, key=key, older=older, **cold_filters)
+            ]
+
+        # точный count(*) — в фоне, один на набор фильтров; страницы его не ждут
+        count_key = json.dumps(filters, sort_keys=True, default=str)
+        if filters.get("exact_count") and count_key not in count_jobs():
+            def exact_total(stmt=base, with_cold=cold):
+                with get_session() as sess:
+                    n = browse.count_exact(sess, stmt)
+                return n + (archive.cold_count(archive_root, **cold_filters) if with_cold else 0)
+            count_jobs()[count_key] = count_pool().submit(exact_total)
 
         with get_session() as sess:
-            base = select(
-                Message.message_id,
-                Message.chat_id,
-                Chat.title.label("chat_title"),
-                Message.user_id,
-                Message.date,
-                Message.text,
-            ).join(Chat, Chat.chat_id == Message.chat_id)
-
-            if where:
-                from sqlmodel import and_  # локальный импорт
-                base = base.where(and_(*where))
-
-            total = sess.exec(select(func.count()).select_from(base.subquery())).one()
-            page_stmt = base.order_by(Message.date.desc()).limit(int(per_page)).offset(int(offset))
-            rows = sess.exec(page_stmt).all()
+            if tsq is not None:
+                base = base.add_columns(search.rank(tsq).label("rank"))
+            token = st.session_state.get("browser_token")
+            if by_rank and tsq is not None:
+                res = browse.page_ranked(sess, base, [search.rank(tsq).desc(), Message.date.desc()], int(per_page), token)
+            elif by_rank:
+                res = browse.page_ranked(sess, base, [search.fuzzy_distance(textstore.full_text(), q), Message.date.desc()],
+                                         int(per_page), token)
+            else:
+                res = browse.page(sess, base, int(per_page), token, cold=cold_rows if cold else None)
+            rows = res["rows"]
+            estimate = None
+            if not filters.get("exact_count"):
+                try:
+                    estimate = browse.count_estimate(sess, base)
+                except Exception:
+                    estimate = None
+
+            # сниппеты с подсветкой — только для строк текущей страницы
+            snippets = {}
+            if tsq is not None and rows:
+                keys = [(r.chat_id, r.message_id) for r in rows]
+                hl = sess.exec(
+                    select(Message.chat_id, Message.message_id,
+                           search.headline(ChatMeta.fts_config, textstore.full_text(), tsq))
+                    .outerjoin(ChatMeta, ChatMeta.chat_id == Message.chat_id)
+                    .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)
+                    .where(tuple_(Message.chat_id, Message.message_id).in_(keys))
+                ).all()
+                snippets = {(c, m): h for c, m, h in hl}
 
             # подтянуть имена пользователей
             uids = [r.user_id for r in rows if r.user_id is not None]
@@ -706,46 +1095,70 @@ with tabs[4]:
                 for uid, un, fn, ln in urows:
                     users[uid] = un or " ".join(filter(None, [fn, ln])) or str(uid)
 
-        st.caption(
-            f"Найдено: {total} сообщений. Страниц: {max(1, math.ceil(total/int(per_page)))}"
-        )
+            # повторы вынесенных текстов — по индексу text_hash
+            usage = textstore.text_usage(sess, {r.text_hash for r in rows if r.text_hash})
+
+        job = count_jobs().get(count_key) if filters.get("exact_count") else None
+        if job is not None and job.done() and job.exception() is None:
+            st.caption(f"Найдено: {job.result()} сообщений.")
+        elif job is not None and job.done():
+            st.caption(f"Не удалось посчитать: {job.exception()}")
+        elif job is not None:
+            cc1, cc2 = st.columns([3, 1])
+            cc1.caption("Точное количество считается…")
+            cc2.button("🔄 Обновить количество", key="db_count_refresh", on_click=rerun_browser)
+        elif estimate is not None:
+            st.caption(f"Найдено: ≈{estimate} сообщений (оценка планировщика, без архива).")
 
         if rows:
             df = pd.DataFrame([
                 {
-                    "дата": r.date,
+                    "дата": fmt_dt(r.date),
                     "пользователь": users.get(r.user_id, r.user_id),
                     "чат": r.chat_title or r.chat_id,
                     "msg_id": r.message_id,
+                    **({"релевантность": round(float(r.rank), 4),
+                        "фрагмент": snippets.get((r.chat_id, r.message_id))} if tsq is not None else {}),
+                    "повторов": usage.get(r.text_hash, (1, 1))[0],
                     "текст": r.text,
                 }
                 for r in rows
             ])
             st.dataframe(df, use_container_width=True)
 
+            repeated = {r.text_hash: r.text for r in rows if usage.get(r.text_hash, (1, 1))[0] > 1}
+            if repeated:
+                with st.expander("Где ещё опубликован этот текст"):
+                    h = st.selectbox(
+                        "Текст",
+                        list(repeated.keys()),
+                        format_func=lambda x: f"{usage[x][0]}× в {usage[x][1]} чатах — {(repeated[x] or '')[:80]}",
+                        key="db_repeated_text",
+                        on_change=rerun_browser,  # иначе следующий прогон не покажет результаты
+                    )
+                    with get_session() as sess:
+                        where_rows = textstore.text_chats(sess, h)
+                    st.dataframe(pd.DataFrame([
+                        {"чат": title or cid, "chat_id": cid, "раз": n, "первый": fmt_dt(first), "последний": fmt_dt(last)}
+                        for cid, title, n, first, last in where_rows
+                    ]), use_container_width=True)
+
             c1, c2, c3 = st.columns([1, 1, 1])
-            total_pages = max(1, math.ceil(total / int(per_page)))
             with c1:
-                if st.button(
-                    "« Назад",
-                    disabled=int(st.session_state["browser_page"]) <= 1,
-                    key="db_prev",
-                ):
-                    st.session_state["browser_page"] -= 1
+                if st.button("« Назад", disabled=res["prev"] is None, key="db_prev"):
+                    st.session_state["browser_token"] = res["prev"]
                     st.session_state["browser_run_query"] = True
                     st.rerun()
             with c2:
-                st.write(f"Стр. {st.session_state['browser_page']} из {total_pages}")
+                if st.button("В начало", disabled=token is None, key="db_first"):
+                    st.session_state["browser_token"] = None
+                    st.session_state["browser_run_query"] = True
+                    st.rerun()
             with c3:
-                if st.button(
-                    "Вперёд »",
-                    disabled=int(st.session_state["browser_page"]) >= total_pages,
-                    key="db_next",
-                ):
-                    if int(st.session_state["browser_page"]) < total_pages:
-                        st.session_state["browser_page"] += 1
-                        st.session_state["browser_run_query"] = True
-                        st.rerun()
+                if st.button("Вперёд »", disabled=res["next"] is None, key="db_next"):
+                    st.session_state["browser_token"] = res["next"]
+                    st.session_state["browser_run_query"] = True
+                    st.rerun()
         else:
             st.info("Нет данных по выбранным фильтрам.")
 
@@ -769,115 +1182,77 @@ with tabs[5]:
     with col3:
         f_lang = st.selectbox("Язык", ["любой"] + languages_list, key="dict_lang")
 
-    with get_session() as sess:
-        q = select(Chat)
-        if f_type != "любой":
-            if f_type == "канал":
-                q = q.where(Chat.is_channel == True)
-            elif f_type == "группа":
-                q = q.where(Chat.is_group == True)
-            elif f_type == "личка":
-                q = q.where((Chat.is_channel == False) & (Chat.is_group == False))
-
-        chats = sess.exec(q).all()
-
-        rows = []
-        for c in chats:
-            meta = sess.exec(select(ChatMeta).where(ChatMeta.chat_id == c.chat_id)).first()
-            topics = sess.exec(select(ChatTopic.topic).where(ChatTopic.chat_id == c.chat_id)).all()
-            langs = sess.exec(select(ChatLanguage.language).where(ChatLanguage.chat_id == c.chat_id)).all()
-
-            country = meta.country if meta else ""
-            topics_str = ", ".join([t[0] for t in topics]) if topics else ""
-            langs_str = ", ".join([l[0] for l in langs]) if langs else ""
-
-            if f_country != "любой" and f_country.lower() not in country.lower():
-                continue
-            if f_lang != "любой" and (not langs_str or f_lang.lower() not in langs_str.lower()):
-                continue
-
-            rows.append({
-                "chat_id": c.chat_id,
-                "title": c.title,
-                "тип": "канал" if c.is_channel else ("группа" if c.is_group else "личка"),
-                "страна": country,
-                "темы": topics_str,
-                "языки": langs_str
-            })
+    rows = chat_reference(
+        f_type,
+        None if f_country == "любой" else f_country,
+        None if f_lang == "любой" else f_lang,
+        data_version(),
+    )
 
-        if rows:
-            df = pd.DataFrame(rows)
-            st.dataframe(df, use_container_width=True)
+    if rows:
+        df = pd.DataFrame([
+            {
+                "chat_id": r["chat_id"],
+                "title": r["title"],
+                "тип": "канал" if r["is_channel"] else ("группа" if r["is_group"] else "личка"),
+                "страна": r["country"] or "",
+                "темы": ", ".join(r["topics"]),
+                "языки": ", ".join(r["languages"]),
+            }
+            for r in rows
+        ])
+        st.dataframe(df, use_container_width=True)
 
-            st.divider()
-            st.subheader("Редактирование свойств чата")
+        st.divider()
+        st.subheader("Редактирование свойств чата")
 
-            # список label: "chat_id — title"
-            ids = [r["chat_id"] for r in rows]
-            id_to_title = {r["chat_id"]: r.get("title") for r in rows}
-            options = [f'{cid} — {id_to_title.get(cid) or ""}'.strip() for cid in ids]
+        by_id = {r["chat_id"]: r for r in rows}
+        selected_id = st.selectbox(
+            "Выберите chat_id", [None] + list(by_id),
+            format_func=lambda c: "-" if c is None else f'{c} — {by_id[c]["title"] or ""}'.strip(),
+            key="dict_chat_id",
+        )
+        if selected_id is not None:
+            row = by_id[selected_id]
+            sel_country_opts = ["-"] + countries_list
+            idx = sel_country_opts.index(row["country"]) if row["country"] in countries_list else 0
+            in_country = st.selectbox(
+                "Страна",
+                sel_country_opts,
+                index=idx,
+                key="dict_edit_country",
+            )
+            in_topics = st.multiselect(
+                "Темы",
+                topics_list_all,
+                default=[t for t in row["topics"] if t in topics_list_all],
+                key="dict_edit_topics",
+            )
+            in_langs = st.multiselect(
+                "Языки",
+                languages_list,
+                default=[l for l in row["languages"] if l in languages_list],
+                key="dict_edit_langs",
+            )
 
-            sel_label = st.selectbox("Выберите chat_id", ["-"] + options, key="dict_chat_id")
-            if sel_label != "-":
-                # распарсим chat_id из "123456 — Title"
-                try:
-                    selected_id = int(sel_label.split("—", 1)[0].strip())
-                except Exception:
-                    selected_id = None
-
-                if selected_id is not None:
-                    chat = sess.get(Chat, selected_id)
-                    if chat:
-                        meta = sess.exec(select(ChatMeta).where(ChatMeta.chat_id == chat.chat_id)).first()
-                        topics = sess.exec(select(ChatTopic.topic).where(ChatTopic.chat_id == chat.chat_id)).all()
-                        langs  = sess.exec(select(ChatLanguage.language).where(ChatLanguage.chat_id == chat.chat_id)).all()
-
-                        sel_country_opts = ["-"] + countries_list
-                        idx = sel_country_opts.index(meta.country) if meta and meta.country in countries_list else 0
-                        in_country = st.selectbox(
-                            "Страна",
-                            sel_country_opts,
-                            index=idx,
-                            key="dict_edit_country",
-                        )
-                        in_topics = st.multiselect(
-                            "Темы",
-                            topics_list_all,
-                            default=[t[0] for t in topics],
-                            key="dict_edit_topics",
-                        )
-                        in_langs = st.multiselect(
-                            "Языки",
-                            languages_list,
-                            default=[l[0] for l in langs],
-                            key="dict_edit_langs",
-                        )
-
-                        if st.button("💾 Сохранить изменения", key="dict_save"):
-                            # 1) country (upsert)
-                            if not meta:
-                                meta = ChatMeta(chat_id=chat.chat_id, country=(in_country if in_country != "-" else None))
-                            else:
-                                meta.country = in_country if in_country != "-" else None
-                            sess.add(meta)
-                            sess.commit()
-
-                            # 2) topics — сначала удаляем все, затем вставляем новые
-                            sess.exec(delete(ChatTopic).where(ChatTopic.chat_id == chat.chat_id))
-                            for t in in_topics:
-                                sess.add(ChatTopic(chat_id=chat.chat_id, topic=t))
-                            sess.commit()
-
-                            # 3) languages — аналогично
-                            sess.exec(delete(ChatLanguage).where(ChatLanguage.chat_id == chat.chat_id))
-                            for l in in_langs:
-                                sess.add(ChatLanguage(chat_id=chat.chat_id, language=l))
-                            sess.commit()
-
-                            st.success("Сохранено в БД.")
-                            st.rerun()
-        else:
-            st.info("Нет чатов по заданным фильтрам или база пуста.")
+            if st.button("💾 Сохранить изменения", key="dict_save"):
+                # страна, темы и языки — только разница, одной транзакцией
+                reindex = []
+                with get_session() as sess:
+                    catalog.save(sess, selected_id, in_country if in_country != "-" else None, in_topics, in_langs)
+                    # словари полнотекстового поиска по языкам чата
+                    if st.session_state.get("fts_available"):
+                        reindex = catalog.sync_fts(sess, [selected_id])
+                    sess.commit()
+                if reindex:
+                    # сообщения чата переиндексируются пачками в фоне, не в запросе панели
+                    reindex_pool().submit(search.reindex_pending, engine)
+
+                bump_meta_version()
+                st.success("Сохранено в БД." + (" Поиск по чату переиндексируется в фоне." if reindex else ""))
+                st.rerun()
+    else:
+        st.info("Нет чатов по заданным фильтрам или база пуста.")
 
 # ------------------------------------------------------------------------------
 # 6) ОКНА/КУРСОРЫ
@@ -885,17 +1260,11 @@ with tabs[5]:
 with tabs[6]:
     st.subheader("Окна/Курсоры (техданные)")
 
-    with get_session() as sess:
-        cursors = sess.exec(select(Cursor)).all()
-        windows = sess.exec(select(Window)).all()
+    cursors, windows = tech_tables(data_version())
 
     if cursors:
         st.write("Cursor:")
-        df_c = pd.DataFrame([{
-            "chat_id": c.chat_id,
-            "oldest_id": c.oldest_fetched_id,
-            "newest_id": c.newest_fetched_id,
-        } for c in cursors])
+        df_c = pd.DataFrame(cursors, columns=["chat_id", "oldest_id", "newest_id"])
         st.dataframe(df_c, use_container_width=True)
     else:
         st.info("Cursor пусто")
@@ -904,9 +1273,7 @@ with tabs[6]:
 
     if windows:
         st.write("Window:")
-        df_w = pd.DataFrame([{
-            "id": w.id, "chat_id": w.chat_id, "min_id": w.min_id, "max_id": w.max_id
-        } for w in windows])
+        df_w = pd.DataFrame(windows, columns=["id", "chat_id", "min_id", "max_id"])
         st.dataframe(df_w, use_container_width=True)
     else:
         st.info("Window пусто")
@@ -927,33 +1294,83 @@ with tabs[7]:
         st.success(".env сохранён. Перезапустите панель или воркер, чтобы применить.")
 
 # ------------------------------------------------------------------------------
-# 8) ЭКСПОРТ (CSV)
+# 8) ЭКСПОРТ (потоково, exporter.py)
 # ------------------------------------------------------------------------------
 with tabs[8]:
-    st.subheader("Экспорт сообщений в CSV")
-
-    limit = st.number_input("Сколько строк выгрузить (последние)", min_value=10, max_value=100000, value=1000, step=10, key="export_limit")
-    if st.button("Скачать CSV", key="export_btn"):
-        with get_session() as sess:
-            q = select(Message).order_by(Message.date.desc()).limit(int(limit))
-            rows = sess.exec(q).all()
-        df = pd.DataFrame([
-            {
-                "chat_id": r.chat_id,
-                "message_id": r.message_id,
-                "user_id": r.user_id,
-                "date": r.date,
-                "text": r.text,
-            } for r in rows
-        ])
-        st.download_button(
-            label="Скачать messages.csv",
-            data=df.to_csv(index=False).encode("utf-8"),
-            file_name="messages.csv",
-            mime="text/csv",
-            key="export_download_btn",
-            help="CSV в UTF-8. Открой в Excel/Google Sheets.",
+    st.subheader("Экспорт сообщений")
+    st.caption("Файл пишется в exports/ потоково (COPY или серверный курсор) — память не зависит от объёма. "
+               "С флажком «Включая архив» в начало файла идут архивные месяцы из Parquet (storage.archive.path).")
+
+    browser_query = st.session_state.get("browser_query")
+    ex1, ex2, ex3 = st.columns([2, 1, 1])
+    with ex1:
+        ex_source = st.radio(
+            "Что выгрузить",
+            ["по фильтрам «Просмотра БД»", "все сообщения за период"],
+            key="export_source",
+            help="Фильтры — последние применённые во вкладке «Просмотр БД» (чат, тип, автор, даты, текст).",
         )
+    with ex2:
+        ex_format = st.selectbox("Формат", list(exporter.FORMATS), key="export_format")
+    with ex3:
+        ex_gzip = st.checkbox("gzip", value=True, key="export_gzip")
+        ex_archive = st.checkbox(
+            "Включая архив", value=archive_on if browser_query is None else bool(browser_query.get("with_archive")),
+            disabled=not archive_on, key="export_with_archive",
+        )
+
+    if ex_source == "все сообщения за период":
+        ed1, ed2 = st.columns(2)
+        with ed1:
+            ex_from = st.date_input("С даты", value=None, key="export_date_from")
+        with ed2:
+            ex_to = st.date_input("По дату", value=None, key="export_date_to")
+        ex_filters = {
+            "since": day_start(ex_from) if ex_from else None,
+            "until": day_start(ex_to + timedelta(days=1)) if ex_to else None,
+        }
+    elif browser_query:
+        ex_filters = browser_query
+        st.caption("Фильтры: " + ", ".join(f"{k}={v}" for k, v in browser_query.items() if v not in (None, "", "любой")))
+    else:
+        ex_filters = None
+        st.info("Сначала примените фильтры во вкладке «Просмотр БД».")
+
+    st.session_state.setdefault("export_jobs", [])
+    if st.button("Начать выгрузку", disabled=ex_filters is None, key="export_btn"):
+        prog = {"rows": 0, "bytes": 0}
+
+        def run_export(f=dict(ex_filters, with_archive=ex_archive and archive_on), fmt=ex_format, gz=ex_gzip, prog=prog):
+            return exporter.export(f, fmt, gz, progress=lambda rows, size: prog.update(rows=rows, bytes=size))
+
+        jobs = st.session_state["export_jobs"]
+        jobs.append((export_pool().submit(run_export), prog))
+        # в сессии — только последние EXPORT_JOBS_KEEP завершённых (идущие не выбрасываются)
+        done = [j for j in jobs if j[0].done()]
+        for j in done[:max(0, len(done) - EXPORT_JOBS_KEEP)]:
+            jobs.remove(j)
+
+    for job, prog in reversed(st.session_state["export_jobs"]):
+        if not job.done():
+            rows = "" if prog["rows"] is None else f"{prog['rows']:,} строк, ".replace(",", " ")
+            st.info(f"Выгрузка идёт: {rows}{prog['bytes'] / 1048576:.1f} МБ (обновите страницу)")
+        elif job.exception() is not None:
+            st.error(f"Выгрузка не удалась: {job.exception()}")
+        else:
+            res = job.result()
+            size_mb = res["bytes"] / 1048576
+            st.success(f"{res['path']}: {res['rows']:,} строк, {size_mb:.1f} МБ, {res['seconds']} с".replace(",", " "))
+            if size_mb <= EXPORT_DOWNLOAD_MAX_MB and os.path.exists(res["path"]):
+                with open(res["path"], "rb") as f:
+                    st.download_button(
+                        label=f"Скачать {Path(res['path']).name}",
+                        data=f,
+                        file_name=Path(res["path"]).name,
+                        key=f"export_download_{res['path']}",
+                    )
+
+    if st.session_state["export_jobs"] and st.button("🔄 Обновить статус", key="export_refresh"):
+        st.rerun()
 
 
 # ------------------------------------------------------------------------------
@@ -997,3 +1414,79 @@ with tabs[9]:
         )
         st.success("Справочники сохранены.")
         st.rerun()
+
+# ------------------------------------------------------------------------------
+# 10) АНАЛИТИКА (по агрегатам rollup.py)
+# ------------------------------------------------------------------------------
+with tabs[10]:
+    st.subheader("Аналитика активности")
+    st.caption("Считается по activityrollup/posterrollup (rollup.py), без прохода по сообщениям.")
+
+    an_version = data_version()
+    an_chats = chat_list(an_version)
+    an_titles = {c.chat_id: c.title for c in an_chats}
+
+    today = datetime.now(BUCHAREST_TZ).date()
+    ac1, ac2, ac3, ac4 = st.columns([2, 1, 1, 1])
+    with ac1:
+        period = st.date_input("Период", value=(today - timedelta(days=89), today), key="an_period")
+    with ac2:
+        an_kind = st.selectbox("Тип", ["любой", "канал", "группа", "личка"], key="an_kind")
+    with ac3:
+        window = st.number_input("Скользящее среднее, дней", min_value=1, max_value=60, value=7, key="an_window")
+    with ac4:
+        recent_days = st.number_input("Рост: окно, дней", min_value=1, max_value=180, value=30, key="an_recent")
+    an_selected = st.multiselect(
+        "Чаты (пусто — все)", [c.chat_id for c in an_chats],
+        format_func=lambda c: f"{an_titles.get(c) or c} (id={c})", key="an_chats",
+    )
+
+    if not isinstance(period, (list, tuple)) or len(period) != 2:
+        st.info("Выберите начало и конец периода.")
+    else:
+        since, until = period
+        if an_selected:
+            an_ids = tuple(sorted(an_selected))
+        elif an_kind != "любой":
+            an_ids = tuple(sorted(
+                c.chat_id for c in an_chats
+                if (an_kind == "канал" and c.is_channel) or (an_kind == "группа" and c.is_group)
+                or (an_kind == "личка" and not c.is_channel and not c.is_group)
+            ))
+        else:
+            an_ids = None
+        try:
+            res = analytics_bundle(an_ids, since, until, int(window), int(recent_days), an_titles, an_version)
+        except Exception as e:
+            res = None
+            st.warning(f"Агрегаты недоступны — выполните python migrations.py upgrade ({e})")
+
+        if res is not None:
+            n_days = max(1, (until - since).days + 1)
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Сообщений", f"{res['messages']:,}".replace(",", " "))
+            m2.metric("В среднем за день", f"{res['messages'] / n_days:,.0f}".replace(",", " "))
+            m3.metric("Активных чатов", res["active_chats"])
+            m4.metric("Доля ботов", f"{res['bots'] / max(1, res['messages']):.1%}")
+
+            st.markdown("**Активность по дням**")
+            st.line_chart(res["curve"][["сообщений", "среднее"]])
+
+            st.markdown("**Час недели** (сообщений в среднем, местное время)")
+            heat = res["heat"].reset_index(names="день").melt("день", var_name="час", value_name="сообщений")
+            st.altair_chart(
+                alt.Chart(heat).mark_rect().encode(
+                    x=alt.X("час:O"), y=alt.Y("день:N", sort=analytics.WEEKDAYS),
+                    color=alt.Color("сообщений:Q", scale=alt.Scale(scheme="blues")),
+                    tooltip=["день", "час", alt.Tooltip("сообщений:Q", format=".1f")],
+                ),
+                use_container_width=True,
+            )
+
+            col_l, col_r = st.columns(2)
+            with col_l:
+                st.markdown("**Чаты**")
+                st.dataframe(res["chats"], use_container_width=True)
+            with col_r:
+                st.markdown("**Самые активные авторы**")
+                st.dataframe(res["posters"], use_container_width=True)
@@ -1,7 +1,11 @@
-import os, yaml, time, signal, subprocess
+import os, json, yaml, time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import streamlit as st
-from sqlmodel import Session, create_engine, select
-from db import Account, User, Chat, Message, Cursor, Window, AccountChat, ChatBot, DirectPeer, get_session
+from sqlmodel import Session, select
+from db import Account, User, DirectPeer, engine
+import catalog
+import search
 
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
 if ADMIN_TOKEN:
@@ -19,9 +23,28 @@ def load_cfg():
         return yaml.safe_load(f)
 
 cfg = load_cfg()
-DB_PATH = cfg["storage"]["db_path"]
-DB_URL = os.getenv("DATABASE_URL", "").strip() or None
-engine = create_engine(DB_URL if DB_URL else f"sqlite:///{DB_PATH}")
+
+def load_list(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = yaml.safe_load(f) or []
+    except FileNotFoundError:
+        return []
+    return data if isinstance(data, list) else []
+
+def csv_list(value):
+    return [x.strip() for x in str(value or "").split(",") if x.strip()]
+
+def kind_label(ch):
+    return "канал" if ch["is_channel"] else ("группа" if ch["is_group"] else (ch["type"] or "личка"))
+
+@st.cache_resource
+def reindex_pool() -> ThreadPoolExecutor:
+    """Фоновая переиндексация поиска после смены языков чатов (search.reindex_pending)."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="reindex")
+
+KINDS = ["любой", "канал", "группа", "личка"]
+EDITABLE = ["страна", "темы", "языки"]
 
 st.set_page_config(page_title="TG Analyzer — Расширенная панель", layout="wide")
 st.title("TG Analyzer — Аккаунты и Справочник")
@@ -56,16 +79,16 @@ with tabs[0]:
         st.markdown("---")
         st.markdown("### Чаты аккаунта")
         with Session(engine) as s:
-            rows = s.exec(select(AccountChat, Chat).where(AccountChat.account_id==sel_id).join(Chat, Chat.chat_id==AccountChat.chat_id)).all()
+            rows = catalog.chats(s, account_id=sel_id)
         st.dataframe([{
-            "chat_id": ch.chat_id,
-            "title": ch.title,
-            "type": ch.type,
-            "вид": "канал" if ch.is_channel else ("группа" if ch.is_group else ch.type),
-            "country": ch.country,
-            "topics": ch.topics,
-            "languages": ch.languages
-        } for ac, ch in rows], use_container_width=True)
+            "chat_id": ch["chat_id"],
+            "title": ch["title"],
+            "type": ch["type"],
+            "вид": kind_label(ch),
+            "country": ch["country"],
+            "topics": ", ".join(ch["topics"]),
+            "languages": ", ".join(ch["languages"])
+        } for ch in rows], use_container_width=True)
         st.markdown("### Личные переписки (Direct)")
         with Session(engine) as s:
             dms = s.exec(select(DirectPeer, User).where(DirectPeer.account_id==sel_id).join(User, User.user_id==DirectPeer.user_id)).all()
@@ -73,23 +96,76 @@ with tabs[0]:
 
 with tabs[1]:
     st.subheader("Справочник каналов/групп")
+    # страница целиком — три запроса (count, чаты с метаданными, боты), правки — одной транзакцией
+    countries = load_list("countries.yaml")
+    languages = load_list("languages.yaml")
+    f1, f2, f3, f4, f5 = st.columns([2, 1, 1, 1, 1])
+    q = f1.text_input("Название содержит", key="cat_q")
+    kind = f2.selectbox("Вид", KINDS, key="cat_kind")
+    country = f3.selectbox("Страна", ["любая"] + countries, key="cat_country")
+    language = f4.selectbox("Язык", ["любой"] + languages, key="cat_language")
+    size = f5.selectbox("На странице", [50, 100, 200, 500], index=1, key="cat_size")
+    filters = {
+        "kind": kind,
+        "country": None if country == "любая" else country,
+        "language": None if language == "любой" else language,
+        "q": q.strip() or None,
+    }
+    with Session(engine) as s:
+        total = catalog.count(s, **filters)
+    pages = max(1, -(-total // size))
+    page = st.number_input(f"Страница из {pages} (чатов: {total})", min_value=1, max_value=pages, value=1, key="cat_page")
     with Session(engine) as s:
-        chats = s.exec(select(Chat)).all()
-    for ch in chats[:500]:
-        with st.expander(f"{ch.title or ch.chat_id} — {('канал' if ch.is_channel else ('группа' if ch.is_group else ch.type))}"):
-            st.write(f"chat_id: `{ch.chat_id}`  | type: `{ch.type}`")
-            cval = st.text_input(f"Страна для {ch.chat_id}", value=ch.country or "", key=f"country_{ch.chat_id}")
-            tval = st.text_input(f"Темы (CSV) для {ch.chat_id}", value=ch.topics or "", key=f"topics_{ch.chat_id}")
-            lval = st.text_input(f"Языки (CSV) для {ch.chat_id}", value=ch.languages or "", key=f"lang_{ch.chat_id}")
+        chats = catalog.chats(s, limit=size, offset=(int(page) - 1) * size, **filters)
+        bots = catalog.bots(s, [ch["chat_id"] for ch in chats])
+
+    df = pd.DataFrame([{
+        "chat_id": ch["chat_id"],
+        "title": ch["title"],
+        "вид": kind_label(ch),
+        "страна": ch["country"] or "",
+        "темы": ", ".join(ch["topics"]),
+        "языки": ", ".join(ch["languages"]),
+        "боты": ", ".join(bots.get(ch["chat_id"], [])),
+    } for ch in chats], columns=["chat_id", "title", "вид", "страна", "темы", "языки", "боты"])
+    # своё состояние редактора на каждую страницу и набор фильтров — правки не «переезжают» на другие строки
+    editor_key = "cat_editor_" + json.dumps([filters, int(page), size], sort_keys=True, ensure_ascii=False)
+    edited = st.data_editor(
+        df,
+        key=editor_key,
+        hide_index=True,
+        use_container_width=True,
+        disabled=["chat_id", "title", "вид", "боты"],
+        column_config={
+            "страна": (st.column_config.SelectboxColumn("страна", options=[""] + countries) if countries
+                       else st.column_config.TextColumn("страна")),
+            "темы": st.column_config.TextColumn("темы", help="Через запятую"),
+            "языки": st.column_config.TextColumn("языки", help="Через запятую"),
+        },
+    )
+
+    if st.button("💾 Сохранить изменения", key="cat_save"):
+        new = edited[EDITABLE].fillna("").astype(str)
+        diff = edited[(new != df[EDITABLE]).any(axis=1)]
+        if diff.empty:
+            st.info("Изменений нет")
+        else:
+            rows = [{
+                "chat_id": int(r["chat_id"]),
+                "country": str(r["страна"] or "").strip() or None,
+                "topics": csv_list(r["темы"]),
+                "languages": csv_list(r["языки"]),
+            } for _, r in diff.iterrows()]
             with Session(engine) as s:
-                bots = s.exec(select(ChatBot, User).where(ChatBot.chat_id==ch.chat_id).join(User, User.user_id==ChatBot.bot_user_id)).all()
-            if bots:
-                st.write("Боты в чате:", [{"user_id": u.user_id, "username": u.username} for cb, u in bots])
-            if st.button(f"💾 Сохранить {ch.chat_id}"):
-                with Session(engine) as s:
-                    chx = s.get(Chat, ch.chat_id)
-                    chx.country = cval.strip() or None
-                    chx.topics = tval.strip() or None
-                    chx.languages = lval.strip() or None
-                    s.add(chx); s.commit()
-                st.success("Сохранено")
+                changed_langs = catalog.save_many(s, rows)
+                reindex = catalog.sync_fts(s, sorted(changed_langs))
+                s.commit()
+            if reindex:
+                # сообщения чатов переиндексируются пачками в фоне, не в запросе панели
+                reindex_pool().submit(search.reindex_pending, engine)
+            # основная панель сбросит кэш чтений (см. data_version в dashboard_app.py)
+            os.makedirs("runtime", exist_ok=True)
+            with open(os.path.join("runtime", "meta_version"), "w") as f:
+                f.write(str(time.time_ns()))
+            st.success(f"Сохранено чатов: {len(rows)}"
+                       + (f". Поиск переиндексируется в фоне: {len(reindex)}" if reindex else ""))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# dataset.py — инкрементальная выгрузка сообщений в Parquet-датасет для аналитиков
+#
+# Раскладка: <path>/chat_id=<id>/month=<YYYY-MM>/part-<run>-<n>.parquet (hive-партиции,
+# месяц по Бухаресту), схема — schema(), сжатие — storage.dataset.compression.
+# chat_id и month хранятся только в путях: читать с partitioning() (chat_id — int64).
+# Для каждого чата _manifest.json хранит водяные знаки: min и max выгруженного message_id.
+# Запуск читает из БД только строки за ними (новые сообщения и догруженную воркером
+# историю) по индексу (chat_id, message_id): новые строки текущего месяца сливаются
+# с его файлами в один, прошлым месяцам дописывается part-файл — остальное не трогается.
+# Датасет только дописывается: правки и удаления в БД после выгрузки в него не попадают.
+#
+# Порядок: новые файлы -> manifest (строки чата атомарно) -> удаление заменённых файлов.
+# Файлы, которых нет в manifest, — остатки прерванного запуска; удаляются при старте.
+#
+#   python dataset.py run
+#   python dataset.py list
+#   python dataset.py run --full      # с нуля (старый датасет удаляется)
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import or_
+from sqlmodel import select
+
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+DEFAULTS = {"path": "exports/dataset", "compression": "zstd"}
+COMPRESSIONS = ("zstd", "snappy", "gzip", "none")
+MANIFEST_VERSION = 1
+BATCH = 10_000
+FLUSH_ROWS = 200_000  # строк в памяти на чат, после — запись part-файлов
+
+
+def settings(cfg: dict) -> dict:
+    """storage.dataset из config.yaml с значениями по умолчанию."""
+    return {**DEFAULTS, **((cfg.get("storage") or {}).get("dataset") or {})}
+
+
+def schema():
+    """Столбцы part-файла (без столбцов партиций)."""
+    import pyarrow as pa
+    return pa.schema([
+        ("message_id", pa.int64()), ("account_id", pa.int64()),
+        ("user_id", pa.int64()), ("date", pa.timestamp("us", tz="UTC")),
+        ("text", pa.string()), ("text_hash", pa.string()),
+    ])
+
+
+def partitioning():
+    """Hive-партиции датасета для pyarrow.dataset: ds.dataset(path, partitioning=partitioning())."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("chat_id", pa.int64()), ("month", pa.string())]), flavor="hive")
+
+
+# ------------------------------------------------------------------------------
+# Manifest
+# ------------------------------------------------------------------------------
+def manifest_path(root) -> Path:
+    return Path(root) / "_manifest.json"  # «_» — pyarrow.dataset и DuckDB его пропускают
+
+
+def load_manifest(root) -> dict:
+    try:
+        m = json.loads(manifest_path(root).read_text(encoding="utf-8"))
+        if m.get("version") == MANIFEST_VERSION:
+            return m
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "chats": {}, "files": {}}
+
+
+def save_manifest(root, manifest: dict, compression: str) -> None:
+    manifest["schema"] = [{"name": f.name, "type": str(f.type)} for f in schema()]
+    manifest["partitioning"] = [{"name": "chat_id", "type": "int64"}, {"name": "month", "type": "string"}]
+    manifest["compression"] = compression
+    manifest["updated_at"] = datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds")
+    p = manifest_path(root)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    tmp.replace(p)
+
+
+def remove_orphans(root, manifest: dict) -> int:
+    """Удаляет part-файлы, не попавшие в manifest (запуск прервался до его записи)."""
+    listed = set(manifest["files"])
+    n = 0
+    for p in Path(root).glob("chat_id=*/month=*/*.parquet"):
+        if p.relative_to(root).as_posix() not in listed:
+            p.unlink()
+            n += 1
+    return n
+
+
+# ------------------------------------------------------------------------------
+# Запись
+# ------------------------------------------------------------------------------
+def _month(d: datetime) -> str:
+    return d.astimezone(BUCHAREST_TZ).strftime("%Y-%m")
+
+
+def _write(root, rel: str, chat_id: int, rows: list[dict], compression: str) -> dict:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows.sort(key=lambda r: r["message_id"])
+    path = Path(root) / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(pa.Table.from_pylist(rows, schema=schema()), tmp,
+                   compression=None if compression == "none" else compression, row_group_size=100_000)
+    os.replace(tmp, path)
+    dates = [r["date"] for r in rows if r["date"] is not None]
+    return {
+        "chat_id": chat_id,
+        "rows": len(rows),
+        "min_message_id": rows[0]["message_id"],
+        "max_message_id": rows[-1]["message_id"],
+        "min_date": min(dates).isoformat() if dates else None,
+        "max_date": max(dates).isoformat() if dates else None,
+        "bytes": path.stat().st_size,
+        "written_at": datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds"),
+    }
+
+
+class _ChatWriter:
+    """Новые строки одного чата -> part-файлы по месяцам. Текущий месяц переписывается
+    одним файлом вместе с уже выгруженными строками, прошлым — дописывается part."""
+
+    def __init__(self, root, manifest: dict, chat_id: int, run: str, compression: str):
+        self.root, self.manifest, self.chat_id = Path(root), manifest, chat_id
+        self.run, self.compression = run, compression
+        self.current = datetime.now(BUCHAREST_TZ).strftime("%Y-%m")
+        self.buf: dict[str, list] = {}
+        self.buffered = 0
+        self.written: dict[str, dict] = {}  # новые файлы: rel -> запись manifest
+        self.replaced: list[str] = []       # файлы текущего месяца, слитые в новый
+        self.n = 0
+
+    def add(self, row: dict) -> None:
+        self.buf.setdefault(_month(row["date"]) if row["date"] else "unknown", []).append(row)
+        self.buffered += 1
+        if self.buffered >= FLUSH_ROWS:
+            self.flush()
+
+    def _rel(self, month: str) -> str:
+        while True:  # имя не должно совпасть с файлом, который этот же запуск заменяет
+            self.n += 1
+            rel = f"chat_id={self.chat_id}/month={month}/part-{self.run}-{self.n:04d}.parquet"
+            if rel not in self.manifest["files"] and not (self.root / rel).exists():
+                return rel
+
+    def flush(self) -> None:
+        import pyarrow.parquet as pq
+
+        for month, rows in self.buf.items():
+            if month == self.current:
+                # уже выгруженные файлы месяца (и записанные в этом запуске) сливаются с новыми строками
+                old = [rel for rel, f in {**self.manifest["files"], **self.written}.items()
+                       if f["chat_id"] == self.chat_id and f["month"] == month and rel not in self.replaced]
+                for rel in old:
+                    rows = pq.ParquetFile(self.root / rel).read().to_pylist() + rows
+                    if rel in self.written:
+                        del self.written[rel]
+                        (self.root / rel).unlink()
+                    else:
+                        self.replaced.append(rel)
+            rel = self._rel(month)
+            self.written[rel] = {**_write(self.root, rel, self.chat_id, rows, self.compression), "month": month}
+        self.buf, self.buffered = {}, 0
+
+    def commit(self) -> None:
+        """Файлы и водяные знаки чата — в manifest одной записью, затем удаление заменённых."""
+        self.flush()
+        if not self.written:
+            return
+        files = self.manifest["files"]
+        for rel in self.replaced:
+            files.pop(rel, None)
+        files.update(self.written)
+        ids = [(f["min_message_id"], f["max_message_id"]) for f in self.written.values()]
+        prev = self.manifest["chats"].get(str(self.chat_id), {})
+        self.manifest["chats"][str(self.chat_id)] = {
+            "min_message_id": min([lo for lo, _ in ids] + ([prev["min_message_id"]] if prev else [])),
+            "max_message_id": max([hi for _, hi in ids] + ([prev["max_message_id"]] if prev else [])),
+            "rows": sum(f["rows"] for f in files.values() if f["chat_id"] == self.chat_id),
+            "exported_at": datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds"),
+        }
+        save_manifest(self.root, self.manifest, self.compression)
+        for rel in self.replaced:
+            (self.root / rel).unlink(missing_ok=True)
+
+
+def export_chat(sess, root, manifest: dict, chat_id: int, run: str, compression: str) -> int:
+    """Строки чата за водяными знаками -> датасет. Возвращает число новых строк."""
+    from db import Message, MessageText
+    import textstore
+
+    wm = manifest["chats"].get(str(chat_id))
+    cond = [Message.chat_id == chat_id]
+    if wm:
+        cond.append(or_(Message.message_id > wm["max_message_id"], Message.message_id < wm["min_message_id"]))
+    stmt = (
+        select(Message.message_id, Message.account_id, Message.user_id, Message.date,
+               textstore.full_text().label("text"), Message.text_hash)
+        .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)
+        .where(*cond)
+        .order_by(Message.message_id)
+    )
+    writer = _ChatWriter(root, manifest, chat_id, run, compression)
+    n = 0
+    result = sess.connection().execution_options(stream_results=True, yield_per=BATCH).execute(stmt)
+    for part in result.partitions():
+        for r in part:
+            row = dict(r._mapping)
+            d = row["date"]
+            if d is not None:  # SQLite отдаёт UTC без зоны
+                row["date"] = d.replace(tzinfo=timezone.utc) if d.tzinfo is None else d.astimezone(timezone.utc)
+            writer.add(row)
+        n += len(part)
+    writer.commit()
+    return n
+
+
+def run(engine, root, compression: str = "zstd", full: bool = False) -> int:
+    from db import Chat, get_session
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression: {', '.join(COMPRESSIONS)}")
+    if full and Path(root).exists():
+        shutil.rmtree(root)
+    manifest = load_manifest(root)
+    orphans = remove_orphans(root, manifest)
+    if orphans:
+        print(f"dataset: удалено незавершённых файлов {orphans}")
+
+    run_id = datetime.now(BUCHAREST_TZ).strftime("%Y%m%d%H%M%S")
+    total = 0
+    with get_session() as sess:
+        # по чату — два диапазона uq_message_chat_msg за водяными знаками; без новых строк — пустой ответ
+        for chat_id in sess.exec(select(Chat.chat_id).order_by(Chat.chat_id)).all():
+            n = export_chat(sess, root, manifest, chat_id, run_id, compression)
+            if n:
+                print(f"dataset: chat {chat_id}: +{n}")
+            total += n
+    if not manifest_path(root).exists():
+        save_manifest(root, manifest, compression)
+    return total
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Инкрементальный Parquet-датасет сообщений")
+    ap.add_argument("command", choices=["run", "list"])
+    ap.add_argument("--full", action="store_true", help="выгрузить заново с нуля")
+    args = ap.parse_args(argv)
+
+    s = settings(read_config())
+    if args.command == "list":
+        m = load_manifest(s["path"])
+        for chat_id, c in sorted(m["chats"].items(), key=lambda kv: int(kv[0])):
+            print(f"chat {chat_id}: {c['rows']} строк, message_id {c['min_message_id']}..{c['max_message_id']}, {c['exported_at']}")
+        print(f"файлов: {len(m['files'])}, байт: {sum(f['bytes'] for f in m['files'].values())}")
+        return 0
+
+    from db import engine
+    print(f"dataset: новых строк {run(engine, s['path'], s['compression'], args.full)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# dialogs.py — снимок диалогов аккаунта из Telegram в таблице dialog (вкладка «Диалоги»)
+#
+# Telegram отдаёт диалоги от свежих к старым (закреплённые — первыми). Водяной знак сессии —
+# max(last_message_at) в dialog: обновление читает диалоги, пока не дойдёт до уже известного
+# последнего сообщения, и пишет их одним upsert. Старые диалоги без новых сообщений не
+# перечитываются; полное обновление (full) проходит до limit диалогов.
+# dialog_id — marked id диалога (как telethon.utils.get_peer_id): голые id пользователя
+# и канала могут совпасть, а (session_name, dialog_id) — первичный ключ.
+# Панель читает только таблицу: поиск по названию/username, тип, страницы LIMIT/OFFSET
+# по ix_dialog_session_last.
+#
+#   python dialogs.py refresh
+#   python dialogs.py refresh --full --limit 2000
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import func, or_
+from sqlmodel import select
+
+from db import Dialog
+import storage
+
+SESSIONS_DIR = Path("sessions")
+KINDS = ("канал", "группа", "личка", "другое")
+FULL_LIMIT = 2000
+
+
+def kind_of(ent) -> str:
+    from telethon.tl.types import Channel, Chat as TLChat, User as TLUser
+
+    if isinstance(ent, Channel):
+        return "группа" if getattr(ent, "megagroup", False) else "канал"
+    if isinstance(ent, TLChat):
+        return "группа"
+    if isinstance(ent, TLUser):
+        return "личка"
+    return "другое"
+
+
+def watermark(sess, session_name: str):
+    """Дата последнего сообщения среди сохранённых диалогов сессии (None — снимка ещё нет)."""
+    return sess.exec(select(func.max(Dialog.last_message_at)).where(Dialog.session_name == session_name)).one()
+
+
+async def _fetch(session_name: str, api_id: int, api_hash: str, since, limit: int) -> list[dict]:
+    from telethon import TelegramClient
+
+    now = datetime.now(timezone.utc)
+    rows = []
+    async with TelegramClient(str(SESSIONS_DIR / session_name), api_id, api_hash) as client:
+        async for dlg in client.iter_dialogs(limit=limit):
+            # закреплённые идут вне порядка дат — по ним не останавливаемся
+            if since is not None and not dlg.pinned and dlg.date is not None and dlg.date <= since:
+                break
+            ent = dlg.entity
+            username = getattr(ent, "username", None)
+            rows.append({
+                "session_name": session_name,
+                "dialog_id": dlg.id,  # marked id (utils.get_peer_id): у пользователя и канала не совпадают
+                "title": getattr(ent, "title", None) or username or str(ent.id),
+                "username": username,
+                "kind": kind_of(ent),
+                "last_message_at": dlg.date,
+                "updated_at": now,
+            })
+    return rows
+
+
+def refresh(session_name: str, api_id: int, api_hash: str, full: bool = False, limit: int = FULL_LIMIT) -> int:
+    """Подтягивает из Telegram диалоги новее водяного знака (full — все, до limit) в dialog.
+    Возвращает число записанных диалогов."""
+    from db import get_session
+
+    with get_session() as sess:
+        since = None if full else watermark(sess, session_name)
+    rows = asyncio.run(_fetch(session_name, api_id, api_hash, since, limit))
+    with get_session() as sess:
+        storage.upsert(sess, Dialog.__table__, rows, ["session_name", "dialog_id"],
+                       ["title", "username", "kind", "last_message_at", "updated_at"])
+        sess.commit()
+    return len(rows)
+
+
+# ------------------------------------------------------------------------------
+# Чтение
+# ------------------------------------------------------------------------------
+def _filtered(stmt, session_name: str, q: str = None, kind: str = None):
+    stmt = stmt.where(Dialog.session_name == session_name)
+    if q:
+        stmt = stmt.where(or_(Dialog.title.ilike(f"%{q}%"), Dialog.username.ilike(f"%{q.lstrip('@')}%")))
+    if kind:
+        stmt = stmt.where(Dialog.kind == kind)
+    return stmt
+
+
+def count(sess, session_name: str, **filters) -> int:
+    return sess.exec(_filtered(select(func.count()).select_from(Dialog), session_name, **filters)).one()
+
+
+def page(sess, session_name: str, limit: int = 100, offset: int = 0, **filters) -> list[dict]:
+    """Диалоги сессии от свежих к старым. Фильтры: q (название или username), kind."""
+    stmt = _filtered(
+        select(Dialog.dialog_id, Dialog.title, Dialog.username, Dialog.kind, Dialog.last_message_at, Dialog.updated_at),
+        session_name, **filters,
+    ).order_by(
+        Dialog.last_message_at.desc().nulls_last(), Dialog.dialog_id
+    ).limit(limit).offset(offset)
+    return [dict(r._mapping) for r in sess.exec(stmt).all()]
+
+
+def config_entry(d: dict):
+    """Строка для chats в config.yaml: @username, иначе marked id (-100… для каналов) —
+    client.get_entity понимает его без username."""
+    return f"@{d['username']}" if d.get("username") else d["dialog_id"]
+
+
+def main(argv=None) -> int:
+    from dotenv import load_dotenv
+
+    ap = argparse.ArgumentParser(description="Снимок диалогов аккаунта в таблице dialog")
+    ap.add_argument("command", choices=["refresh"])
+    ap.add_argument("--session", default=None, help="по умолчанию SESSION_NAME из .env")
+    ap.add_argument("--full", action="store_true", help="перечитать все диалоги (до --limit)")
+    ap.add_argument("--limit", type=int, default=FULL_LIMIT)
+    args = ap.parse_args(argv)
+
+    load_dotenv(".env")
+    session_name = args.session or os.getenv("SESSION_NAME", "research_account")
+    n = refresh(session_name, int(os.getenv("API_ID", "0") or 0), os.getenv("API_HASH", ""), args.full, args.limit)
+    print(f"dialogs: {session_name}: записано {n}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
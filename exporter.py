@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# exporter.py — потоковая выгрузка сообщений по фильтрам «Просмотра БД»
+#
+# Фильтры те же, что у browse.conditions (чат, тип, автор, даты, текст). Строки не
+# собираются в памяти: CSV из Postgres пишет сам сервер через COPY (… ) TO STDOUT,
+# остальное (JSONL, SQLite) читается серверным курсором пачками по BATCH и сразу
+# пишется в файл. Файл создаётся как *.part и переименовывается, когда выгрузка готова;
+# gzip — на лету. Память не зависит от числа строк.
+# with_archive: сначала строки холодного архива (archive.cold_iter, Parquet через DuckDB —
+# он старше всего, что в БД), затем БД; файл целиком в порядке ключа. COPY тогда не используется,
+# чтобы даты в обеих частях были в одном формате.
+#
+#   python exporter.py --chat 1864457857 --since 2025-01-01 --format jsonl --gzip
+#   python exporter.py --q "выборы" --until 2025-06-01
+#   python exporter.py --chat 1864457857 --with-archive
+
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from sqlmodel import select
+
+import archive
+import browse
+import search
+import storage
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+FORMATS = ("csv", "jsonl")
+COLUMNS = ["chat_id", "chat_title", "message_id", "user_id", "date", "text"]
+BATCH = 5_000
+PROGRESS_BYTES = 4 * 1024 * 1024
+OUT_DIR = "exports"
+
+
+def statement(sess, f: dict):
+    """SELECT выгрузки по фильтрам f (как у browse.conditions), в порядке ключа browse.KEY."""
+    tsq = None
+    if f.get("q") and f.get("text_mode") == "fts":
+        tsq = search.build_tsquery(f["q"], search.configs_in_use(sess, f.get("chat_id")))
+    stmt = browse.messages(browse.conditions(f, tsq))
+    cols = {c.name: c for c in stmt.selected_columns}
+    return stmt.with_only_columns(*[cols[c] for c in COLUMNS]).order_by(*browse.KEY)
+
+
+class _Sink:
+    """Бинарный поток в файл (опционально gzip) со счётчиком байт для прогресса."""
+
+    def __init__(self, path: Path, gz: bool, progress=None):
+        self.raw = open(path, "wb")
+        self.out = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6) if gz else self.raw
+        self.progress = progress
+        self.bytes = 0
+        self.rows = 0
+        self._reported = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.out.write(data)
+        self.bytes += len(data)
+        if self.progress and self.bytes - self._reported >= PROGRESS_BYTES:
+            self._reported = self.bytes
+            self.progress(self.rows, self.bytes)
+        return len(data)
+
+    def close(self) -> None:
+        if self.out is not self.raw:
+            self.out.close()
+        self.raw.close()
+
+
+def _fmt_date(d):
+    return d.astimezone(BUCHAREST_TZ).isoformat() if d else None
+
+
+def _copy_csv(sess, stmt, sink: _Sink) -> None:
+    """CSV силами Postgres: COPY (SELECT …) TO STDOUT, параметры подставляет psycopg2."""
+    conn = sess.connection()
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    raw = conn.connection.driver_connection
+    with raw.cursor() as cur:
+        cur.execute("SET LOCAL TimeZone = 'Europe/Bucharest'")
+        sql = cur.mogrify(str(compiled), compiled.params).decode()
+        cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')", sink)
+        sink.rows = max(cur.rowcount, 0)
+
+
+def cold_batches(sess, f: dict):
+    """Пачки строк архива по тем же фильтрам (тип чата — через таблицу chat, название — оттуда же)."""
+    from db import Chat
+
+    chats = sess.exec(select(Chat.chat_id, Chat.title, Chat.is_channel, Chat.is_group)).all()
+    kind = f.get("kind", "любой")
+    if f.get("chat_id"):
+        chat_ids = [f["chat_id"]]
+    elif kind == "любой":
+        chat_ids = None
+    else:
+        chat_ids = [c.chat_id for c in chats
+                    if (kind == "канал" and c.is_channel) or (kind == "группа" and c.is_group)
+                    or (kind == "личка" and not c.is_channel and not c.is_group)]
+    titles = {c.chat_id: c.title for c in chats}
+    root = archive.settings(read_config())["path"]
+    for part in archive.cold_iter(root, chat_ids=chat_ids, user_id=f.get("user_id"), since=f.get("since"),
+                                  until=f.get("until"), q=f.get("q") or None,
+                                  words=f.get("text_mode") in ("fts", "fuzzy"), batch=BATCH):
+        yield [dict(r, chat_title=titles.get(r["chat_id"])) for r in part]
+
+
+def _stream(sess, stmt, fmt: str, sink: _Sink, cold=()) -> None:
+    """Серверный курсор: пачки по BATCH, каждая сразу уходит в файл. cold — пачки архива,
+    пишутся перед строками БД."""
+    result = sess.connection().execution_options(stream_results=True, yield_per=BATCH).execute(stmt)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    if fmt == "csv":
+        writer.writerow(COLUMNS)
+    hot = ([dict(r._mapping) for r in part] for part in result.partitions())
+    for part in itertools.chain(cold, hot):
+        for row in part:
+            row["date"] = _fmt_date(row["date"])
+            if fmt == "csv":
+                writer.writerow([row[c] for c in COLUMNS])
+            else:
+                buf.write(json.dumps({c: row[c] for c in COLUMNS}, ensure_ascii=False))
+                buf.write("\n")
+        sink.rows += len(part)
+        sink.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+
+
+def export(f: dict, fmt: str = "csv", gz: bool = False, out_dir: str = OUT_DIR, name: str = None,
+           progress=None) -> dict:
+    """Выгружает сообщения по фильтрам f в out_dir (f["with_archive"] — вместе с холодным архивом).
+    progress(rows, bytes) вызывается по ходу (rows = None, пока строки считает сервер — COPY).
+    Возвращает path, rows, bytes, seconds."""
+    from db import get_session
+
+    if fmt not in FORMATS:
+        raise ValueError(f"формат: {', '.join(FORMATS)}")
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    # секунд мало: две небольшие выгрузки подряд укладываются в одну и перезаписали бы друг друга
+    name = name or f"messages-{datetime.now(BUCHAREST_TZ):%Y%m%d-%H%M%S}-{time.time_ns() % 10**9:09d}"
+    path = out / f"{name}.{fmt}{'.gz' if gz else ''}"
+    tmp = path.with_name(path.name + ".part")
+
+    started = time.monotonic()
+    with get_session() as sess:
+        stmt = statement(sess, f)
+        with_archive = bool(f.get("with_archive"))
+        copy = fmt == "csv" and storage.is_postgres(sess) and not with_archive
+        sink = _Sink(tmp, gz, (lambda rows, size: progress(None, size)) if copy and progress else progress)
+        try:
+            if copy:
+                _copy_csv(sess, stmt, sink)
+            else:
+                _stream(sess, stmt, fmt, sink, cold_batches(sess, f) if with_archive else ())
+        except BaseException:
+            sink.close()
+            tmp.unlink(missing_ok=True)
+            raise
+        sink.close()
+        sess.rollback()  # только чтение; SET LOCAL уходит вместе с транзакцией
+    tmp.replace(path)
+    res = {"path": str(path), "rows": sink.rows, "bytes": sink.bytes,
+           "seconds": round(time.monotonic() - started, 1)}
+    if progress:
+        progress(res["rows"], res["bytes"])
+    return res
+
+
+def _day(s: str) -> datetime:
+    d = date.fromisoformat(s)
+    return datetime(d.year, d.month, d.day, tzinfo=BUCHAREST_TZ)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Потоковая выгрузка сообщений в exports/")
+    ap.add_argument("--chat", type=int)
+    ap.add_argument("--user", type=int)
+    ap.add_argument("--kind", default="любой", choices=["любой", "канал", "группа", "личка"])
+    ap.add_argument("--since", help="YYYY-MM-DD (включительно, Europe/Bucharest)")
+    ap.add_argument("--until", help="YYYY-MM-DD (включительно)")
+    ap.add_argument("--q", help="текст: подстрока или, с --fts, слова")
+    ap.add_argument("--fts", action="store_true", help="поиск по словам (Postgres с text_tsv)")
+    ap.add_argument("--format", default="csv", choices=FORMATS)
+    ap.add_argument("--gzip", action="store_true")
+    ap.add_argument("--with-archive", action="store_true", help="вместе с холодным архивом (Parquet)")
+    ap.add_argument("--out-dir", default=OUT_DIR)
+    args = ap.parse_args(argv)
+
+    f = {
+        "kind": args.kind, "chat_id": args.chat, "user_id": args.user, "q": args.q,
+        "text_mode": "fts" if args.fts else "substring",
+        "since": _day(args.since) if args.since else None,
+        "until": _day(args.until) + timedelta(days=1) if args.until else None,
+        "with_archive": args.with_archive,
+    }
+
+    def report(rows, size):
+        print(f"export: {'' if rows is None else f'{rows} строк, '}{size / 1048576:.1f} МБ", flush=True)
+
+    res = export(f, args.format, args.gzip, args.out_dir, progress=report)
+    print(f"export: {res['path']} за {res['seconds']} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
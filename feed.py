@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# feed.py — лента новых сообщений для внешних потребителей (алерты, скоринг)
+#
+# Воркер в той же транзакции, что и INSERT в message, добавляет в messagefeed по строке
+# на каждое реально вставленное сообщение. seq растёт монотонно и — благодаря
+# pg_advisory_xact_lock на время записи — в порядке коммитов: потребитель, прочитавший
+# seq N, уже не увидит позже строку с seq < N. После коммита Postgres шлёт
+# NOTIFY message_feed, так что потребитель просыпается сразу, а не по таймеру.
+# В SQLite запись и так последовательна, ожидание — короткий опрос; seq — AUTOINCREMENT,
+# так что номера, удалённые trim, не выдаются повторно.
+#
+# Потребитель хранит позицию в feedoffset и читает пачками после неё:
+#
+#   for batch in FeedConsumer("alerts").follow():
+#       handle(batch)          # позиция сохраняется, когда берётся следующая пачка
+#
+#   python feed.py tail --consumer alerts
+#   python feed.py status
+#   python feed.py trim --older-than-days 7
+
+import argparse
+import json
+import select as _select
+import sys
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import delete, func, text
+from sqlmodel import select
+
+from db import FeedOffset, Message, MessageFeed, MessageText
+import storage
+import textstore
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+CHANNEL = "message_feed"
+LOCK_KEY = 0x74676D66  # pg_advisory_xact_lock: seq в порядке коммитов
+DEFAULT_RETENTION_DAYS = 7
+FEED_COLS = ["chat_id", "message_id", "date"]
+
+
+def retention_days(cfg: dict) -> int:
+    """storage.feed_retention_days; 0 — не чистить."""
+    return int((cfg.get("storage") or {}).get("feed_retention_days", DEFAULT_RETENTION_DAYS))
+
+
+# ------------------------------------------------------------------------------
+# Запись (воркер)
+# ------------------------------------------------------------------------------
+def publish(sess, inserted) -> int:
+    """inserted — строки (chat_id, message_id, date, …) только что вставленных сообщений.
+    Вызывается до commit, в той же транзакции."""
+    if not inserted:
+        return 0
+    conn = sess.connection()
+    pg = storage.is_postgres(sess)
+    if pg:
+        # держится до конца транзакции: параллельные писатели получают seq по очереди
+        conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": LOCK_KEY})
+    now = datetime.now(BUCHAREST_TZ)
+    conn.execute(MessageFeed.__table__.insert(), [
+        {"chat_id": r.chat_id, "message_id": r.message_id, "date": r.date, "created_at": now} for r in inserted
+    ])
+    if pg:
+        conn.execute(text("SELECT pg_notify(:ch, '')"), {"ch": CHANNEL})  # доставляется при commit
+    return len(inserted)
+
+
+def trim(engine, days: int) -> int:
+    """Удаляет записи старше days дней, уже прочитанные всеми потребителями."""
+    if days <= 0:
+        return 0
+    from db import get_session
+    with get_session() as sess:
+        floor = sess.exec(select(func.min(FeedOffset.seq))).one()
+        cond = MessageFeed.created_at < datetime.now(BUCHAREST_TZ) - timedelta(days=days)
+        if floor is not None:
+            cond = cond & (MessageFeed.seq <= floor)
+        n = sess.exec(delete(MessageFeed).where(cond)).rowcount or 0
+        sess.commit()
+    return n
+
+
+# ------------------------------------------------------------------------------
+# Чтение (потребители)
+# ------------------------------------------------------------------------------
+class FeedConsumer:
+    """Читает ленту пачками после сохранённой позиции (at-least-once)."""
+
+    def __init__(self, name: str, batch: int = 500, engine=None):
+        from db import engine as default_engine
+        self.name = name
+        self.batch = batch
+        self.engine = engine or default_engine
+
+    def position(self) -> int:
+        from db import get_session
+        with get_session() as sess:
+            off = sess.get(FeedOffset, self.name)
+            return off.seq if off else 0
+
+    def commit(self, seq: int) -> None:
+        from db import get_session
+        with get_session() as sess:
+            storage.upsert(sess, FeedOffset.__table__, [{
+                "consumer": self.name, "seq": seq,
+                "updated_at": datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds"),
+            }], ["consumer"], ["seq", "updated_at"])
+            sess.commit()
+
+    def seek_end(self) -> None:
+        from db import get_session
+        with get_session() as sess:
+            head = sess.exec(select(func.coalesce(func.max(MessageFeed.seq), 0))).one()
+        self.commit(head)
+
+    def read(self, after: int = None) -> list[dict]:
+        """Следующая пачка: seq, сообщение и полный текст."""
+        from db import get_session
+        after = self.position() if after is None else after
+        with get_session() as sess:
+            rows = sess.exec(
+                select(MessageFeed.seq, MessageFeed.chat_id, MessageFeed.message_id, MessageFeed.date,
+                       Message.user_id, Message.account_id, textstore.full_text().label("text"))
+                .outerjoin(Message, (Message.chat_id == MessageFeed.chat_id)
+                           & (Message.message_id == MessageFeed.message_id))
+                .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)
+                .where(MessageFeed.seq > after)
+                .order_by(MessageFeed.seq)
+                .limit(self.batch)
+            ).all()
+        return [r._asdict() for r in rows]
+
+    def _waiter(self, idle: float):
+        """Функция ожидания новых записей: LISTEN в Postgres, sleep в SQLite."""
+        if not storage.is_postgres(self.engine):
+            return lambda: time.sleep(idle)
+        raw = self.engine.raw_connection()
+        pg = raw.driver_connection
+        pg.autocommit = True
+        pg.cursor().execute(f"LISTEN {CHANNEL}")
+
+        def wait():
+            if _select.select([pg], [], [], idle)[0]:
+                pg.poll()
+                pg.notifies.clear()
+        return wait
+
+    def follow(self, idle: float = 5.0):
+        """Бесконечный поток пачек. Позиция сохраняется, когда вызывающий берёт
+        следующую пачку, — необработанная пачка после сбоя будет прочитана снова."""
+        wait = self._waiter(idle)
+        pos = self.position()
+        while True:
+            rows = self.read(pos)
+            if not rows:
+                wait()
+                continue
+            yield rows
+            pos = rows[-1]["seq"]
+            self.commit(pos)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Лента новых сообщений")
+    ap.add_argument("command", choices=["tail", "status", "trim"])
+    ap.add_argument("--consumer", default="tail")
+    ap.add_argument("--from-end", action="store_true", help="новому потребителю — только новые записи")
+    ap.add_argument("--batch", type=int, default=500)
+    ap.add_argument("--older-than-days", type=int)
+    args = ap.parse_args(argv)
+
+    from db import engine, get_session
+    if args.command == "status":
+        with get_session() as sess:
+            head = sess.exec(select(func.coalesce(func.max(MessageFeed.seq), 0))).one()
+            offsets = sess.exec(select(FeedOffset).order_by(FeedOffset.consumer)).all()
+        print(f"head seq: {head}")
+        for o in offsets:
+            print(f"  {o.consumer:<24} seq {o.seq:>12}  отставание {head - o.seq:>10}  {o.updated_at}")
+        return 0
+    if args.command == "trim":
+        days = args.older_than_days if args.older_than_days is not None else retention_days(read_config())
+        print(f"trimmed: {trim(engine, days)}")
+        return 0
+
+    consumer = FeedConsumer(args.consumer, batch=args.batch)
+    if args.from_end and consumer.position() == 0:
+        consumer.seek_end()
+    try:
+        for batch in consumer.follow():
+            for r in batch:
+                r["date"] = r["date"].astimezone(BUCHAREST_TZ).isoformat() if r["date"] else None
+                print(json.dumps(r, ensure_ascii=False), flush=True)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# logquery.py — быстрый поиск по структурированному логу (logs/app*.jsonl)
+#
+# Для каждого файла строится индекс блоков: смещение, диапазон времени, набор
+# chat_id и уровней. Запрос читает с диска только блоки, которые могут
+# содержать подходящие записи. Ротированные файлы не меняются и индексируются
+# один раз, активный файл — дописывается в индекс с последнего смещения.
+#
+# Хвост лога (tail) читается блоками с конца файла, а слежение (LogFollower) помнит
+# inode и смещение и дочитывает только дописанные байты — стоимость не зависит от
+# размера файла. Оба работают и с текстовым app.log, и с app.jsonl.
+#
+#   python logquery.py --chat 1864457857 --level WARNING --since 2025-08-20 --limit 50
+#   python logquery.py --path logs/app.log --level WARNING --follow
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+BLOCK_LINES = 2000
+INDEX_VERSION = 1
+LEVELS = {"TRACE": 5, "DEBUG": 10, "INFO": 20, "SUCCESS": 25, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+TAIL_BLOCK = 64 * 1024
+TAIL_MAX_BYTES = 8 * 1024 * 1024  # сколько хвоста просматривать, если фильтр почти ничего не находит
+TEXT_RECORD = re.compile(rb"^\d{4}-\d{2}-\d{2} ")  # начало записи loguru; остальное — продолжение (traceback)
+TEXT_LEVEL = re.compile(r"\|\s*([A-Z]+)\s*\|")
+
+
+def _ts(value) -> float:
+    """ISO-строка/datetime/date -> epoch seconds (наивные значения — по Бухаресту)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):  # date
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=BUCHAREST_TZ)
+    return value.timestamp()
+
+
+def log_files(jsonl_path) -> list[Path]:
+    """Активный файл и ротированные копии loguru (app.<дата>.jsonl), старые — первыми."""
+    base = Path(jsonl_path)
+    if not base.parent.exists():
+        return []
+    files = [p for p in base.parent.glob(f"{base.stem}.*{base.suffix}") if p.is_file()]
+    if base.exists():
+        files.append(base)
+    return sorted(set(files), key=lambda p: p.stat().st_mtime)
+
+
+# ------------------------------------------------------------------------------
+# Индекс
+# ------------------------------------------------------------------------------
+def _index_path(path: Path) -> Path:
+    return path.parent / ".index" / (path.name + ".idx.json")
+
+
+def _new_block(off: int) -> dict:
+    return {"off": off, "end": off, "n": 0, "ts_min": None, "ts_max": None, "levels": set(), "chats": set()}
+
+
+def _seal(block: dict) -> dict:
+    return dict(block, levels=sorted(block["levels"]), chats=sorted(block["chats"]))
+
+
+def _load_index(path: Path, st: os.stat_result) -> dict:
+    try:
+        idx = json.loads(_index_path(path).read_text(encoding="utf-8"))
+        # файл пересоздан (ротация под тем же именем) или усечён — строим заново
+        if idx.get("v") == INDEX_VERSION and idx.get("ino") == st.st_ino and idx.get("indexed", 0) <= st.st_size:
+            return idx
+    except (OSError, ValueError):
+        pass
+    return {"v": INDEX_VERSION, "ino": st.st_ino, "indexed": 0, "blocks": []}
+
+
+def build_index(path) -> dict:
+    """Дописывает индекс файла с последнего проиндексированного смещения."""
+    path = Path(path)
+    st = path.stat()
+    idx = _load_index(path, st)
+    if idx["indexed"] == st.st_size:
+        return idx
+
+    blocks = idx["blocks"]
+    # последний блок мог быть неполным — продолжаем его
+    if blocks and blocks[-1]["n"] < BLOCK_LINES:
+        cur = blocks.pop()
+        cur["levels"], cur["chats"] = set(cur["levels"]), set(cur["chats"])
+    else:
+        cur = _new_block(idx["indexed"])
+
+    with open(path, "rb") as f:
+        f.seek(idx["indexed"])
+        pos = idx["indexed"]
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # запись ещё дописывается
+            pos += len(line)
+            try:
+                rec = json.loads(line)
+                ts = _ts(rec["ts"])
+            except (ValueError, KeyError, TypeError):
+                cur["end"] = pos
+                continue
+            cur["n"] += 1
+            cur["end"] = pos
+            cur["ts_min"] = ts if cur["ts_min"] is None else min(cur["ts_min"], ts)
+            cur["ts_max"] = ts if cur["ts_max"] is None else max(cur["ts_max"], ts)
+            cur["levels"].add(rec.get("level"))
+            if rec.get("chat_id") is not None:
+                cur["chats"].add(rec["chat_id"])
+            if cur["n"] >= BLOCK_LINES:
+                blocks.append(_seal(cur))
+                cur = _new_block(pos)
+    if cur["n"] or cur["end"] > cur["off"]:
+        blocks.append(_seal(cur))
+
+    idx["indexed"] = pos
+    ip = _index_path(path)
+    ip.parent.mkdir(parents=True, exist_ok=True)
+    tmp = ip.with_suffix(".tmp")
+    tmp.write_text(json.dumps(idx), encoding="utf-8")
+    tmp.replace(ip)
+    return idx
+
+
+# ------------------------------------------------------------------------------
+# Запрос
+# ------------------------------------------------------------------------------
+def _block_matches(b: dict, chat_id, min_level, since, until) -> bool:
+    if not b["n"]:
+        return False
+    if since is not None and b["ts_max"] < since:
+        return False
+    if until is not None and b["ts_min"] >= until:
+        return False
+    if chat_id is not None and chat_id not in b["chats"]:
+        return False
+    if min_level and not any(LEVELS.get(lv, 0) >= min_level for lv in b["levels"]):
+        return False
+    return True
+
+
+def prune_indexes(jsonl_path) -> None:
+    """Удаляет индексы файлов, которые loguru уже стёр по retention."""
+    idx_dir = Path(jsonl_path).parent / ".index"
+    if not idx_dir.exists():
+        return
+    for ip in idx_dir.glob("*.idx.json"):
+        if not (Path(jsonl_path).parent / ip.name[: -len(".idx.json")]).exists():
+            ip.unlink(missing_ok=True)
+
+
+def query(jsonl_path, *, chat_id=None, level=None, since=None, until=None, text=None, limit=1000) -> list[dict]:
+    """Записи, подходящие под фильтры, в хронологическом порядке (последние `limit`).
+    level — минимальный уровень (WARNING включает ERROR/CRITICAL).
+    """
+    min_level = LEVELS.get(level.upper(), 0) if level else 0
+    since = _ts(since) if since is not None else None
+    until = _ts(until) if until is not None else None
+    chat_id = int(chat_id) if chat_id is not None else None
+    text = text.lower() if text else None
+
+    prune_indexes(jsonl_path)
+    out = []
+    for path in reversed(log_files(jsonl_path)):
+        idx = build_index(path)
+        blocks = [b for b in idx["blocks"] if _block_matches(b, chat_id, min_level, since, until)]
+        if not blocks:
+            continue
+        with open(path, "rb") as f:
+            for b in reversed(blocks):
+                f.seek(b["off"])
+                chunk = f.read(b["end"] - b["off"])
+                matched = []
+                for line in chunk.splitlines():
+                    try:
+                        rec = json.loads(line)
+                        ts = _ts(rec["ts"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if since is not None and ts < since:
+                        continue
+                    if until is not None and ts >= until:
+                        continue
+                    if chat_id is not None and rec.get("chat_id") != chat_id:
+                        continue
+                    if min_level and LEVELS.get(rec.get("level"), 0) < min_level:
+                        continue
+                    if text and text not in (rec.get("msg") or "").lower():
+                        continue
+                    matched.append(rec)
+                out.extend(reversed(matched))
+                if len(out) >= limit:
+                    return list(reversed(out[:limit]))
+    return list(reversed(out))
+
+
+# ------------------------------------------------------------------------------
+# Хвост и слежение
+# ------------------------------------------------------------------------------
+class RecordFilter:
+    """Фильтр записи по первой строке: минимальный уровень и chat_id (в app.log — подстрока)."""
+
+    def __init__(self, *, level=None, chat_id=None, jsonl=False):
+        self.min_level = LEVELS.get(level.upper(), 0) if level else 0
+        self.chat_id = int(chat_id) if chat_id is not None else None
+        self.jsonl = jsonl
+
+    def __call__(self, head: str) -> bool:
+        if not self.min_level and self.chat_id is None:
+            return True
+        if self.jsonl:
+            try:
+                rec = json.loads(head)
+            except ValueError:
+                return False
+            level, chat_ok = rec.get("level"), self.chat_id is None or rec.get("chat_id") == self.chat_id
+        else:
+            m = TEXT_LEVEL.search(head)
+            level, chat_ok = m and m.group(1), self.chat_id is None or str(self.chat_id) in head
+        return chat_ok and (not self.min_level or LEVELS.get(level, 0) >= self.min_level)
+
+
+def _reverse_lines(f, end: int):
+    """Строки файла (bytes, без \\n) от смещения end к началу, блоками по TAIL_BLOCK."""
+    pos, rest = end, b""
+    while pos > 0:
+        step = min(TAIL_BLOCK, pos)
+        pos -= step
+        f.seek(pos)
+        lines = (f.read(step) + rest).split(b"\n")
+        rest = lines.pop(0)
+        yield from reversed(lines)
+    yield rest
+
+
+def tail(path, n: int = 200, *, level=None, chat_id=None, end: int = None) -> list[str]:
+    """Последние n записей файла до смещения end (по умолчанию — до конца), старые — первыми.
+    Запись app.log вместе со строками traceback считается одной."""
+    path = Path(path)
+    jsonl = path.suffix == ".jsonl"
+    keep = RecordFilter(level=level, chat_id=chat_id, jsonl=jsonl)
+    out, pending = [], []
+    with open(path, "rb") as f:
+        end = os.fstat(f.fileno()).st_size if end is None else end
+        scanned = 0
+        for line in _reverse_lines(f, end):
+            scanned += len(line) + 1
+            if not line:
+                continue
+            if jsonl or TEXT_RECORD.match(line):
+                head = line.decode("utf-8", "replace")
+                if keep(head):
+                    out.append("\n".join([head] + [p.decode("utf-8", "replace") for p in reversed(pending)]))
+                    if len(out) >= n:
+                        break
+                pending = []
+            else:
+                pending.append(line)
+            if scanned > TAIL_MAX_BYTES:
+                break
+    return out[::-1]
+
+
+class LogFollower:
+    """Слежение за логом: после первого tail() дочитывает только новые байты.
+    Ротация loguru (файл переименован, под тем же именем — новый) определяется по inode:
+    остаток старого файла дочитывается из ротированной копии, новый — с начала."""
+
+    def __init__(self, path, n: int = 500, *, level=None, chat_id=None):
+        self.path = Path(path)
+        self.n = n
+        self.level, self.chat_id = level, chat_id
+        self.keep = RecordFilter(level=level, chat_id=chat_id, jsonl=self.path.suffix == ".jsonl")
+        self.records = deque(maxlen=n)
+        self.ino, self.offset = None, 0
+        self._partial, self._kept = b"", False
+
+    def text(self) -> str:
+        return "\n".join(self.records)
+
+    def poll(self) -> list[str]:
+        """Дочитывает файл. Возвращает новые строки, прошедшие фильтр (пусто — изменений нет)."""
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return []
+        if self.ino is None:
+            self._tail(self.path, st.st_size)
+            self.ino = st.st_ino
+            return list(self.records)
+        new = []
+        if st.st_ino != self.ino:
+            rotated = next((p for p in log_files(self.path) if p != self.path and p.stat().st_ino == self.ino), None)
+            if rotated is not None:
+                new += self._read(rotated)
+            self.ino, self.offset, self._partial = st.st_ino, 0, b""
+        elif st.st_size < self.offset:  # усечён на месте
+            self.offset, self._partial = 0, b""
+        if st.st_size > self.offset:
+            new += self._read(self.path)
+        return new
+
+    def _tail(self, path: Path, size: int) -> list[str]:
+        """Последние n записей до последнего \n; незаконченная строка (воркер пишет её прямо
+        сейчас) остаётся в _partial и дочитывается следующим poll."""
+        with open(path, "rb") as f:
+            partial = next(_reverse_lines(f, size))
+        recs = tail(path, self.n, level=self.level, chat_id=self.chat_id, end=size - len(partial))
+        self.records.extend(recs)
+        self.offset, self._partial, self._kept = size, partial, False
+        return recs
+
+    def _read(self, path: Path) -> list[str]:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size - self.offset > TAIL_MAX_BYTES:  # отстали слишком сильно — только хвост
+                return self._tail(path, size)
+            f.seek(self.offset)
+            data = self._partial + f.read(size - self.offset)
+            self.offset = size
+        lines = data.split(b"\n")
+        self._partial = lines.pop()  # незаконченная строка — до следующего poll
+        jsonl = path.suffix == ".jsonl"
+        new = []
+        for line in lines:
+            if not line:
+                continue
+            text = line.decode("utf-8", "replace")
+            if jsonl or TEXT_RECORD.match(line):
+                self._kept = self.keep(text)
+                if self._kept:
+                    self.records.append(text)
+                    new.append(text)
+            elif self._kept and self.records:
+                self.records[-1] += "\n" + text
+                new.append(text)
+        return new
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Поиск по структурированному логу воркера")
+    ap.add_argument("--path", default="logs/app.jsonl")
+    ap.add_argument("--chat", type=int)
+    ap.add_argument("--level", help="минимальный уровень: INFO, WARNING, ERROR …")
+    ap.add_argument("--since", help="ISO-дата/время (Europe/Bucharest, если без смещения)")
+    ap.add_argument("--until")
+    ap.add_argument("--text", help="подстрока в сообщении")
+    ap.add_argument("--limit", type=int, default=200)
+    ap.add_argument("--json", action="store_true", help="печатать записи как JSONL")
+    ap.add_argument("--follow", action="store_true", help="хвост файла и новые записи (фильтры --chat и --level)")
+    args = ap.parse_args(argv)
+
+    if args.follow:
+        follower = LogFollower(args.path, args.limit, level=args.level, chat_id=args.chat)
+        try:
+            while True:
+                for line in follower.poll():
+                    print(line, flush=True)
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return 0
+
+    rows = query(args.path, chat_id=args.chat, level=args.level, since=args.since,
+                 until=args.until, text=args.text, limit=args.limit)
+    for r in rows:
+        if args.json:
+            print(json.dumps(r, ensure_ascii=False))
+        else:
+            extra = " ".join(f"{k}={r[k]}" for k in ("chat_id", "mode", "batch", "inserted", "duration_ms", "flood_wait") if k in r)
+            print(f"{r['ts']} {r['level']:<8} {r['msg']} {extra}".rstrip())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# migrate_v3.py — message.date: ISO-строка -> timestamptz (онлайн, без остановки воркера)
+#
+# Postgres:
+#   1) добавляем колонку date_tz и триггер, который заполняет её для новых строк;
+#   2) заполняем старые строки пачками по id (каждая пачка — отдельная транзакция,
+#      повторный запуск продолжает с незаполненных);
+#   3) строим индекс CONCURRENTLY;
+#   4) добираем оставшиеся строки пачками по частичному индексу WHERE date_tz IS NULL;
+#   5) в одной короткой транзакции только меняем колонки местами (date -> date_text,
+#      date_tz -> date). Старая колонка остаётся до запуска с --drop-old.
+# SQLite: строки переписываются в UTC-формат TZDateTime (см. db.py).
+#
+#   python migrate_v3.py                      # DSN из .env / DATABASE_URL
+#   python migrate_v3.py --drop-old           # после проверки удалить date_text
+#   python migrate_v3.py --sqlite data/db.sqlite
+
+import argparse
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+BATCH = 50_000
+# строки, которым ещё нужен date_tz (пустая строка даты остаётся NULL и в очередь не входит)
+PENDING = "date_tz IS NULL AND date IS NOT NULL AND date <> ''"
+
+
+def _column_type(conn, column: str):
+    return conn.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'message' AND column_name = :c"
+    ), {"c": column}).scalar()
+
+
+def migrate_postgres(engine, batch: int, drop_old: bool) -> None:
+    with engine.connect() as conn:
+        date_type = _column_type(conn, "date")
+        has_old = _column_type(conn, "date_text") is not None
+    if date_type == "timestamp with time zone":
+        print("message.date уже timestamptz.")
+        if drop_old and has_old:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE message DROP COLUMN date_text"))
+            print("Колонка date_text удалена.")
+        return
+
+    # 1) колонка + триггер для строк, которые воркер вставит во время миграции
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE message ADD COLUMN IF NOT EXISTS date_tz timestamptz"))
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION message_date_tz_sync() RETURNS trigger AS $$
+            BEGIN
+                NEW.date_tz := NULLIF(NEW.date, '')::timestamptz;
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS trg_message_date_tz ON message"))
+        conn.execute(text(
+            "CREATE TRIGGER trg_message_date_tz BEFORE INSERT OR UPDATE OF date ON message "
+            "FOR EACH ROW EXECUTE FUNCTION message_date_tz_sync()"
+        ))
+
+    # 2) backfill пачками по диапазонам id
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text("SELECT min(id), max(id) FROM message")).one()
+    if lo is not None:
+        started = time.time()
+        for start in range(lo, hi + 1, batch):
+            with engine.begin() as conn:
+                n = conn.execute(text(
+                    "UPDATE message SET date_tz = NULLIF(date, '')::timestamptz "
+                    "WHERE id >= :a AND id < :b AND date_tz IS NULL AND date IS NOT NULL"
+                ), {"a": start, "b": start + batch}).rowcount
+            done = min(start + batch, hi + 1) - lo
+            print(f"backfill: id < {start + batch} ({done * 100 // (hi - lo + 1)}%), updated {n}, "
+                  f"{time.time() - started:.0f}s")
+
+    # 3) индекс без блокировки записи
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_date_tz ON message (date_tz)"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_date_tz_pending ON message (id) WHERE {PENDING}"))
+
+    # 4) добор незаполненных строк (пропущенные прерванным запуском) пачками по частичному индексу;
+    #    новые строки с шага 1 заполняет триггер, так что под блокировкой добирать нечего
+    while True:
+        with engine.begin() as conn:
+            n = conn.execute(text(
+                "UPDATE message SET date_tz = NULLIF(date, '')::timestamptz "
+                f"WHERE id IN (SELECT id FROM message WHERE {PENDING} ORDER BY id LIMIT :n)"
+            ), {"n": batch}).rowcount
+        if n:
+            print(f"catch-up: updated {n}")
+        if n < batch:
+            break
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_message_date_tz_pending"))
+
+    # 5) переключение — короткая транзакция: только переименования, не ждём долгих блокировок
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        conn.execute(text("LOCK TABLE message IN SHARE ROW EXCLUSIVE MODE"))
+        conn.execute(text("DROP TRIGGER IF EXISTS trg_message_date_tz ON message"))
+        conn.execute(text("DROP FUNCTION IF EXISTS message_date_tz_sync()"))
+        conn.execute(text("ALTER TABLE message RENAME COLUMN date TO date_text"))
+        conn.execute(text("ALTER TABLE message RENAME COLUMN date_tz TO date"))
+        conn.execute(text("ALTER INDEX IF EXISTS ix_message_date RENAME TO ix_message_date_text"))
+        conn.execute(text("ALTER INDEX ix_message_date_tz RENAME TO ix_message_date"))
+    print("message.date переключена на timestamptz (старая колонка: date_text).")
+
+    if drop_old:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE message DROP COLUMN date_text"))
+        print("Колонка date_text удалена.")
+
+
+def migrate_sqlite(path: str, batch: int) -> None:
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    last_id, total = 0, 0
+    while True:
+        rows = cur.execute(
+            "SELECT rowid, date FROM message WHERE rowid > ? AND date IS NOT NULL ORDER BY rowid LIMIT ?",
+            (last_id, batch),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for mid, val in rows:
+            try:
+                dt = datetime.fromisoformat(val)
+            except (TypeError, ValueError):
+                continue
+            if dt.tzinfo is None:  # уже в формате TZDateTime (UTC без смещения)
+                continue
+            updates.append((dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"), mid))
+        cur.executemany("UPDATE message SET date = ? WHERE rowid = ?", updates)
+        conn.commit()
+        total += len(updates)
+        last_id = rows[-1][0]
+    conn.close()
+    print(f"SQLite: переписано дат {total}.")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Migration v3: message.date -> timestamptz")
+    ap.add_argument("--sqlite", help="путь к SQLite-базе вместо Postgres")
+    ap.add_argument("--batch", type=int, default=BATCH)
+    ap.add_argument("--drop-old", action="store_true", help="удалить колонку date_text после переключения")
+    args = ap.parse_args(argv)
+
+    if args.sqlite:
+        migrate_sqlite(args.sqlite, args.batch)
+    else:
+        from db import engine
+        migrate_postgres(engine, args.batch, args.drop_old)
+    print("Migration v3 complete.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# migrations.py — версионированная схема БД, построенная из моделей db.py
+#
+# db.py — единственное описание схемы: таблицы, колонки и индексы задаются в моделях,
+# отсюда же генерируется postgres_schema.sql. Шаги ниже применяются по порядку и
+# записываются в schemaversion; каждый шаг идемпотентен, так что после сбоя
+# повторный upgrade продолжает с незавершённого шага. Индексы на существующих
+# таблицах строятся CONCURRENTLY — воркер продолжает писать.
+#
+#   python migrations.py status
+#   python migrations.py upgrade
+#   python migrations.py check                           # EXPLAIN горячих запросов, ошибка при Seq Scan
+#   python migrations.py dump-schema > postgres_schema.sql
+
+import argparse
+import sys
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import Integer, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlmodel import SQLModel
+
+import db  # noqa: F401 — регистрирует модели в SQLModel.metadata
+from db import SchemaVersion
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+LOCK_KEY = 0x74676D67  # pg_advisory_lock: один upgrade за раз
+BATCH = 50_000
+
+
+# ------------------------------------------------------------------------------
+# Схема из моделей
+# ------------------------------------------------------------------------------
+def sync_models(engine) -> None:
+    """Создаёт недостающие таблицы (с их индексами) и добавляет недостающие колонки.
+    SQLite-таблицу, у которой первичный ключ или AUTOINCREMENT не совпадает с моделью, пересобирает."""
+    SQLModel.metadata.create_all(engine)
+    insp = inspect(engine)
+    prep = engine.dialect.identifier_preparer
+    for table in SQLModel.metadata.sorted_tables:
+        if engine.dialect.name == "sqlite" and _sqlite_differs(engine, insp, table):
+            _rebuild_sqlite(engine, table, {c["name"] for c in insp.get_columns(table.name)})
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have:
+                    continue
+                print(f"add column {table.name}.{col.name}")
+                conn.execute(text(
+                    f"ALTER TABLE {prep.format_table(table)} ADD COLUMN {prep.format_column(col)} "
+                    f"{col.type.compile(dialect=engine.dialect)}"
+                ))
+
+
+def _sqlite_differs(engine, insp, table) -> bool:
+    pk = insp.get_pk_constraint(table.name)["constrained_columns"]
+    if sorted(pk) != sorted(c.name for c in table.primary_key):
+        return True
+    if not table.dialect_options["sqlite"]["autoincrement"]:
+        return False
+    with engine.connect() as conn:
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :n"),
+                           {"n": table.name}).scalar()
+    return "AUTOINCREMENT" not in (sql or "").upper()
+
+
+def _rebuild_sqlite(engine, table, have: set[str]) -> None:
+    """Пересборка таблицы SQLite по модели (ALTER TABLE не меняет первичный ключ):
+    новая таблица -> копия строк -> DROP старой -> RENAME -> индексы, в одной транзакции
+    при выключенных foreign_keys. Суррогатный id, которого не было (старая message с ключом
+    (chat_id, message_id)), заполняется из rowid — порядок вставки сохраняется."""
+    prep = engine.dialect.identifier_preparer
+    name, tmp = prep.format_table(table), prep.quote(f"_new_{table.name}")
+    ddl = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+    ddl = ddl.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {tmp} ", 1)
+    cols = [c.name for c in table.columns if c.name in have]
+    src = [prep.quote(c) for c in cols]
+    dst = list(src)
+    auto = [c.name for c in table.primary_key if c.name not in have]
+    if len(auto) == 1 and isinstance(table.c[auto[0]].type, Integer):
+        dst.append(prep.quote(auto[0]))
+        src.append("rowid")
+    print(f"rebuild table {table.name} (primary key {', '.join(c.name for c in table.primary_key)})")
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys = OFF")  # вне транзакции — иначе не действует
+        conn.commit()
+        try:
+            with conn.begin():
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {tmp}")
+                conn.exec_driver_sql(ddl)
+                conn.exec_driver_sql(
+                    f"INSERT INTO {tmp} ({', '.join(dst)}) SELECT {', '.join(src)} FROM {name} ORDER BY rowid"
+                )
+                conn.exec_driver_sql(f"DROP TABLE {name}")
+                conn.exec_driver_sql(f"ALTER TABLE {tmp} RENAME TO {name}")
+                for idx in table.indexes:
+                    idx.create(conn, checkfirst=True)
+                orphans = conn.exec_driver_sql(f"PRAGMA foreign_key_check({name})").all()
+            if orphans:
+                print(f"  {table.name}: строк со ссылками на отсутствующие записи — {len(orphans)}")
+        finally:
+            conn.rollback()
+            conn.exec_driver_sql("PRAGMA foreign_keys = ON")
+            conn.commit()
+
+
+def model_indexes(engine, table_name: str = None) -> list[tuple[str, str, str]]:
+    """[(имя, таблица, определение)] индексов моделей; определение — всё после имени таблицы."""
+    out = []
+    prep = engine.dialect.identifier_preparer
+    for table in SQLModel.metadata.sorted_tables:
+        if table_name and table.name != table_name:
+            continue
+        qtable = prep.format_table(table)
+        for idx in sorted(table.indexes, key=lambda i: i.name):
+            ddl = str(CreateIndex(idx).compile(dialect=engine.dialect))
+            definition = ddl.split(f" ON {qtable} ", 1)[1]
+            out.append((idx.name, qtable, definition))
+    return out
+
+
+def sync_indexes(engine) -> None:
+    """Строит недостающие индексы моделей (Postgres — CONCURRENTLY, с учётом партиций)."""
+    from partitions import create_index_online
+
+    for name, table, definition in model_indexes(engine):
+        if engine.dialect.name == "postgresql":
+            print(f"index {name} …")
+            create_index_online(engine, name, table, definition)
+        else:
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}"))
+
+
+def drop_indexes(engine, names) -> None:
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            for name in names:
+                conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for name in names:
+            # индекс партиционированной таблицы CONCURRENTLY не удаляется
+            partitioned = conn.execute(text(
+                "SELECT c.relkind = 'I' FROM pg_class c WHERE c.oid = to_regclass(:n)"
+            ), {"n": name}).scalar()
+            if partitioned is None:
+                continue
+            conn.execute(text(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name}"))
+            print(f"dropped index {name}")
+
+
+# ------------------------------------------------------------------------------
+# Шаги
+# ------------------------------------------------------------------------------
+def _date_timestamptz(engine) -> None:
+    import migrate_v3
+    if engine.dialect.name == "postgresql":
+        migrate_v3.migrate_postgres(engine, BATCH, drop_old=False)
+    elif engine.dialect.name == "sqlite":
+        migrate_v3.migrate_sqlite(engine.url.database, BATCH)
+
+
+def _hot_query_indexes(engine) -> None:
+    sync_indexes(engine)
+    # покрыты составными ix_message_chat_date / ix_message_user_date / ix_chat_title_cover
+    drop_indexes(engine, ["ix_message_chat_id", "ix_message_user_id", "ix_chat_title"])
+
+
+def _message_text_store(engine) -> None:
+    import search
+    import textstore
+
+    sync_models(engine)   # messagetext, message.text_hash
+    sync_indexes(engine)  # ix_message_text_hash
+    if search.fts_available(engine):
+        with engine.begin() as conn:
+            search.create_tsv_trigger(conn)
+    textstore.backfill(engine, textstore.min_length(read_config()))
+    textstore.create_view(engine)
+
+
+def _chat_stats(engine) -> None:
+    import stats
+    sync_models(engine)
+    stats.reconcile(engine)
+
+
+def _activity_rollup(engine) -> None:
+    import rollup
+    sync_models(engine)
+    rollup.backfill(engine, rollup.WORKERS if engine.dialect.name == "postgresql" else 1)
+
+
+def _poster_rollup(engine) -> None:
+    import rollup
+    sync_models(engine)
+    with engine.connect() as conn:
+        filled = conn.execute(text("SELECT 1 FROM posterrollup LIMIT 1")).first()
+        authored = conn.execute(text("SELECT 1 FROM message WHERE user_id IS NOT NULL LIMIT 1")).first()
+    # шаг 7 в том же upgrade уже заполнил и posterrollup (пустой она остаётся, только если
+    # у сообщений нет авторов); добирать нужно, лишь если шаг 7 применён до появления таблицы
+    if authored and not filled:
+        rollup.backfill(engine, rollup.WORKERS if engine.dialect.name == "postgresql" else 1, posters_only=True)
+
+
+def _feed_autoincrement(engine) -> None:
+    sync_models(engine)  # SQLite: messagefeed пересобирается с AUTOINCREMENT
+    if engine.dialect.name != "sqlite":
+        return
+    # счётчик не ниже уже выданных seq: хвост ленты мог быть удалён trim, позиции потребителей остались
+    with engine.begin() as conn:
+        head = conn.execute(text(
+            "SELECT max(coalesce((SELECT max(seq) FROM messagefeed), 0), coalesce((SELECT max(seq) FROM feedoffset), 0))"
+        )).scalar()
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'messagefeed'"))
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('messagefeed', :s)"), {"s": head})
+
+
+def _dialog_marked_ids(engine) -> None:
+    sync_models(engine)
+    # снимок с голыми id (канал и пользователь с одним id затирали друг друга) не переводится:
+    # тип группы по нему не восстановить; следующее обновление (водяного знака нет) перечитает всё
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM dialog"))
+
+
+def _fts_indexed(engine) -> None:
+    sync_models(engine)
+    # всё, что уже проиндексировано, считается проиндексированным текущей конфигурацией
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE chatmeta SET fts_indexed = fts_config WHERE fts_indexed IS NULL"))
+
+
+STEPS = [
+    (1, "таблицы и колонки из моделей", sync_models),
+    (2, "message.date -> timestamptz", _date_timestamptz),
+    (3, "индексы горячих запросов", _hot_query_indexes),
+    (4, "тексты сообщений по хешу (messagetext)", _message_text_store),
+    (5, "лента новых сообщений (messagefeed, feedoffset)", sync_models),
+    (6, "счётчики панели (chatstats)", _chat_stats),
+    (7, "активность по часам и суткам (activityrollup)", _activity_rollup),
+    (8, "авторы по суткам (posterrollup)", _poster_rollup),
+    (9, "диалоги аккаунтов (dialog)", sync_models),
+    (10, "очередь переиндексации поиска (chatmeta.fts_indexed)", _fts_indexed),
+    (11, "seq ленты без повторов после trim (messagefeed AUTOINCREMENT)", _feed_autoincrement),
+    (12, "время обновления метаданных чатов (account.meta_refreshed_at)", sync_models),
+    (13, "диалоги по marked id (dialog.dialog_id)", _dialog_marked_ids),
+]
+
+
+def current_version(engine) -> int:
+    if not inspect(engine).has_table(SchemaVersion.__tablename__):
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT COALESCE(max(version), 0) FROM schemaversion")).scalar()
+
+
+def pending(engine) -> list[tuple[int, str]]:
+    cur = current_version(engine)
+    return [(v, name) for v, name, _ in STEPS if v > cur]
+
+
+def upgrade(engine) -> int:
+    """Применяет недостающие шаги. Возвращает итоговую версию схемы."""
+    lock = None
+    if engine.dialect.name == "postgresql":
+        lock = engine.connect()
+        if not lock.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": LOCK_KEY}).scalar():
+            lock.close()
+            raise SystemExit("upgrade уже выполняется в другом процессе")
+    try:
+        cur = current_version(engine)
+        for version, name, step in STEPS:
+            if version <= cur:
+                continue
+            print(f"[{version}] {name}")
+            step(engine)
+            SQLModel.metadata.create_all(engine, tables=[SchemaVersion.__table__])
+            with engine.begin() as conn:
+                conn.execute(SchemaVersion.__table__.insert().values(
+                    version=version, name=name,
+                    applied_at=datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds"),
+                ))
+            cur = version
+        return cur
+    finally:
+        if lock is not None:
+            lock.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": LOCK_KEY})
+            lock.close()
+
+
+# ------------------------------------------------------------------------------
+# Проверка планов горячих запросов
+# ------------------------------------------------------------------------------
+HOT_QUERIES = {
+    "просмотр БД: чат, новые сверху":
+        "SELECT id, message_id, user_id, date FROM message WHERE chat_id = :chat_id "
+        "ORDER BY date DESC, id DESC LIMIT 100",
+    "просмотр БД: контакт, новые сверху":
+        "SELECT id, chat_id, message_id, date FROM message WHERE user_id = :user_id "
+        "ORDER BY date DESC, id DESC LIMIT 100",
+    "просмотр БД: следующая страница чата (keyset)":
+        "SELECT id, message_id, user_id, date FROM message WHERE chat_id = :chat_id AND date <= :date "
+        "AND (date, chat_id, message_id) < (:date, :chat_id, :message_id) "
+        "ORDER BY date DESC, chat_id DESC, message_id DESC LIMIT 101",
+    "просмотр БД: все сообщения, новые сверху":
+        "SELECT id, chat_id, message_id, date FROM message ORDER BY date DESC LIMIT 100",
+    "панель: чаты по названию":
+        "SELECT chat_id, title, type, is_group, is_channel FROM chat ORDER BY title",
+    "воркер: курсор чата": "SELECT * FROM cursor WHERE chat_id = :chat_id",
+    "воркер: окна чата": 'SELECT * FROM "window" WHERE chat_id = :chat_id',
+    "воркер: аккаунт по сессии": "SELECT id FROM account WHERE session_name = :session",
+    "воркер: чаты аккаунта": "SELECT chat_id FROM accountchat WHERE account_id = :account_id",
+    "воркер: участники чата": "SELECT user_id, last_seen_at FROM chatmember WHERE chat_id = :chat_id",
+}
+HOT_PARAMS = {"chat_id": 0, "user_id": 0, "account_id": 0, "session": "", "date": "2100-01-01", "message_id": 0}
+
+
+def _full_scans_pg(plan: dict, filtered: bool) -> list[str]:
+    # Seq Scan, а для запросов с WHERE — и обход индекса целиком без Index Cond
+    node = plan.get("Node Type")
+    full = node == "Seq Scan" or (
+        filtered and node in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan
+    )
+    out = [plan.get("Relation Name", "?")] if full else []
+    for sub in plan.get("Plans", []):
+        out += _full_scans_pg(sub, filtered)
+    return out
+
+
+def check_plans(engine) -> dict[str, list[str]]:
+    """{запрос: [таблицы, прочитанные целиком]} — пусто, если всё по индексам.
+    В Postgres seq scan запрещается на время EXPLAIN: если план всё равно его содержит,
+    подходящего индекса нет (а не просто «таблица маленькая»)."""
+    bad = {}
+    with engine.connect() as conn:
+        for name, sql in HOT_QUERIES.items():
+            if engine.dialect.name == "postgresql":
+                with conn.begin():
+                    conn.execute(text("SET LOCAL enable_seqscan = off"))
+                    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), HOT_PARAMS).scalar()
+                scans = _full_scans_pg(plan[0]["Plan"], " WHERE " in sql)
+            else:
+                rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), HOT_PARAMS).all()
+                scans = [r[-1] for r in rows
+                         if r[-1].startswith("SCAN ") and ("USING" not in r[-1] or " WHERE " in sql)]
+            if scans:
+                bad[name] = scans
+    return bad
+
+
+# ------------------------------------------------------------------------------
+# DDL
+# ------------------------------------------------------------------------------
+def dump_schema() -> str:
+    dialect = postgresql.dialect()
+    out = [
+        "-- postgres_schema.sql — сгенерировано из db.py: python migrations.py dump-schema",
+        "-- Не редактировать вручную. Полнотекстовый/trigram-поиск и партиции",
+        "-- добавляются отдельно: search.py install-fts / install-trgm, partitions.py convert.",
+        "",
+    ]
+    for table in SQLModel.metadata.sorted_tables:
+        out.append(str(CreateTable(table).compile(dialect=dialect)).strip().replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1) + ";")
+        for idx in sorted(table.indexes, key=lambda i: i.name):
+            ddl = str(CreateIndex(idx).compile(dialect=dialect))
+            out.append(ddl.replace(" INDEX ", " INDEX IF NOT EXISTS ", 1) + ";")
+        out.append("")
+    return "\n".join(out)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Версионированные миграции схемы")
+    ap.add_argument("command", choices=["status", "upgrade", "check", "dump-schema"])
+    args = ap.parse_args(argv)
+
+    if args.command == "dump-schema":
+        print(dump_schema())
+        return 0
+
+    from db import engine
+    if args.command == "upgrade":
+        print(f"schema version: {upgrade(engine)}")
+    elif args.command == "status":
+        print(f"schema version: {current_version(engine)} / {STEPS[-1][0]}")
+        for v, name in pending(engine):
+            print(f"  pending [{v}] {name}")
+    else:
+        bad = check_plans(engine)
+        for name in HOT_QUERIES:
+            print(f"{'SEQ SCAN' if name in bad else 'ok':<8} {name}" + (f": {', '.join(bad[name])}" if name in bad else ""))
+        return 1 if bad else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
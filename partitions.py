@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# partitions.py — помесячное партиционирование message (Postgres, declarative RANGE по date)
+#
+# Уникальность: в партиционированной таблице уникальный ключ обязан включать ключ
+# партиции, поэтому вместо (chat_id, message_id) используется (chat_id, message_id, date).
+# Дата сообщения в Telegram не меняется, так что повторная вставка того же
+# сообщения попадает в ту же партицию и ловится ON CONFLICT — см. message_conflict_cols().
+# Строки вне помесячных партиций (старая история нового чата, месяцы, снятые retention)
+# попадают в message_default; при создании партиции месяца его строки из неё переносятся.
+#
+#   python partitions.py convert           # перевести существующую message в партиционированную
+#   python partitions.py maintain          # создать будущие партиции + применить retention
+#   python partitions.py list
+
+import argparse
+import re
+import sys
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+PART_RE = re.compile(r"^message_y(\d{4})m(\d{2})$")
+DEFAULT_PART = "message_default"
+COPY_BATCH = 100_000
+COPY_COLUMNS = "id, chat_id, message_id, account_id, user_id, date, text, text_hash"
+
+DEFAULTS = {"enabled": False, "months_ahead": 3, "retention_months": 0, "retention_action": "detach"}
+
+
+def settings(cfg: dict) -> dict:
+    """storage.partitioning из config.yaml с значениями по умолчанию."""
+    return {**DEFAULTS, **((cfg.get("storage") or {}).get("partitioning") or {})}
+
+
+def _month_start(year: int, month: int) -> datetime:
+    # границы месяцев — по Бухаресту, как и все даты в панели
+    return datetime(year, month, 1, tzinfo=BUCHAREST_TZ)
+
+
+def _add_months(year: int, month: int, n: int) -> tuple[int, int]:
+    idx = year * 12 + (month - 1) + n
+    return idx // 12, idx % 12 + 1
+
+
+def partition_name(year: int, month: int) -> str:
+    return f"message_y{year:04d}m{month:02d}"
+
+
+def is_partitioned(conn) -> bool:
+    return bool(conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = 'message')"
+    )).scalar())
+
+
+def message_conflict_cols(engine) -> list[str]:
+    """Колонки ON CONFLICT для вставки сообщений под текущую схему таблицы."""
+    if engine.dialect.name != "postgresql":
+        return ["chat_id", "message_id"]
+    with engine.connect() as conn:
+        return ["chat_id", "message_id", "date"] if is_partitioned(conn) else ["chat_id", "message_id"]
+
+
+def partition_tables(conn, parent: str = "message") -> list[str]:
+    """Все партиции таблицы, включая DEFAULT."""
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :p ORDER BY c.relname"
+    ), {"p": parent}).scalars().all()
+
+
+def list_partitions(conn) -> list[tuple[str, int, int]]:
+    """Помесячные партиции message: [(имя, год, месяц)] по возрастанию."""
+    out = []
+    for name in partition_tables(conn):
+        m = PART_RE.match(name)
+        if m:
+            out.append((name, int(m.group(1)), int(m.group(2))))
+    return sorted(out, key=lambda x: (x[1], x[2]))
+
+
+def ensure_default_partition(conn) -> bool:
+    """message_default для строк вне помесячных партиций. True — создана сейчас."""
+    if conn.execute(text("SELECT to_regclass(:n) IS NOT NULL"), {"n": DEFAULT_PART}).scalar():
+        return False
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PART} PARTITION OF message DEFAULT"))
+    return True
+
+
+def create_partition(conn, year: int, month: int) -> str:
+    """Партиция месяца. Если в message_default уже есть строки этого месяца, DEFAULT на время
+    отцепляется и строки переносятся в новую партицию (иначе CREATE … PARTITION OF упадёт)."""
+    name = partition_name(year, month)
+    ny, nm = _add_months(year, month, 1)
+    bounds = {"lo": _month_start(year, month), "hi": _month_start(ny, nm)}
+    create = (f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF message "
+              f"FOR VALUES FROM ('{bounds['lo'].isoformat()}') TO ('{bounds['hi'].isoformat()}')")
+    has_default = conn.execute(text("SELECT to_regclass(:n) IS NOT NULL"), {"n": DEFAULT_PART}).scalar()
+    if not has_default or not conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PART} WHERE date >= :lo AND date < :hi)"
+    ), bounds).scalar():
+        conn.execute(text(create))
+        return name
+    conn.execute(text(f"ALTER TABLE message DETACH PARTITION {DEFAULT_PART}"))
+    conn.execute(text(create))
+    conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PART} WHERE date >= :lo AND date < :hi RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), bounds)
+    conn.execute(text(f"ALTER TABLE message ATTACH PARTITION {DEFAULT_PART} DEFAULT"))
+    return name
+
+
+def ensure_partitions(engine, months_ahead: int = 3) -> list[str]:
+    """Партиции от текущего месяца на months_ahead вперёд (идемпотентно)."""
+    now = datetime.now(BUCHAREST_TZ)
+    created = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        if ensure_default_partition(conn):
+            created.append(DEFAULT_PART)
+        existing = {name for name, _, _ in list_partitions(conn)}
+        for i in range(months_ahead + 1):
+            y, m = _add_months(now.year, now.month, i)
+            if partition_name(y, m) not in existing:
+                created.append(create_partition(conn, y, m))
+    return created
+
+
+def apply_retention(engine, retention_months: int, action: str = "detach") -> list[str]:
+    """Отцепляет (detach) или удаляет (drop) партиции старше retention_months.
+    Сообщения этих месяцев, догруженные позже, попадут в message_default."""
+    if not retention_months or retention_months <= 0:
+        return []
+    now = datetime.now(BUCHAREST_TZ)
+    cy, cm = _add_months(now.year, now.month, -retention_months)
+    affected = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        for name, y, m in list_partitions(conn):
+            if (y, m) >= (cy, cm):
+                break
+            conn.execute(text(f"ALTER TABLE message DETACH PARTITION {name}"))
+            if action == "drop":
+                conn.execute(text(f"DROP TABLE {name}"))
+            affected.append(name)
+    return affected
+
+
+def create_index_online(engine, name: str, table: str, definition: str) -> None:
+    """CREATE INDEX CONCURRENTLY, в том числе для партиционированной таблицы:
+    родительский индекс создаётся ON ONLY, индексы партиций — CONCURRENTLY и
+    затем присоединяются (у партиционированной таблицы CONCURRENTLY не поддерживается).
+    definition — всё после имени таблицы, например "USING gin (text_tsv)".
+    Повторный вызов после сбоя продолжает: невалидный индекс (прерванный CONCURRENTLY)
+    пересоздаётся, у родительского — присоединяются недостающие партиции.
+    """
+    with engine.connect() as conn:
+        partitioned = table == "message" and is_partitioned(conn)
+        parts = partition_tables(conn) if partitioned else []
+        valid = _index_valid(conn, name)
+        attached = set(conn.execute(text(
+            "SELECT t.relname FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid "
+            "JOIN pg_class t ON t.oid = x.indrelid WHERE i.inhparent = to_regclass(:n)"
+        ), {"n": name}).scalars().all()) if partitioned and valid is not None else set()
+    if valid:
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not partitioned:
+            if valid is False:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}"))
+            return
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}"))
+        for part in parts:
+            if part in attached:
+                continue
+            pidx = f"{part}_{name.removeprefix('ix_message_')}"
+            if _index_valid(conn, pidx) is False:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {pidx}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {pidx} ON {part} {definition}"))
+            conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {pidx}"))
+
+
+def _index_valid(conn, name: str):
+    """pg_index.indisvalid: True/False, None — индекса нет."""
+    return conn.execute(text(
+        "SELECT x.indisvalid FROM pg_index x WHERE x.indexrelid = to_regclass(:n)"
+    ), {"n": name}).scalar()
+
+
+def maintain(engine, cfg: dict) -> tuple[list[str], list[str]]:
+    """Вызывается воркером при старте: будущие партиции + retention."""
+    s = settings(cfg)
+    if not s["enabled"] or engine.dialect.name != "postgresql":
+        return [], []
+    created = ensure_partitions(engine, int(s["months_ahead"]))
+    removed = apply_retention(engine, int(s["retention_months"]), s["retention_action"])
+    return created, removed
+
+
+def convert(engine, months_ahead: int = 3, batch: int = COPY_BATCH) -> None:
+    """Переводит обычную message в партиционированную без длительной блокировки:
+    копирование пачками по id в message_p, затем короткое переключение имён.
+    Все изменения message после начала копирования (вставки, в том числе поздно
+    закоммиченные ниже уже скопированных id, UPDATE и DELETE) триггер пишет в message_p_delta;
+    они применяются пачками после копирования и остатком — под блокировкой переключения.
+    Поиск переносится вместе с таблицей: колонка text_tsv (копируется как есть), триггер
+    trg_message_tsv и GIN-индексы ix_message_text_tsv / ix_message_text_trgm, если они были.
+    Старая таблица остаётся как message_unpartitioned.
+    """
+    from migrations import model_indexes
+    import search
+
+    definitions = {name: d for name, _, d in model_indexes(engine, "message")}
+
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            print("message уже партиционирована.")
+            return
+        columns = dict(conn.execute(text(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'message'"
+        )).all())
+        if columns.get("date") != "timestamp with time zone":
+            raise SystemExit("message.date ещё не timestamptz — сначала выполните migrate_v3.py")
+        has_tsv = "text_tsv" in columns
+        if has_tsv:
+            definitions["ix_message_text_tsv"] = search.TSV_INDEX
+        if conn.execute(text("SELECT to_regclass('ix_message_text_trgm') IS NOT NULL")).scalar():
+            definitions["ix_message_text_trgm"] = search.MESSAGE_TRGM_INDEX
+        msg_indexes = list(definitions)
+        cols = COPY_COLUMNS + (", text_tsv" if has_tsv else "")
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS message_p (
+                id          BIGINT NOT NULL DEFAULT nextval('message_id_seq'),
+                chat_id     BIGINT NOT NULL REFERENCES chat(chat_id) ON DELETE CASCADE,
+                message_id  BIGINT NOT NULL,
+                account_id  INTEGER REFERENCES account(id) ON DELETE SET NULL,
+                user_id     BIGINT REFERENCES "user"(user_id) ON DELETE SET NULL,
+                date        TIMESTAMPTZ NOT NULL,
+                text        TEXT,
+                text_hash   VARCHAR(32),
+                {"text_tsv    TSVECTOR," if has_tsv else ""}
+                PRIMARY KEY (id, date),
+                CONSTRAINT uq_message_chat_msg_date UNIQUE (chat_id, message_id, date)
+            ) PARTITION BY RANGE (date)
+        """))
+        # индексы — те же, что описаны в модели Message (db.py), и поисковые
+        for name in msg_indexes:
+            pname = name.replace("ix_message_", "ix_message_p_", 1)
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {pname} ON message_p {definitions[name]}"))
+        lo_dt = conn.execute(text("SELECT min(date) FROM message")).scalar()
+
+        # партиции за всю историю + вперёд
+        now = datetime.now(BUCHAREST_TZ)
+        start = (lo_dt or now).astimezone(BUCHAREST_TZ)
+        y, m = start.year, start.month
+        last = _add_months(now.year, now.month, months_ahead)
+        while (y, m) <= last:
+            name = partition_name(y, m).replace("message_", "message_p_", 1)
+            ny, nm = _add_months(y, m, 1)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF message_p "
+                f"FOR VALUES FROM ('{_month_start(y, m).isoformat()}') TO ('{_month_start(ny, nm).isoformat()}')"
+            ))
+            y, m = ny, nm
+        conn.execute(text("CREATE TABLE IF NOT EXISTS message_p_default PARTITION OF message_p DEFAULT"))
+
+        # журнал изменений: CREATE TRIGGER ждёт завершения открытых транзакций записи,
+        # так что всё, что закоммичено позже, попадёт либо в копию, либо в журнал
+        conn.execute(text("CREATE TABLE IF NOT EXISTS message_p_delta (seq BIGSERIAL PRIMARY KEY, id BIGINT NOT NULL)"))
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION message_p_delta_log() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO message_p_delta (id) VALUES (OLD.id);
+                ELSE
+                    INSERT INTO message_p_delta (id) VALUES (NEW.id);
+                    IF TG_OP = 'UPDATE' AND OLD.id <> NEW.id THEN
+                        INSERT INTO message_p_delta (id) VALUES (OLD.id);
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS trg_message_p_delta ON message"))
+        conn.execute(text(
+            "CREATE TRIGGER trg_message_p_delta AFTER INSERT OR UPDATE OR DELETE ON message "
+            "FOR EACH ROW EXECUTE FUNCTION message_p_delta_log()"
+        ))
+    with engine.connect() as conn:
+        lo_id, hi_id = conn.execute(text("SELECT min(id), max(id) FROM message")).one()
+
+    if hi_id is not None:
+        for a in range(lo_id, hi_id + 1, batch):
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f"INSERT INTO message_p ({cols}) SELECT {cols} FROM message "
+                    "WHERE id >= :a AND id < :b AND date IS NOT NULL ON CONFLICT DO NOTHING"
+                ), {"a": a, "b": a + batch})
+            print(f"copied id <= {min(a + batch - 1, hi_id)} / {hi_id}")
+
+    # журнал изменений — пачками, пока он не станет коротким
+    applied = 0
+    while True:
+        with engine.begin() as conn:
+            n, applied = _apply_delta(conn, cols, applied, batch)
+        if n < batch:
+            break
+
+    # переключение: остаток журнала и имена — под блокировкой записи
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        conn.execute(text("LOCK TABLE message IN SHARE ROW EXCLUSIVE MODE"))
+        _apply_delta(conn, cols, applied)
+        conn.execute(text("DROP TRIGGER trg_message_p_delta ON message"))
+        conn.execute(text("DROP FUNCTION message_p_delta_log()"))
+        conn.execute(text("DROP TABLE message_p_delta"))
+        conn.execute(text("ALTER TABLE message RENAME TO message_unpartitioned"))
+        conn.execute(text("ALTER TABLE message_p RENAME TO message"))
+        conn.execute(text("ALTER SEQUENCE message_id_seq OWNED BY message.id"))
+        for name in conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'message'"
+        )).scalars().all():
+            conn.execute(text(f"ALTER TABLE {name} RENAME TO {name.replace('message_p_', 'message_', 1)}"))
+        for name in msg_indexes:
+            old = name.replace("ix_message_", "ix_message_unpartitioned_", 1)
+            conn.execute(text(f"ALTER INDEX IF EXISTS {name} RENAME TO {old}"))
+            conn.execute(text(f"ALTER INDEX {name.replace('ix_message_', 'ix_message_p_', 1)} RENAME TO {name}"))
+        if has_tsv:
+            search.create_tsv_trigger(conn)  # на партиционированной таблице — для всех партиций
+    with engine.connect() as conn:
+        has_view = conn.execute(text("SELECT to_regclass('message_full') IS NOT NULL")).scalar()
+    if has_view:
+        # view ссылается на таблицу, а не на имя — переключаем на новую message
+        from textstore import create_view
+        create_view(engine)
+    print("message переведена на помесячные партиции (старая таблица: message_unpartitioned).")
+
+
+def _apply_delta(conn, cols: str, after: int, limit: int = None) -> tuple[int, int]:
+    """Переносит в message_p строки из журнала message_p_delta с seq > after: копия строки
+    удаляется и вставляется заново из message (удалённые в message — просто удаляются).
+    Возвращает (записей журнала, последний seq)."""
+    last = conn.execute(text(
+        "SELECT max(seq), count(*) FROM (SELECT seq FROM message_p_delta WHERE seq > :a ORDER BY seq"
+        + (" LIMIT :n" if limit else "") + ") d"
+    ), {"a": after, "n": limit}).one()
+    hi, n = last
+    if not n:
+        return 0, after
+    ids = "SELECT id FROM message_p_delta WHERE seq > :a AND seq <= :b"
+    conn.execute(text(f"DELETE FROM message_p WHERE id IN ({ids})"), {"a": after, "b": hi})
+    conn.execute(text(
+        f"INSERT INTO message_p ({cols}) SELECT {cols} FROM message "
+        f"WHERE id IN ({ids}) AND date IS NOT NULL ON CONFLICT DO NOTHING"
+    ), {"a": after, "b": hi})
+    return n, hi
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Партиции таблицы message")
+    ap.add_argument("command", choices=["convert", "maintain", "list"])
+    args = ap.parse_args(argv)
+
+    from db import engine
+    s = settings(read_config())
+    if args.command == "convert":
+        convert(engine, int(s["months_ahead"]))
+    elif args.command == "maintain":
+        print("created:", ensure_partitions(engine, int(s["months_ahead"])))
+        print(f"{s['retention_action']}:", apply_retention(engine, int(s["retention_months"]), s["retention_action"]))
+    else:
+        with engine.connect() as conn:
+            for name, *_ in list_partitions(conn):
+                print(name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,68 +1,229 @@
+-- postgres_schema.sql — сгенерировано из db.py: python migrations.py dump-schema
+-- Не редактировать вручную. Полнотекстовый/trigram-поиск и партиции
+-- добавляются отдельно: search.py install-fts / install-trgm, partitions.py convert.
+
 CREATE TABLE IF NOT EXISTS account (
-  id BIGSERIAL PRIMARY KEY,
-  session_name TEXT NOT NULL,
-  display_name TEXT,
-  description TEXT,
-  roles TEXT,
-  created_at TIMESTAMPTZ
-);
-CREATE TABLE IF NOT EXISTS users (
-  user_id      BIGINT PRIMARY KEY,
-  username     TEXT,
-  first_name   TEXT,
-  last_name    TEXT,
-  last_seen_at TIMESTAMPTZ,
-  is_bot       BOOLEAN
-);
-CREATE TABLE IF NOT EXISTS chats (
-  chat_id BIGINT PRIMARY KEY,
-  title   TEXT,
-  type    TEXT,
-  is_group BOOLEAN,
-  is_channel BOOLEAN,
-  country TEXT,
-  topics  TEXT,
-  languages TEXT
+	id SERIAL NOT NULL, 
+	session_name VARCHAR(255) NOT NULL, 
+	display_name VARCHAR(255), 
+	description TEXT, 
+	roles VARCHAR(255), 
+	created_at VARCHAR(64), 
+	meta_refreshed_at VARCHAR(64), 
+	PRIMARY KEY (id)
 );
+CREATE INDEX IF NOT EXISTS ix_account_id ON account (id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_account_session_name ON account (session_name);
+
+CREATE TABLE IF NOT EXISTS chat (
+	chat_id BIGINT NOT NULL, 
+	title VARCHAR(512), 
+	type VARCHAR(64), 
+	is_group BOOLEAN, 
+	is_channel BOOLEAN, 
+	PRIMARY KEY (chat_id)
+);
+CREATE INDEX IF NOT EXISTS ix_chat_is_channel ON chat (is_channel);
+CREATE INDEX IF NOT EXISTS ix_chat_is_group ON chat (is_group);
+CREATE INDEX IF NOT EXISTS ix_chat_title_cover ON chat (title) INCLUDE (chat_id, type, is_group, is_channel);
+
+CREATE TABLE IF NOT EXISTS chatstats (
+	chat_id BIGINT NOT NULL, 
+	messages BIGINT NOT NULL, 
+	users BIGINT NOT NULL, 
+	chats BIGINT NOT NULL, 
+	channels BIGINT NOT NULL, 
+	groups BIGINT NOT NULL, 
+	last_message_at TIMESTAMP WITH TIME ZONE, 
+	reconciled_at VARCHAR(64), 
+	PRIMARY KEY (chat_id)
+);
+
+CREATE TABLE IF NOT EXISTS dialog (
+	session_name VARCHAR(255) NOT NULL, 
+	dialog_id BIGINT NOT NULL, 
+	title VARCHAR(512), 
+	username VARCHAR(255), 
+	kind VARCHAR(16), 
+	last_message_at TIMESTAMP WITH TIME ZONE, 
+	updated_at TIMESTAMP WITH TIME ZONE, 
+	PRIMARY KEY (session_name, dialog_id)
+);
+CREATE INDEX IF NOT EXISTS ix_dialog_session_last ON dialog (session_name, last_message_at DESC);
+
+CREATE TABLE IF NOT EXISTS feedoffset (
+	consumer VARCHAR(64) NOT NULL, 
+	seq BIGINT NOT NULL, 
+	updated_at VARCHAR(64), 
+	PRIMARY KEY (consumer)
+);
+
+CREATE TABLE IF NOT EXISTS messagefeed (
+	seq BIGSERIAL NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	message_id BIGINT NOT NULL, 
+	date TIMESTAMP WITH TIME ZONE, 
+	created_at TIMESTAMP WITH TIME ZONE, 
+	PRIMARY KEY (seq)
+);
+
+CREATE TABLE IF NOT EXISTS messagetext (
+	text_hash VARCHAR(32) NOT NULL, 
+	text TEXT NOT NULL, 
+	length INTEGER, 
+	created_at TIMESTAMP WITH TIME ZONE, 
+	PRIMARY KEY (text_hash)
+);
+
+CREATE TABLE IF NOT EXISTS schemaversion (
+	version INTEGER NOT NULL, 
+	name VARCHAR(128) NOT NULL, 
+	applied_at VARCHAR(64), 
+	PRIMARY KEY (version)
+);
+
+CREATE TABLE IF NOT EXISTS "user" (
+	user_id BIGINT NOT NULL, 
+	username VARCHAR(255), 
+	first_name VARCHAR(255), 
+	last_name VARCHAR(255), 
+	is_bot BOOLEAN, 
+	PRIMARY KEY (user_id)
+);
+CREATE INDEX IF NOT EXISTS ix_user_username ON "user" (username);
+
 CREATE TABLE IF NOT EXISTS accountchat (
-  account_id BIGINT,
-  chat_id BIGINT,
-  PRIMARY KEY (account_id, chat_id)
+	account_id INTEGER NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	PRIMARY KEY (account_id, chat_id), 
+	FOREIGN KEY(account_id) REFERENCES account (id) ON DELETE CASCADE, 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
 );
+
+CREATE TABLE IF NOT EXISTS activityrollup (
+	chat_id BIGINT NOT NULL, 
+	grain VARCHAR(1) NOT NULL, 
+	bucket TIMESTAMP WITH TIME ZONE NOT NULL, 
+	messages BIGINT NOT NULL, 
+	posters INTEGER NOT NULL, 
+	bot_messages BIGINT NOT NULL, 
+	text_chars BIGINT NOT NULL, 
+	PRIMARY KEY (chat_id, grain, bucket), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_activityrollup_grain_bucket ON activityrollup (grain, bucket);
+
 CREATE TABLE IF NOT EXISTS chatbot (
-  chat_id BIGINT,
-  bot_user_id BIGINT,
-  PRIMARY KEY (chat_id, bot_user_id)
+	chat_id BIGINT NOT NULL, 
+	bot_user_id BIGINT NOT NULL, 
+	PRIMARY KEY (chat_id, bot_user_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE, 
+	FOREIGN KEY(bot_user_id) REFERENCES "user" (user_id) ON DELETE CASCADE
 );
-CREATE TABLE IF NOT EXISTS directpeer (
-  account_id BIGINT,
-  user_id BIGINT,
-  PRIMARY KEY (account_id, user_id)
-);
-CREATE TABLE IF NOT EXISTS messages (
-  chat_id     BIGINT NOT NULL,
-  message_id  BIGINT NOT NULL,
-  account_id  BIGINT,
-  user_id     BIGINT,
-  date        TIMESTAMPTZ NOT NULL,
-  text        TEXT,
-  PRIMARY KEY (chat_id, message_id)
+
+CREATE TABLE IF NOT EXISTS chatlanguage (
+	id SERIAL NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	language VARCHAR(64), 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
 );
+CREATE INDEX IF NOT EXISTS ix_chatlanguage_chat_id ON chatlanguage (chat_id);
+CREATE INDEX IF NOT EXISTS ix_chatlanguage_language ON chatlanguage (language);
+
+CREATE TABLE IF NOT EXISTS chatmember (
+	chat_id BIGINT NOT NULL, 
+	user_id BIGINT NOT NULL, 
+	role VARCHAR(32), 
+	last_seen_at VARCHAR(64), 
+	PRIMARY KEY (chat_id, user_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE, 
+	FOREIGN KEY(user_id) REFERENCES "user" (user_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_chatmember_user_id ON chatmember (user_id);
+
+CREATE TABLE IF NOT EXISTS chatmeta (
+	chat_id BIGINT NOT NULL, 
+	country VARCHAR(64), 
+	fts_config VARCHAR(64), 
+	fts_indexed VARCHAR(64), 
+	PRIMARY KEY (chat_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS chattopic (
+	id SERIAL NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	topic VARCHAR(128), 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_chattopic_chat_id ON chattopic (chat_id);
+CREATE INDEX IF NOT EXISTS ix_chattopic_topic ON chattopic (topic);
+
 CREATE TABLE IF NOT EXISTS cursor (
-  chat_id            BIGINT PRIMARY KEY,
-  oldest_fetched_id  BIGINT NOT NULL,
-  newest_fetched_id  BIGINT NOT NULL,
-  updated_at         TIMESTAMPTZ DEFAULT NOW()
-);
-CREATE TABLE IF NOT EXISTS window (
-  id BIGSERIAL PRIMARY KEY,
-  chat_id BIGINT NOT NULL,
-  min_id BIGINT,
-  max_id BIGINT,
-  status TEXT DEFAULT 'queued',
-  taken_by TEXT,
-  note TEXT
-);
-CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date DESC);
-CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id);
-CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_id, date DESC);
+	chat_id BIGINT NOT NULL, 
+	oldest_fetched_id BIGINT, 
+	newest_fetched_id BIGINT, 
+	PRIMARY KEY (chat_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS directpeer (
+	account_id INTEGER NOT NULL, 
+	user_id BIGINT NOT NULL, 
+	PRIMARY KEY (account_id, user_id), 
+	FOREIGN KEY(account_id) REFERENCES account (id) ON DELETE CASCADE, 
+	FOREIGN KEY(user_id) REFERENCES "user" (user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS message (
+	id SERIAL NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	message_id BIGINT NOT NULL, 
+	account_id INTEGER, 
+	user_id BIGINT, 
+	date TIMESTAMP WITH TIME ZONE, 
+	text TEXT, 
+	text_hash VARCHAR(32), 
+	PRIMARY KEY (id), 
+	CONSTRAINT uq_message_chat_msg UNIQUE (chat_id, message_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE, 
+	FOREIGN KEY(account_id) REFERENCES account (id) ON DELETE SET NULL, 
+	FOREIGN KEY(user_id) REFERENCES "user" (user_id) ON DELETE SET NULL
+);
+CREATE INDEX IF NOT EXISTS ix_message_chat_date ON message (chat_id, date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_message_date ON message (date);
+CREATE INDEX IF NOT EXISTS ix_message_text_hash ON message (text_hash);
+CREATE INDEX IF NOT EXISTS ix_message_user_date ON message (user_id, date DESC, id DESC);
+
+CREATE TABLE IF NOT EXISTS participantsstate (
+	chat_id BIGINT NOT NULL, 
+	participants_count BIGINT, 
+	first_page_hash BIGINT, 
+	refreshed_at VARCHAR(64), 
+	PRIMARY KEY (chat_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS posterrollup (
+	chat_id BIGINT NOT NULL, 
+	day TIMESTAMP WITH TIME ZONE NOT NULL, 
+	user_id BIGINT NOT NULL, 
+	messages INTEGER NOT NULL, 
+	PRIMARY KEY (chat_id, day, user_id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE, 
+	FOREIGN KEY(user_id) REFERENCES "user" (user_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_posterrollup_day ON posterrollup (day);
+
+CREATE TABLE IF NOT EXISTS "window" (
+	id SERIAL NOT NULL, 
+	chat_id BIGINT NOT NULL, 
+	min_id BIGINT, 
+	max_id BIGINT, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(chat_id) REFERENCES chat (chat_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_window_chat_id ON "window" (chat_id);
+
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# rollup.py — активность чатов по часам и суткам (activityrollup, posterrollup)
+#
+# Строка на (чат, час) и (чат, сутки) по Бухаресту: сообщений, писавших, от ботов и символов
+# текста (средняя длина = text_chars / messages); posterrollup — сообщений автора за сутки.
+# Графики и «Аналитика» панели читают только эти таблицы.
+#
+# Единица пересчёта — сутки чата: его часы и сами сутки заново считаются из message
+# (диапазон по ix_message_chat_date), так что пересчёт идемпотентен, а «писавшие» точны.
+# Какие сутки затронуты новыми строками, rollup узнаёт из ленты messagefeed (потребитель
+# "rollup", см. feed.py); воркер дочитывает её раз в limits.rollup_interval_sec.
+# backfill строит таблицу по уже сохранённым данным параллельно, кусками «чат × месяц».
+#
+#   python rollup.py backfill --workers 4
+#   python rollup.py refresh
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import delete, func
+from sqlmodel import select
+
+from db import ActivityRollup, Message, MessageFeed, MessageText, PosterRollup, User
+import feed
+import storage
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+CONSUMER = "rollup"
+WORKERS = 4
+DEFAULT_INTERVAL_SEC = 300
+
+
+def interval_sec(cfg: dict) -> float:
+    return float((cfg.get("limits") or {}).get("rollup_interval_sec", DEFAULT_INTERVAL_SEC))
+
+
+def _hour(bind):
+    # Бухарест смещён от UTC на целые часы: границы часа в UTC и по местному времени совпадают
+    if storage.is_postgres(bind):
+        return func.date_trunc("hour", Message.date)
+    return func.strftime("%Y-%m-%d %H:00:00", Message.date)
+
+
+def _as_utc(v) -> datetime:
+    if isinstance(v, str):  # SQLite: UTC без зоны
+        return datetime.fromisoformat(v).replace(tzinfo=timezone.utc)
+    return v.astimezone(timezone.utc)
+
+
+def day_start(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day, tzinfo=BUCHAREST_TZ)
+
+
+def compute(sess, chat_id: int, lo: datetime, hi: datetime) -> tuple[list[dict], list[dict]]:
+    """Строки activityrollup и posterrollup чата за [lo, hi); lo и hi — начала суток по Бухаресту."""
+    h = _hour(sess).label("h")
+    res = sess.exec(
+        select(h, Message.user_id, func.count(), func.count().filter(User.is_bot == True),
+               func.sum(func.coalesce(func.length(Message.text), MessageText.length, 0)))
+        .outerjoin(User, User.user_id == Message.user_id)
+        .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)
+        .where(Message.chat_id == chat_id, Message.date >= lo, Message.date < hi)
+        .group_by(h, Message.user_id)
+    ).all()
+    # (час, автор) -> сумма по часам и суткам; писавшие суток — объединение авторов часов
+    acc, posters = {}, {}
+    for hour, uid, n, bots, chars in res:
+        hour = _as_utc(hour).astimezone(BUCHAREST_TZ)
+        day = day_start(hour.date())
+        if uid is not None:
+            posters[(day, uid)] = posters.get((day, uid), 0) + n
+        for key in (("h", hour), ("d", day)):
+            a = acc.setdefault(key, {"messages": 0, "bot_messages": 0, "text_chars": 0, "users": set()})
+            a["messages"] += n
+            a["bot_messages"] += bots or 0
+            a["text_chars"] += chars or 0
+            if uid is not None:
+                a["users"].add(uid)
+    rows = [
+        {"chat_id": chat_id, "grain": g, "bucket": b, "messages": a["messages"], "posters": len(a["users"]),
+         "bot_messages": a["bot_messages"], "text_chars": a["text_chars"]}
+        for (g, b), a in acc.items()
+    ]
+    return rows, [{"chat_id": chat_id, "day": d, "user_id": u, "messages": n} for (d, u), n in posters.items()]
+
+
+def rebuild(chat_id: int, lo: datetime, hi: datetime, posters_only: bool = False) -> int:
+    """Пересчитывает часы и сутки чата за [lo, hi) (posters_only — только posterrollup).
+    Возвращает число сообщений."""
+    from db import get_session
+    with get_session() as sess:
+        rows, posters = compute(sess, chat_id, lo, hi)
+        if not posters_only:
+            sess.exec(delete(ActivityRollup).where(
+                ActivityRollup.chat_id == chat_id, ActivityRollup.bucket >= lo, ActivityRollup.bucket < hi
+            ))
+            storage.insert_ignore(sess, ActivityRollup.__table__, rows)
+        sess.exec(delete(PosterRollup).where(
+            PosterRollup.chat_id == chat_id, PosterRollup.day >= lo, PosterRollup.day < hi
+        ))
+        storage.insert_ignore(sess, PosterRollup.__table__, posters)
+        sess.commit()
+    return sum(r["messages"] for r in rows if r["grain"] == "d")
+
+
+# ------------------------------------------------------------------------------
+# Инкрементально (по ленте) и backfill
+# ------------------------------------------------------------------------------
+def refresh(engine, batch: int = 5_000) -> int:
+    """Пересчитывает сутки, в которые попали новые сообщения. Возвращает число пересчитанных суток."""
+    consumer = feed.FeedConsumer(CONSUMER, batch=batch, engine=engine)
+    done = 0
+    while True:
+        rows = consumer.read()
+        if not rows:
+            return done
+        days = {(r["chat_id"], r["date"].astimezone(BUCHAREST_TZ).date()) for r in rows if r["date"]}
+        for chat_id, d in sorted(days):
+            rebuild(chat_id, day_start(d), day_start(d + timedelta(days=1)))
+        done += len(days)
+        consumer.commit(rows[-1]["seq"])
+
+
+def _months(first: datetime, last: datetime):
+    d = first.astimezone(BUCHAREST_TZ).date().replace(day=1)
+    end = last.astimezone(BUCHAREST_TZ).date()
+    while d <= end:
+        nxt = (d.replace(year=d.year + 1, month=1) if d.month == 12 else d.replace(month=d.month + 1))
+        yield day_start(d), day_start(nxt)
+        d = nxt
+
+
+def backfill(engine, workers: int = WORKERS, posters_only: bool = False) -> int:
+    """Строит activityrollup и posterrollup по всей message, кусками «чат × месяц» в workers потоков.
+    posters_only — только posterrollup (activityrollup уже построен)."""
+    from db import get_session
+    with get_session() as sess:
+        # всё, что попадёт в ленту после этой точки, дочитает refresh
+        head = sess.exec(select(func.coalesce(func.max(MessageFeed.seq), 0))).one()
+        spans = sess.exec(
+            select(Message.chat_id, func.min(Message.date), func.max(Message.date))
+            .where(Message.date.is_not(None))
+            .group_by(Message.chat_id)
+        ).all()
+    chunks = [(c, lo, hi) for c, first, last in spans for lo, hi in _months(first, last)]
+    print(f"rollup backfill: {len(spans)} чатов, {len(chunks)} кусков")
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for i, n in enumerate(pool.map(lambda ch: rebuild(*ch, posters_only=posters_only), chunks), 1):
+            total += n
+            if i % 100 == 0 or i == len(chunks):
+                print(f"rollup backfill: {i}/{len(chunks)}, сообщений {total}")
+
+    consumer = feed.FeedConsumer(CONSUMER, engine=engine)
+    if consumer.position() < head:
+        consumer.commit(head)
+    return total
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Агрегаты активности чатов по часам и суткам")
+    ap.add_argument("command", choices=["backfill", "refresh"])
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    args = ap.parse_args(argv)
+
+    from db import engine
+    if args.command == "backfill":
+        workers = args.workers if storage.is_postgres(engine) else 1  # SQLite пишет один поток
+        print(f"rollup: сообщений {backfill(engine, workers)}")
+    else:
+        print(f"rollup: пересчитано суток {refresh(engine)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
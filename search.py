@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# search.py — поиск по сообщениям и контактам (Postgres)
+#
+# 1) Полнотекстовый: message.text_tsv заполняется триггером при вставке/изменении текста.
+#    Конфигурации словарей берутся из chatmeta.fts_config (список через запятую,
+#    напр. "russian,romanian"), который выводится из языков чата — см. fts_config_for().
+# 2) Подстрока/нечёткий: GIN-индексы pg_trgm по message.text и именам пользователей —
+#    ускоряют ILIKE '%…%' (телефоны, ссылки, части ников) и поиск по похожести.
+#
+#   python search.py install-fts     # колонка, триггер, backfill пачками, GIN CONCURRENTLY
+#   python search.py install-trgm    # pg_trgm + GIN-индексы CONCURRENTLY (запись не блокируется)
+#   python search.py sync-configs    # пересчитать chatmeta.fts_config из языков чатов
+#   python search.py reindex         # переиндексировать чаты, у которых сменилась fts_config
+
+import argparse
+import re
+import sys
+
+from sqlalchemy import cast, func, literal, text
+from sqlalchemy.dialects.postgresql import REGCONFIG, TSVECTOR
+from sqlalchemy.sql import literal_column
+
+DEFAULT_FTS_CONFIG = "russian"
+TSV_INDEX = "USING gin (text_tsv)"
+BACKFILL_BATCH = 50_000
+REINDEX_BATCH = 5_000
+REINDEX_LOCK_KEY = 0x74677278  # pg_advisory_lock: одна переиндексация за раз
+DEFAULT_REINDEX_INTERVAL_SEC = 600
+HEADLINE_OPTS = "StartSel=«, StopSel=», MaxFragments=2, MaxWords=18, MinWords=6, FragmentDelimiter= … "
+
+# названия языков из languages.yaml (в нижнем регистре) -> конфигурация Postgres.
+# Для украинского в стандартной поставке нет стеммера; если установлен словарь
+# (hunspell, конфигурация "ukrainian") — используется он, иначе русский snowball.
+LANGUAGE_CONFIGS = {
+    "русский": "russian",
+    "украинский": "ukrainian",
+    "румынский": "romanian",
+    "молдавский": "romanian",
+    "английский": "english",
+    "немецкий": "german",
+    "французский": "french",
+    "итальянский": "italian",
+    "испанский": "spanish",
+    "турецкий": "turkish",
+}
+CONFIG_FALLBACKS = {"ukrainian": "russian"}
+
+# колонка вне модели Message: тип tsvector есть только в Postgres
+text_tsv = literal_column("message.text_tsv", TSVECTOR)
+_TOKEN_RE = re.compile(r'"([^"]+)"|(\S+)')
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+# ------------------------------------------------------------------------------
+# Конфигурации языков
+# ------------------------------------------------------------------------------
+def available_configs(conn) -> set[str]:
+    return set(conn.execute(text("SELECT cfgname FROM pg_ts_config")).scalars().all())
+
+
+def fts_config_for(languages, available=None) -> str:
+    """Языки чата -> "russian,romanian". Пустой список -> конфигурация по умолчанию."""
+    out = []
+    for lang in languages or []:
+        cfg = LANGUAGE_CONFIGS.get(str(lang).strip().lower())
+        if cfg and available is not None and cfg not in available:
+            cfg = CONFIG_FALLBACKS.get(cfg)
+        if cfg and cfg not in out:
+            out.append(cfg)
+    return ",".join(out) or DEFAULT_FTS_CONFIG
+
+
+def sync_chat_configs(engine) -> int:
+    """Проставляет chatmeta.fts_config всем чатам по их языкам. Возвращает число изменённых."""
+    from sqlmodel import Session, select
+    from db import Chat, ChatMeta, ChatLanguage
+    changed = 0
+    with engine.connect() as conn:
+        avail = available_configs(conn)
+    with Session(engine) as sess:
+        langs = {}
+        for chat_id, lang in sess.exec(select(ChatLanguage.chat_id, ChatLanguage.language)).all():
+            langs.setdefault(chat_id, []).append(lang)
+        metas = {m.chat_id: m for m in sess.exec(select(ChatMeta)).all()}
+        for chat_id in sess.exec(select(Chat.chat_id)).all():
+            cfg = fts_config_for(langs.get(chat_id), avail)
+            meta = metas.get(chat_id) or ChatMeta(chat_id=chat_id)
+            if meta.fts_config != cfg:
+                meta.fts_config = cfg
+                sess.add(meta)
+                changed += 1
+        sess.commit()
+    return changed
+
+
+def reindex_chat(engine, chat_id: int, batch: int = REINDEX_BATCH) -> int:
+    """Пересчитать text_tsv сообщений чата (триггер на UPDATE OF text) пачками по
+    ix_message_chat_date, каждая пачка — своя короткая транзакция. Возвращает число строк."""
+    last, done = None, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "UPDATE message SET text = text WHERE id IN ("
+                " SELECT id FROM message WHERE chat_id = :c"
+                + (" AND (date, id) < (:d, :i)" if last else " AND date IS NOT NULL")
+                + " ORDER BY date DESC, id DESC LIMIT :n) RETURNING date, id"
+            ), {"c": chat_id, "n": batch, "d": last and last[0], "i": last and last[1]}).all()
+        if not rows:
+            break
+        last = min(rows)
+        done += len(rows)
+    with engine.begin() as conn:
+        done += conn.execute(text(
+            "UPDATE message SET text = text WHERE chat_id = :c AND date IS NULL"
+        ), {"c": chat_id}).rowcount or 0
+    return done
+
+
+def pending_reindex(conn) -> list[tuple[int, str]]:
+    """Чаты, у которых fts_config сменилась после индексации: [(chat_id, fts_config)]."""
+    return conn.execute(text(
+        "SELECT chat_id, fts_config FROM chatmeta "
+        "WHERE coalesce(fts_config, :d) <> coalesce(fts_indexed, :d) ORDER BY chat_id"
+    ), {"d": DEFAULT_FTS_CONFIG}).all()
+
+
+def reindex_interval_sec(cfg: dict) -> float:
+    """limits.fts_reindex_interval_sec — как часто воркер дочищает очередь переиндексации."""
+    return float((cfg.get("limits") or {}).get("fts_reindex_interval_sec", DEFAULT_REINDEX_INTERVAL_SEC))
+
+
+def reindex_pending(engine, batch: int = REINDEX_BATCH) -> list[tuple[int, str, int]]:
+    """Фоновая переиндексация чатов из pending_reindex (панель после правки языков, воркер).
+    Один исполнитель на базу (advisory lock); прерванная — продолжится следующим вызовом.
+    Возвращает [(chat_id, конфигурация, сообщений)] — печатает/логирует вызывающий."""
+    if not fts_available(engine):
+        return []
+    with engine.connect() as lock:
+        if not lock.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": REINDEX_LOCK_KEY}).scalar():
+            return []
+        try:
+            with engine.connect() as conn:
+                todo = pending_reindex(conn)
+            done = []
+            for chat_id, cfg in todo:
+                n = reindex_chat(engine, chat_id, batch)
+                with engine.begin() as conn:
+                    conn.execute(text("UPDATE chatmeta SET fts_indexed = :cfg WHERE chat_id = :c"),
+                                 {"cfg": cfg, "c": chat_id})
+                done.append((chat_id, cfg, n))
+            return done
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": REINDEX_LOCK_KEY})
+            lock.commit()
+
+
+def fts_available(engine) -> bool:
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as conn:
+        return bool(conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'message' AND column_name = 'text_tsv')"
+        )).scalar())
+
+
+def configs_in_use(sess, chat_id=None) -> list[str]:
+    """Конфигурации, которыми проиндексированы сообщения (для построения tsquery)."""
+    from sqlmodel import select
+    from db import ChatMeta
+    q = select(ChatMeta.fts_config).distinct()
+    if chat_id:
+        q = q.where(ChatMeta.chat_id == chat_id)
+    out = set()
+    for val in sess.exec(q).all():
+        out.update(c for c in (val or "").split(",") if c)
+    if not chat_id or not out:
+        out.add(DEFAULT_FTS_CONFIG)  # чаты без chatmeta индексируются конфигурацией по умолчанию
+    return sorted(out)
+
+
+# ------------------------------------------------------------------------------
+# Запрос
+# ------------------------------------------------------------------------------
+def _tsquery_for(cfg: str, q: str):
+    """Строка поиска -> tsquery одной конфигурации.
+    "фраза целиком", префикс*, -исключить; остальные слова объединяются через AND.
+    """
+    regcfg = literal(cfg, type_=REGCONFIG)
+    parts = []
+    for phrase, tok in _TOKEN_RE.findall(q):
+        if phrase:
+            parts.append(func.phraseto_tsquery(regcfg, phrase))
+            continue
+        negate = tok.startswith("-")
+        words = _WORD_RE.findall(tok)
+        if not words:
+            continue
+        if tok.endswith("*"):
+            words[-1] += ":*"
+        expr = " & ".join(words)
+        parts.append(func.to_tsquery(regcfg, f"!({expr})" if negate else expr))
+    if not parts:
+        return None
+    out = parts[0]
+    for p in parts[1:]:
+        out = out.op("&&")(p)
+    return out
+
+
+def build_tsquery(q: str, configs):
+    """tsquery, объединённый (OR) по конфигурациям: документ проиндексирован одной из них."""
+    out = None
+    for cfg in configs:
+        tq = _tsquery_for(cfg, q)
+        if tq is not None:
+            out = tq if out is None else out.op("||")(tq)
+    return out
+
+
+def match(tsq):
+    return text_tsv.op("@@")(tsq)
+
+
+def rank(tsq):
+    return func.ts_rank_cd(text_tsv, tsq)
+
+
+def headline(config_col, text_col, tsq):
+    """Сниппет с подсветкой «…». config_col — chatmeta.fts_config (берётся первая)."""
+    cfg = func.coalesce(func.split_part(config_col, ",", 1), DEFAULT_FTS_CONFIG)
+    return func.ts_headline(cast(cfg, REGCONFIG), func.coalesce(text_col, ""), tsq, HEADLINE_OPTS)
+
+
+# ------------------------------------------------------------------------------
+# Подстрока / нечёткий поиск (pg_trgm)
+# ------------------------------------------------------------------------------
+MESSAGE_TRGM_INDEX = "USING gin (text gin_trgm_ops)"
+TRGM_INDEXES = [
+    ("ix_message_text_trgm", "message", MESSAGE_TRGM_INDEX),
+    ("ix_messagetext_text_trgm", "messagetext", "USING gin (text gin_trgm_ops)"),
+    ("ix_user_username_trgm", '"user"', "USING gin (username gin_trgm_ops)"),
+    ("ix_user_first_name_trgm", '"user"', "USING gin (first_name gin_trgm_ops)"),
+    ("ix_user_last_name_trgm", '"user"', "USING gin (last_name gin_trgm_ops)"),
+]
+
+
+def trgm_available(engine) -> bool:
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as conn:
+        return bool(conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+        )).scalar())
+
+
+def like_pattern(q: str) -> str:
+    """Подстрока для ILIKE с экранированием % и _ (escape-символ — обратная косая)."""
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def substring_match(col, q: str):
+    return col.ilike(like_pattern(q), escape="\\")
+
+
+def fuzzy_match(col, q: str):
+    """Слово из q похоже на фрагмент col (оператор <% — word_similarity, индекс GIN trgm)."""
+    return literal(q).op("<%")(col)
+
+
+def fuzzy_distance(col, q: str):
+    return literal(q).op("<<->")(col)
+
+
+def message_text_match(q: str, fuzzy: bool = False):
+    """Условие по тексту сообщения с учётом вынесенных в messagetext тел (textstore.py):
+    каждая колонка проверяется отдельно, чтобы работали trgm-индексы обеих таблиц."""
+    from sqlmodel import select, or_
+    from db import Message, MessageText
+    cond = fuzzy_match if fuzzy else substring_match
+    return or_(
+        cond(Message.text, q),
+        Message.text_hash.in_(select(MessageText.text_hash).where(cond(MessageText.text, q))),
+    )
+
+
+def find_users(sess, q: str, limit: int = 50, fuzzy: bool = True):
+    """Контакты, похожие по username/имени/фамилии: подстрока (ILIKE) или similarity
+    (оператор % по каждой колонке). Без pg_trgm — fuzzy=False, только подстрока."""
+    from sqlmodel import select, or_
+    from db import User
+    cols = (User.username, User.first_name, User.last_name)
+    conds = [substring_match(c, q) for c in cols]
+    if fuzzy:
+        conds += [c.op("%")(q) for c in cols]
+        score = func.greatest(*[func.coalesce(func.similarity(c, q), 0) for c in cols])
+    else:
+        score = literal(0.0)
+    stmt = (
+        select(User.user_id, User.username, User.first_name, User.last_name, User.is_bot, score.label("score"))
+        .where(or_(*conds))
+        .order_by(score.desc(), User.user_id)
+        .limit(limit)
+    )
+    return sess.exec(stmt).all()
+
+
+# ------------------------------------------------------------------------------
+# Установка
+# ------------------------------------------------------------------------------
+def create_tsv_trigger(conn) -> None:
+    """Триггер text_tsv; текст — из message.text или из messagetext по text_hash."""
+    conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION message_tsv_update() RETURNS trigger AS $$
+        DECLARE
+            cfgs text;
+            c text;
+            body text;
+            v tsvector := ''::tsvector;
+        BEGIN
+            SELECT fts_config INTO cfgs FROM chatmeta WHERE chat_id = NEW.chat_id;
+            body := NEW.text;
+            IF body IS NULL AND NEW.text_hash IS NOT NULL THEN
+                SELECT t.text INTO body FROM messagetext t WHERE t.text_hash = NEW.text_hash;
+            END IF;
+            FOREACH c IN ARRAY string_to_array(coalesce(nullif(cfgs, ''), '{DEFAULT_FTS_CONFIG}'), ',') LOOP
+                v := v || to_tsvector(c::regconfig, coalesce(body, ''));
+            END LOOP;
+            NEW.text_tsv := v;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+    """))
+    conn.execute(text("DROP TRIGGER IF EXISTS trg_message_tsv ON message"))
+    conn.execute(text(
+        "CREATE TRIGGER trg_message_tsv BEFORE INSERT OR UPDATE OF text, text_hash ON message "
+        "FOR EACH ROW EXECUTE FUNCTION message_tsv_update()"
+    ))
+
+
+def install_fts(engine, batch: int = BACKFILL_BATCH) -> None:
+    from partitions import create_index_online
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE chatmeta ADD COLUMN IF NOT EXISTS fts_config VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE chatmeta ADD COLUMN IF NOT EXISTS fts_indexed VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE message ADD COLUMN IF NOT EXISTS text_tsv tsvector"))
+        create_tsv_trigger(conn)
+
+    print("fts_config обновлён у чатов:", sync_chat_configs(engine))
+
+    # backfill пачками по id: UPDATE OF text запускает триггер
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text("SELECT min(id), max(id) FROM message")).one()
+    if lo is not None:
+        for a in range(lo, hi + 1, batch):
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "UPDATE message SET text = text WHERE id >= :a AND id < :b AND text_tsv IS NULL"
+                ), {"a": a, "b": a + batch})
+            print(f"text_tsv: id < {a + batch} / {hi}")
+
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE chatmeta SET fts_indexed = fts_config"))
+    create_index_online(engine, "ix_message_text_tsv", "message", TSV_INDEX)
+    print("FTS установлен.")
+
+
+def install_trgm(engine) -> None:
+    """pg_trgm и GIN-индексы; каждый строится CONCURRENTLY, вставки воркера не ждут."""
+    from partitions import create_index_online
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for name, table, definition in TRGM_INDEXES:
+        print(f"building {name} …")
+        create_index_online(engine, name, table, definition)
+    print("pg_trgm установлен.")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Поиск: установка и обслуживание индексов")
+    ap.add_argument("command", choices=["install-fts", "install-trgm", "sync-configs", "reindex"])
+    args = ap.parse_args(argv)
+
+    from db import engine
+    if args.command == "install-fts":
+        install_fts(engine)
+    elif args.command == "install-trgm":
+        install_trgm(engine)
+    else:
+        if args.command == "sync-configs":
+            print("fts_config обновлён у чатов:", sync_chat_configs(engine))
+        done = reindex_pending(engine)
+        for chat_id, cfg, n in done:
+            print(f"reindex: chat {chat_id} ({cfg}): {n} сообщений")
+        print("переиндексировано чатов:", len(done))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
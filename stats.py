@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# stats.py — счётчики для вкладки «Состояние» без count(*) по большим таблицам
+#
+# chatstats: строка на чат (сообщений, писавших, последнее сообщение) и строка chat_id = 0 —
+# итог по базе (+ чатов, каналов, групп, пользователей). Воркер прибавляет к ним в той же
+# транзакции, что и вставка; панель читает итог одним поиском по первичному ключу.
+# Удаления (архив, ретеншн партиций, ручные правки) и гонки копят расхождение — его
+# исправляет reconcile: полный пересчёт, раз в limits.stats_reconcile_interval_sec.
+#
+#   python stats.py show
+#   python stats.py reconcile
+
+import argparse
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import delete, exists, func
+from sqlmodel import select
+
+from db import Chat, ChatStats, Message, User
+import storage
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+GLOBAL = 0
+COUNTERS = ["messages", "users", "chats", "channels", "groups"]
+
+
+def _row(chat_id: int, **values) -> dict:
+    row = {"chat_id": chat_id, "last_message_at": None, **{k: 0 for k in COUNTERS}}
+    row.update(values)
+    return row
+
+
+def bump(sess, rows: list[dict]) -> None:
+    """Прибавляет счётчики (строки из _row) и сдвигает last_message_at вперёд."""
+    storage.increment(sess, ChatStats.__table__, rows, ["chat_id"], COUNTERS, ["last_message_at"])
+
+
+# ------------------------------------------------------------------------------
+# Воркер
+# ------------------------------------------------------------------------------
+def _new_posters(sess, chat_id: int, inserted) -> int:
+    """Сколько авторов из inserted раньше не писали в чат (по индексу ix_message_user_date)."""
+    uids = {r.user_id for r in inserted if r.user_id is not None}
+    mids = [r.message_id for r in inserted]
+    new = 0
+    for uid in uids:
+        seen = sess.exec(select(exists().where(
+            Message.user_id == uid, Message.chat_id == chat_id, Message.message_id.not_in(mids)
+        ))).one()
+        new += not seen
+    return new
+
+
+def record_messages(sess, chat_id: int, inserted, new_users: int = 0) -> None:
+    """inserted — строки (chat_id, message_id, date, user_id) только что вставленных сообщений."""
+    if not inserted and not new_users:
+        return
+    last = max((r.date for r in inserted if r.date is not None), default=None)
+    n = len(inserted)
+    rows = [_row(GLOBAL, messages=n, users=new_users, last_message_at=last)]
+    if inserted:
+        rows.append(_row(chat_id, messages=n, users=_new_posters(sess, chat_id, inserted), last_message_at=last))
+    bump(sess, rows)
+
+
+def record_users(sess, n: int) -> None:
+    if n:
+        bump(sess, [_row(GLOBAL, users=n)])
+
+
+def record_chat(sess, is_channel: bool, is_group: bool) -> None:
+    bump(sess, [_row(GLOBAL, chats=1, channels=int(bool(is_channel)), groups=int(bool(is_group)))])
+
+
+def record_deleted(sess, chat_id: int, n: int) -> None:
+    """Удалено n сообщений чата (архив); писавшие и последняя дата поправятся сверкой."""
+    if n:
+        bump(sess, [_row(GLOBAL, messages=-n), _row(chat_id, messages=-n)])
+
+
+# ------------------------------------------------------------------------------
+# Сверка
+# ------------------------------------------------------------------------------
+def reconcile(engine) -> int:
+    """Пересчитывает все счётчики с нуля (полный проход по message). Возвращает число чатов."""
+    from db import get_session
+
+    now = datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds")
+    with get_session() as sess:
+        per_chat = sess.exec(
+            select(Message.chat_id, func.count(), func.count(func.distinct(Message.user_id)), func.max(Message.date))
+            .group_by(Message.chat_id)
+        ).all()
+        chats = sess.exec(select(
+            func.count(),
+            func.count().filter(Chat.is_channel == True),
+            func.count().filter(Chat.is_group == True),
+        ).select_from(Chat)).one()
+        users = sess.exec(select(func.count()).select_from(User)).one()
+
+        rows = [_row(c, messages=n, users=u, last_message_at=last, reconciled_at=now) for c, n, u, last in per_chat]
+        rows.append(_row(
+            GLOBAL,
+            messages=sum(n for _, n, _, _ in per_chat),
+            users=users, chats=chats[0], channels=chats[1], groups=chats[2],
+            last_message_at=max((last for *_, last in per_chat if last is not None), default=None),
+            reconciled_at=now,
+        ))
+        sess.exec(delete(ChatStats).where(ChatStats.chat_id.not_in([r["chat_id"] for r in rows])))
+        storage.upsert(sess, ChatStats.__table__, rows, ["chat_id"], COUNTERS + ["last_message_at", "reconciled_at"])
+        sess.commit()
+    return len(per_chat)
+
+
+def reconcile_due(engine, interval_sec: float) -> bool:
+    from db import get_session
+    with get_session() as sess:
+        g = sess.get(ChatStats, GLOBAL)
+    if g is None or not g.reconciled_at:
+        return True
+    return datetime.fromisoformat(g.reconciled_at) < datetime.now(BUCHAREST_TZ) - timedelta(seconds=interval_sec)
+
+
+def totals(sess):
+    """Итоговая строка (chat_id = 0) или None, если счётчики ещё не собраны."""
+    return sess.get(ChatStats, GLOBAL)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Счётчики для панели")
+    ap.add_argument("command", choices=["show", "reconcile"])
+    args = ap.parse_args(argv)
+
+    from db import engine, get_session
+    if args.command == "reconcile":
+        print(f"reconciled chats: {reconcile(engine)}")
+        return 0
+    with get_session() as sess:
+        g = totals(sess)
+    if g is None:
+        print("счётчиков нет — выполните python stats.py reconcile")
+        return 1
+    print(f"messages {g.messages}, users {g.users}, chats {g.chats} (channels {g.channels}, groups {g.groups})")
+    print(f"last message {g.last_message_at}, reconciled {g.reconciled_at}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# storage.py — вставки с ON CONFLICT для Postgres и SQLite
+#
+# Бэкенд выбирается по DATABASE_URL (см. db.py). Оба диалекта поддерживают
+# INSERT … ON CONFLICT (SQLite ≥ 3.24), различается только конструктор insert
+# и лимит параметров на запрос — у SQLite он меньше, поэтому строки режутся на пачки.
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+SQLITE_MAX_PARAMS = 32766   # SQLITE_MAX_VARIABLE_NUMBER для SQLite ≥ 3.32
+PG_MAX_PARAMS = 65535
+
+
+def dialect_name(bind) -> str:
+    """bind — Engine, Connection или Session."""
+    if hasattr(bind, "get_bind"):
+        bind = bind.get_bind()
+    return bind.dialect.name
+
+
+def is_postgres(bind) -> bool:
+    return dialect_name(bind) == "postgresql"
+
+
+def is_sqlite(bind) -> bool:
+    return dialect_name(bind) == "sqlite"
+
+
+def string_agg(bind, col, sep: str):
+    """Агрегат «значения группы через sep»: string_agg в Postgres, group_concat в SQLite."""
+    if is_postgres(bind):
+        return func.string_agg(col, sep)
+    return func.group_concat(col, sep)
+
+
+def _insert(bind, table):
+    name = dialect_name(bind)
+    if name == "postgresql":
+        return postgresql.insert(table)
+    if name == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"неподдерживаемая СУБД: {name}")
+
+
+def _chunks(bind, rows: list[dict]):
+    limit = PG_MAX_PARAMS if is_postgres(bind) else SQLITE_MAX_PARAMS
+    size = max(1, limit // max(1, len(rows[0])))
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def insert_ignore(sess, table, rows: list[dict], conflict_cols=None) -> int:
+    """INSERT … ON CONFLICT DO NOTHING. Возвращает число реально вставленных строк."""
+    if not rows:
+        return 0
+    inserted = 0
+    for part in _chunks(sess, rows):
+        stmt = _insert(sess, table).values(part).on_conflict_do_nothing(index_elements=conflict_cols)
+        inserted += sess.exec(stmt).rowcount or 0
+    return inserted
+
+
+def insert_ignore_returning(sess, table, rows: list[dict], conflict_cols, returning) -> list:
+    """Как insert_ignore, но возвращает колонки returning реально вставленных строк
+    (RETURNING: Postgres, SQLite ≥ 3.35)."""
+    if not rows:
+        return []
+    out = []
+    cols = [table.c[c] for c in returning]
+    for part in _chunks(sess, rows):
+        stmt = _insert(sess, table).values(part).on_conflict_do_nothing(index_elements=conflict_cols)
+        out += sess.exec(stmt.returning(*cols)).all()
+    return out
+
+
+def upsert(sess, table, rows: list[dict], conflict_cols, update_cols) -> int:
+    """INSERT … ON CONFLICT (conflict_cols) DO UPDATE SET update_cols = excluded.*"""
+    if not rows:
+        return 0
+    n = 0
+    for part in _chunks(sess, rows):
+        stmt = _insert(sess, table).values(part)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=conflict_cols,
+            set_={k: stmt.excluded[k] for k in update_cols},
+        )
+        n += sess.exec(stmt).rowcount or 0
+    return n
+
+
+def increment(sess, table, rows: list[dict], conflict_cols, add_cols, max_cols=()) -> int:
+    """INSERT … ON CONFLICT DO UPDATE SET c = c + excluded.c (add_cols),
+    m = наибольшее из m и excluded.m (max_cols, NULL не затирает значение)."""
+    if not rows:
+        return 0
+    n = 0
+    for part in _chunks(sess, rows):
+        stmt = _insert(sess, table).values(part)
+        ex = stmt.excluded
+        set_ = {k: table.c[k] + ex[k] for k in add_cols}
+        for k in max_cols:
+            if is_postgres(sess):
+                set_[k] = func.greatest(table.c[k], ex[k])  # greatest() пропускает NULL
+            else:
+                set_[k] = func.max(func.coalesce(table.c[k], ex[k]), func.coalesce(ex[k], table.c[k]))
+        n += sess.exec(stmt.on_conflict_do_update(index_elements=conflict_cols, set_=set_)).rowcount or 0
+    return n
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# textstore.py — тексты сообщений по содержимому (одна копия на одинаковый текст)
+#
+# Длинный текст (>= storage.dedup_min_length символов) нормализуется, хешируется и
+# хранится один раз в messagetext; в message остаётся text = NULL и text_hash.
+# Короткие тексты («ок», «+») остаются в message.text — join ради них дороже экономии.
+# Полный текст: COALESCE(message.text, messagetext.text) — см. full_text() и view message_full.
+#
+#   python textstore.py backfill      # перенести уже сохранённые длинные тексты
+#   python textstore.py top           # самые частые тексты: сколько раз и в скольких чатах
+
+import argparse
+import hashlib
+import re
+import sys
+import unicodedata
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import bindparam, func, text
+from sqlmodel import select
+
+from db import Message, MessageText
+import storage
+from utils import read_config
+
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+DEFAULT_MIN_LENGTH = 256
+BACKFILL_BATCH = 5_000
+_TRAILING_WS = re.compile(r"[ \t\u00a0]+$", re.MULTILINE)
+
+
+def min_length(cfg: dict) -> int:
+    """storage.dedup_min_length; 0 — дедупликация выключена."""
+    return int((cfg.get("storage") or {}).get("dedup_min_length", DEFAULT_MIN_LENGTH))
+
+
+def normalize_text(s: str) -> str:
+    # NFC, единые переводы строк, без хвостовых пробелов — репосты совпадают побайтно
+    s = unicodedata.normalize("NFC", s).replace("\r\n", "\n").replace("\r", "\n")
+    return _TRAILING_WS.sub("", s).strip()
+
+
+def text_hash(s: str) -> str:
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def dedup_rows(sess, rows: list[dict], threshold: int) -> int:
+    """Выносит длинные тексты строк message в messagetext (на месте меняет rows).
+    Возвращает число новых уникальных текстов."""
+    if threshold <= 0:
+        return 0
+    bodies = {}
+    now = datetime.now(BUCHAREST_TZ)
+    for r in rows:
+        body = r.get("text")
+        if not body or len(body) < threshold:
+            continue
+        body = normalize_text(body)
+        h = text_hash(body)
+        bodies.setdefault(h, {"text_hash": h, "text": body, "length": len(body), "created_at": now})
+        r["text"], r["text_hash"] = None, h
+    for r in rows:
+        r.setdefault("text_hash", None)  # одинаковый набор колонок для multi-row INSERT
+    return storage.insert_ignore(sess, MessageText.__table__, list(bodies.values()), ["text_hash"])
+
+
+def full_text():
+    """Текст сообщения для запросов с .outerjoin(MessageText, MessageText.text_hash == Message.text_hash)."""
+    return func.coalesce(Message.text, MessageText.text)
+
+
+def text_usage(sess, hashes):
+    """{hash: (сообщений, чатов)} — по индексу ix_message_text_hash."""
+    if not hashes:
+        return {}
+    rows = sess.exec(
+        select(Message.text_hash, func.count(), func.count(func.distinct(Message.chat_id)))
+        .where(Message.text_hash.in_(list(hashes)))
+        .group_by(Message.text_hash)
+    ).all()
+    return {h: (n, chats) for h, n, chats in rows}
+
+
+def text_chats(sess, h: str):
+    """Где публиковался текст: чат, количество, первая и последняя дата."""
+    from db import Chat
+    return sess.exec(
+        select(Message.chat_id, Chat.title, func.count(), func.min(Message.date), func.max(Message.date))
+        .join(Chat, Chat.chat_id == Message.chat_id)
+        .where(Message.text_hash == h)
+        .group_by(Message.chat_id, Chat.title)
+        .order_by(func.count().desc())
+    ).all()
+
+
+# ------------------------------------------------------------------------------
+# Схема / перенос
+# ------------------------------------------------------------------------------
+def create_view(engine) -> None:
+    """message_full — message с полным текстом, для SQL-запросов и внешних инструментов."""
+    body = (
+        "SELECT m.id, m.chat_id, m.message_id, m.account_id, m.user_id, m.date, "
+        "COALESCE(m.text, t.text) AS text, m.text_hash "
+        "FROM message m LEFT JOIN messagetext t ON t.text_hash = m.text_hash"
+    )
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text(f"CREATE OR REPLACE VIEW message_full AS {body}"))
+        else:
+            conn.execute(text("DROP VIEW IF EXISTS message_full"))
+            conn.execute(text(f"CREATE VIEW message_full AS {body}"))
+
+
+def backfill(engine, threshold: int, batch: int = BACKFILL_BATCH) -> int:
+    """Переносит длинные тексты уже сохранённых сообщений пачками по id."""
+    if threshold <= 0:
+        return 0
+    from db import get_session
+
+    last_id, moved = 0, 0
+    while True:
+        with get_session() as sess:
+            rows = sess.exec(
+                select(Message.id, Message.text)
+                .where(Message.id > last_id, Message.text_hash.is_(None),
+                       func.length(Message.text) >= threshold)
+                .order_by(Message.id)
+                .limit(batch)
+            ).all()
+            if not rows:
+                break
+            items = [{"id": i, "text": t} for i, t in rows]
+            dedup_rows(sess, items, threshold)
+            sess.connection().execute(
+                Message.__table__.update()
+                .where(Message.__table__.c.id == bindparam("mid"))
+                .values(text=None, text_hash=bindparam("h")),
+                [{"mid": r["id"], "h": r["text_hash"]} for r in items],
+            )
+            sess.commit()
+        last_id = rows[-1][0]
+        moved += len(rows)
+        print(f"textstore: перенесено {moved} (id <= {last_id})")
+    return moved
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Хранилище текстов сообщений по хешу")
+    ap.add_argument("command", choices=["backfill", "top"])
+    ap.add_argument("--limit", type=int, default=20)
+    args = ap.parse_args(argv)
+
+    from db import engine, get_session
+    if args.command == "backfill":
+        backfill(engine, min_length(read_config()))
+        create_view(engine)
+        return 0
+    with get_session() as sess:
+        n = func.count().label("n")
+        top = (
+            select(Message.text_hash, n, func.count(func.distinct(Message.chat_id)).label("chats"))
+            .where(Message.text_hash.is_not(None))
+            .group_by(Message.text_hash)
+            .order_by(n.desc())
+            .limit(args.limit)
+            .subquery()
+        )
+        rows = sess.exec(
+            select(top.c.text_hash, top.c.n, top.c.chats, MessageText.text)
+            .join(MessageText, MessageText.text_hash == top.c.text_hash)
+            .order_by(top.c.n.desc())
+        ).all()
+    for h, cnt, chats, body in rows:
+        print(f"{cnt:>7} раз, чатов {chats:>4}  {h}  {body[:80]!r}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
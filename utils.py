@@ -1,25 +1,110 @@
-import random, time, pathlib
+import json, random, time, pathlib, traceback
+from zoneinfo import ZoneInfo
 from loguru import logger
 
-def setup_logger(log_path: str):
-    import logging
-    from datetime import datetime
-    from zoneinfo import ZoneInfo
-    class TZFormatter(logging.Formatter):
-        def formatTime(self, record, datefmt=None):
-            dt = datetime.fromtimestamp(record.created, tz=ZoneInfo("Europe/Bucharest"))
-            if datefmt:
-                return dt.strftime(datefmt)
-            return dt.isoformat()
+BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
+
+# поля структурированной записи (передаются через logger.bind(...))
+JSON_LOG_FIELDS = ("chat_id", "mode", "batch", "inserted", "duration_ms", "flood_wait")
+
+def json_log_path(log_path: str) -> pathlib.Path:
+    """logs/app.log -> logs/app.jsonl (структурированный лог рядом с текстовым)."""
+    return pathlib.Path(log_path).with_suffix(".jsonl")
+
+def _json_format(record) -> str:
+    payload = {
+        "ts": record["time"].astimezone(BUCHAREST_TZ).isoformat(timespec="milliseconds"),
+        "level": record["level"].name,
+        "msg": record["message"],
+    }
+    for k in JSON_LOG_FIELDS:
+        v = record["extra"].get(k)
+        if v is not None:
+            payload[k] = v
+    if record["exception"] is not None:
+        exc = record["exception"]
+        payload["exc"] = "".join(traceback.format_exception(exc.type, exc.value, exc.traceback))
+    # loguru подставляет {…} из record — кладём готовую строку в extra
+    record["extra"]["_json"] = json.dumps(payload, ensure_ascii=False, default=str)
+    return "{extra[_json]}\n"
+
+def _is_text_record(record) -> bool:
+    # постраничная статистика (event=page) пишется только в JSONL
+    return record["extra"].get("event") != "page"
 
+def setup_logger(log_path: str):
     pathlib.Path(log_path).parent.mkdir(parents=True, exist_ok=True)
     logger.remove()
-    logger.add(log_path, rotation="20 MB", retention="15 days", enqueue=True)
-    logger.add(lambda msg: print(msg, end=""))
+    logger.add(log_path, rotation="20 MB", retention="15 days", enqueue=True, filter=_is_text_record)
+    logger.add(json_log_path(log_path), format=_json_format, rotation="20 MB", retention="15 days", enqueue=True)
+    logger.add(lambda msg: print(msg, end=""), filter=_is_text_record)
     return logger
 
+def read_config(path: str = "config.yaml") -> dict:
+    """config.yaml как есть (без validate_config); нет файла — пустой словарь.
+    Общий загрузчик для CLI модулей хранилища (textstore, feed, rollup, dataset, …)."""
+    import yaml
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
 def sleep_range(a: float, b: float):
     time.sleep(random.uniform(a, b))
 
 def jitter_ms(a_ms: int, b_ms: int):
     time.sleep(random.uniform(a_ms, b_ms)/1000.0)
+
+def _check_pair(limits: dict, key: str, *, integer: bool = False, required: bool = True):
+    if key not in limits:
+        if required:
+            raise ValueError(f"limits.{key}: не задан")
+        return
+    val = limits[key]
+    if not isinstance(val, (list, tuple)) or len(val) != 2:
+        raise ValueError(f"limits.{key}: ожидается пара [min, max]")
+    types = (int,) if integer else (int, float)
+    if any(isinstance(x, bool) or not isinstance(x, types) or x < 0 for x in val):
+        raise ValueError(f"limits.{key}: значения должны быть неотрицательными числами")
+
+def validate_config(cfg) -> dict:
+    """Проверяет config.yaml до применения; при ошибке — ValueError с понятным текстом."""
+    if not isinstance(cfg, dict):
+        raise ValueError("config.yaml: ожидается словарь верхнего уровня")
+    chats = cfg.get("chats") or []
+    if not isinstance(chats, list) or not all(isinstance(c, (str, int)) for c in chats):
+        raise ValueError("chats: ожидается список @username или числовых id")
+    limits = cfg.get("limits")
+    if not isinstance(limits, dict):
+        raise ValueError("limits: секция отсутствует")
+    _check_pair(limits, "batch_size_range", integer=True)
+    lo, hi = limits["batch_size_range"]
+    if lo < 1 or lo > hi:
+        raise ValueError("limits.batch_size_range: нужно 1 <= min <= max")
+    _check_pair(limits, "pause_between_batches_sec")
+    _check_pair(limits, "pause_between_chats_sec")
+    _check_pair(limits, "micro_pause_every_n_msgs", integer=True, required=False)
+    _check_pair(limits, "micro_pause_ms", required=False)
+    if not isinstance(cfg.get("behavior", {}), dict):
+        raise ValueError("behavior: ожидается словарь")
+    if not isinstance(cfg.get("storage", {}), dict):
+        raise ValueError("storage: ожидается словарь")
+    dml = cfg.get("storage", {}).get("dedup_min_length", 0)
+    if not isinstance(dml, int) or isinstance(dml, bool) or dml < 0:
+        raise ValueError("storage.dedup_min_length: нужно целое >= 0 (0 — выключено)")
+    arch = cfg.get("storage", {}).get("archive", {})
+    if not isinstance(arch, dict):
+        raise ValueError("storage.archive: ожидается словарь")
+    days = arch.get("older_than_days", 365)
+    if not isinstance(days, int) or isinstance(days, bool) or days < 31:
+        raise ValueError("storage.archive.older_than_days: нужно целое >= 31")
+    ds = cfg.get("storage", {}).get("dataset", {})
+    if not isinstance(ds, dict):
+        raise ValueError("storage.dataset: ожидается словарь")
+    if ds.get("compression", "zstd") not in ("zstd", "snappy", "gzip", "none"):
+        raise ValueError("storage.dataset.compression: zstd, snappy, gzip или none")
+    frd = cfg.get("storage", {}).get("feed_retention_days", 7)
+    if not isinstance(frd, int) or isinstance(frd, bool) or frd < 0:
+        raise ValueError("storage.feed_retention_days: нужно целое >= 0 (0 — не чистить)")
+    return cfg
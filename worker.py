@@ -20,12 +20,19 @@ except Exception:
 
 from dotenv import load_dotenv
 from telethon import TelegramClient, errors
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types import User as TLUser, Channel, Chat as TLChat
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from telethon import utils as tl_utils
+from telethon.tl.functions.messages import GetHistoryRequest, GetChatsRequest, GetFullChatRequest
+from telethon.tl.functions.channels import GetChannelsRequest, GetFullChannelRequest, GetParticipantsRequest
+from telethon.tl.types import (
+    User as TLUser, Channel, Chat as TLChat, PeerChannel,
+    ChannelParticipantsRecent, ChannelParticipantsSearch,
+    ChannelParticipantCreator, ChannelParticipantAdmin, ChannelParticipantBanned,
+    ChatParticipantCreator, ChatParticipantAdmin,
+)
+from telethon.tl.types.channels import ChannelParticipantsNotModified
 
 
-from utils import setup_logger, sleep_range, jitter_ms
+from utils import setup_logger, sleep_range, jitter_ms, validate_config
 
 # --- Константы/пути ---
 BUCHAREST_TZ = ZoneInfo("Europe/Bucharest")
@@ -67,6 +74,7 @@ def _cleanup_and_exit(*_):
 atexit.register(_cleanup)
 
 STARTED_AT = datetime.now(BUCHAREST_TZ).isoformat()
+DATA_VERSION = 0  # растёт при каждой записи в БД; панель сбрасывает по нему кэш
 
 # --- ENV/CFG ---
 load_dotenv()
@@ -75,8 +83,13 @@ API_HASH = os.getenv("API_HASH")
 SESSION_NAME = os.getenv("SESSION_NAME", "research_account")
 SESSION_PATH = SESSIONS_DIR / SESSION_NAME
 
-with open("config.yaml", "r", encoding="utf-8") as f:
-    CFG = yaml.safe_load(f)
+CFG_PATH = Path("config.yaml")
+
+def load_config() -> dict:
+    with open(CFG_PATH, "r", encoding="utf-8") as f:
+        return validate_config(yaml.safe_load(f) or {})
+
+CFG = load_config()
 
 LOG_PATH = CFG["storage"]["log_path"]
 logger = setup_logger(LOG_PATH)
@@ -84,24 +97,103 @@ logger = setup_logger(LOG_PATH)
 try:
     from db import (
         get_session, Account, User, Chat, Message, Cursor, Window,
-        AccountChat, ChatBot, DirectPeer, engine
+        AccountChat, ChatBot, DirectPeer, ChatMember, ParticipantsState, engine
     )
 except Exception as e:
     logger.error(f"Не удалось создать engine: {e}")
     sys.exit(1)
 
-BATCH_MIN, BATCH_MAX = CFG["limits"]["batch_size_range"]
-PBATCH = CFG["limits"]["pause_between_batches_sec"]
-PCHAT  = CFG["limits"]["pause_between_chats_sec"]
-MICRO_N = CFG["limits"]["micro_pause_every_n_msgs"]
-MICRO_MS = CFG["limits"]["micro_pause_ms"]
-USE_TAKEOUT = CFG["behavior"].get("use_takeout_for_bulk_exports", False)
-INCLUDE_DIALOGS = CFG["behavior"].get("include_dialogs", False)
+import feed
+import migrations
+import partitions
+import rollup
+import search
+import stats
+import storage
+import textstore
+from partitions import message_conflict_cols
+
+def apply_config(cfg: dict) -> None:
+    """Раскладывает конфиг по модульным переменным. Вызывается при старте и при hot reload."""
+    global CFG, CHATS, BATCH_MIN, BATCH_MAX, PBATCH, PCHAT, MICRO_N, MICRO_MS
+    global USE_TAKEOUT, INCLUDE_DIALOGS, META_REFRESH_SEC, META_BATCH
+    global COLLECT_PARTICIPANTS, PARTICIPANTS_PAGE, CONFIG_APPLIED_AT, DEDUP_MIN, STATS_RECONCILE_SEC, ROLLUP_SEC
+    global REINDEX_SEC
+    limits = cfg["limits"]
+    behavior = cfg.get("behavior") or {}
+    CFG = cfg
+    CHATS = list(cfg.get("chats") or [])
+    BATCH_MIN, BATCH_MAX = limits["batch_size_range"]
+    PBATCH = limits["pause_between_batches_sec"]
+    PCHAT  = limits["pause_between_chats_sec"]
+    MICRO_N = limits.get("micro_pause_every_n_msgs")
+    MICRO_MS = limits.get("micro_pause_ms", [200, 500])
+    USE_TAKEOUT = behavior.get("use_takeout_for_bulk_exports", False)
+    INCLUDE_DIALOGS = behavior.get("include_dialogs", False)
+    # обновление метаданных чатов (title/type/флаги) — редко и пачками
+    META_REFRESH_SEC = float(limits.get("meta_refresh_interval_sec", 6 * 3600))
+    META_BATCH = int(limits.get("meta_refresh_batch", 100))
+    # полная сверка счётчиков chatstats
+    STATS_RECONCILE_SEC = float(limits.get("stats_reconcile_interval_sec", 24 * 3600))
+    # агрегаты активности (activityrollup) по ленте новых сообщений
+    ROLLUP_SEC = rollup.interval_sec(cfg)
+    # дочистка очереди переиндексации поиска (chatmeta.fts_indexed)
+    REINDEX_SEC = search.reindex_interval_sec(cfg)
+    # сбор участников групп (включая молчащих)
+    COLLECT_PARTICIPANTS = behavior.get("collect_participants", False)
+    PARTICIPANTS_PAGE = min(200, int(limits.get("participants_page_size", 200)))  # 200 — максимум API
+    # длинные тексты — один раз в messagetext (0 — выключено)
+    DEDUP_MIN = textstore.min_length(cfg)
+    CONFIG_APPLIED_AT = datetime.now(BUCHAREST_TZ).isoformat()
+
+apply_config(CFG)
+
+# -----------------------------
+# HOT RELOAD config.yaml
+# -----------------------------
+# Конфиг перечитывается между страницами истории: по изменению mtime файла
+# или по SIGHUP (кнопка «Перечитать конфиг» в панели). Подключение к Telegram
+# и прогресс не теряются. storage.log_path и use_takeout требуют перезапуска.
+_cfg_mtime = CFG_PATH.stat().st_mtime
+_reload_requested = False
+
+def _request_reload(*_):
+    global _reload_requested
+    _reload_requested = True
+
+def maybe_reload_config() -> bool:
+    global _cfg_mtime, _reload_requested
+    try:
+        mtime = CFG_PATH.stat().st_mtime
+    except OSError:
+        return False
+    if mtime == _cfg_mtime and not _reload_requested:
+        return False
+    _cfg_mtime = mtime
+    _reload_requested = False
+    try:
+        new_cfg = load_config()
+    except Exception as e:
+        logger.error(f"config.yaml не применён (оставлена прежняя конфигурация): {e}")
+        return False
+    added = [c for c in new_cfg.get("chats") or [] if c not in CHATS]
+    removed = [c for c in CHATS if c not in (new_cfg.get("chats") or [])]
+    apply_config(new_cfg)
+    logger.info(f"config.yaml перечитан: +{len(added)} / -{len(removed)} чатов, batch={BATCH_MIN}..{BATCH_MAX}")
+    return True
+
+def is_scheduled(chat_ref) -> bool:
+    """Чат всё ещё в config.yaml? (сравниваем как строки: '@name' или id)"""
+    return chat_ref is None or str(chat_ref) in {str(c) for c in CHATS}
 
 # -----------------------------
 # HEARTBEAT
 # -----------------------------
-def write_heartbeat(*, last_action="tick", mode=None, last_chat_id=None, saved_messages_total=0):
+def write_heartbeat(*, last_action="tick", mode=None, last_chat_id=None, saved_messages_total=0, changed=False):
+    """changed=True (или saved_messages_total > 0) — данные в БД изменились."""
+    global DATA_VERSION
+    if changed or saved_messages_total:
+        DATA_VERSION += 1
     payload = {
         "pid": os.getpid(),
         "session": SESSION_NAME,
@@ -110,7 +202,9 @@ def write_heartbeat(*, last_action="tick", mode=None, last_chat_id=None, saved_m
         "last_action": last_action,
         "last_chat_id": last_chat_id,
         "saved_messages_total": saved_messages_total,
-        "mode": mode,  # incremental | backfill | scan_directs | init
+        "mode": mode,  # incremental | backfill | participants | scan_directs | meta_refresh | stats_reconcile | rollup | init
+        "config_applied_at": CONFIG_APPLIED_AT,
+        "data_version": f"{STARTED_AT}#{DATA_VERSION}",
     }
     try:
         HEARTBEAT_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -119,6 +213,8 @@ def write_heartbeat(*, last_action="tick", mode=None, last_chat_id=None, saved_m
 
 signal.signal(signal.SIGTERM, _cleanup_and_exit)
 signal.signal(signal.SIGINT, _cleanup_and_exit)
+if hasattr(signal, "SIGHUP"):
+    signal.signal(signal.SIGHUP, _request_reload)
 
 # -----------------------------
 # ВСПОМОГАТЕЛЬНЫЕ
@@ -138,31 +234,52 @@ def get_or_create_account(sess):
         sess.commit()
     return res
 
+def chat_row(entity) -> dict:
+    """Поля таблицы chat из Telethon-сущности (общий вид для вставки и обновления)."""
+    is_group = isinstance(entity, (TLChat,)) or (getattr(entity, 'megagroup', False))
+    is_channel = isinstance(entity, Channel) and not (getattr(entity, 'megagroup', False))
+    return {
+        "chat_id": entity.id,
+        "title": getattr(entity, "title", None),
+        "type": str(type(entity)).split("'")[1],
+        "is_group": bool(is_group),
+        "is_channel": bool(is_channel),
+    }
+
 async def ensure_chat_record(sess, entity, account_id: int):
     ch = sess.get(Chat, entity.id)
     if not ch:
-        is_group = isinstance(entity, (TLChat,)) or (getattr(entity, 'megagroup', False))
-        is_channel = isinstance(entity, Channel) and not (getattr(entity, 'megagroup', False))
-        ch = Chat(
-            chat_id=entity.id,
-            title=getattr(entity, "title", None),
-            type=str(type(entity)).split("'")[1],
-            is_group=bool(is_group),
-            is_channel=bool(is_channel)
-        )
+        ch = Chat(**chat_row(entity))
         sess.add(ch)
+        if STATS_READY:
+            stats.record_chat(sess, ch.is_channel, ch.is_group)
         sess.commit()
     sess.merge(AccountChat(account_id=account_id, chat_id=entity.id))
     sess.commit()
 
+# (chat_id, message_id) или (chat_id, message_id, date) для партиционированной message
+MSG_CONFLICT_COLS = message_conflict_cols(engine)
+# messagetext появляется шагом 4 migrations.py; до него тексты пишутся как раньше
+TEXTSTORE_READY = False
+# messagefeed — шаг 5
+FEED_READY = False
+# chatstats — шаг 6
+STATS_READY = False
+# activityrollup, posterrollup — шаги 7–8
+ROLLUP_READY = False
+# chatmeta.fts_indexed — шаг 10
+REINDEX_READY = False
+# account.meta_refreshed_at — шаг 12; до него метаданные обновляются при каждом старте
+META_READY = False
+
 def insert_message_no_conflict(sess, **vals):
-    stmt = pg_insert(Message.__table__).values(**vals).on_conflict_do_nothing(index_elements=['chat_id', 'message_id'])
-    sess.exec(stmt)
+    storage.insert_ignore(sess, Message.__table__, [vals], MSG_CONFLICT_COLS)
 
 async def save_messages(sess, entity, msgs, account_id: int):
     chat_id = entity.id
     rows = []
     saved = 0
+    new_users = 0
 
     for idx, m in enumerate(msgs):
         sender = await m.get_sender()
@@ -178,6 +295,7 @@ async def save_messages(sess, entity, msgs, account_id: int):
                     last_name=sender.last_name,
                     is_bot=bool(sender.bot)
                 ))
+                new_users += 1
                 # не коммитим тут — один общий коммит в конце
             else:
                 if u.is_bot is None and sender.bot is not None:
@@ -186,7 +304,7 @@ async def save_messages(sess, entity, msgs, account_id: int):
             if getattr(sender, "bot", False):
                 sess.merge(ChatBot(chat_id=chat_id, bot_user_id=uid))
 
-        msg_dt_local = m.date.astimezone(BUCHAREST_TZ).isoformat()
+        msg_dt_local = m.date.astimezone(BUCHAREST_TZ)
 
         # копим строки для upsert
         rows.append({
@@ -209,16 +327,17 @@ async def save_messages(sess, entity, msgs, account_id: int):
 
     # один батчевый upsert
     if rows:
-        stmt = pg_insert(Message.__table__).values(rows)
-        # конфликт по уникальному (chat_id, message_id) -> игнорируем дубликаты
-        stmt = stmt.on_conflict_do_nothing(index_elements=["chat_id", "message_id"])
-        res = sess.exec(stmt)
-        # rowcount в Postgres показывает количество реально вставленных
-        try:
-            saved = res.rowcount or 0
-        except Exception:
-            # на всякий случай
-            saved = 0
+        if TEXTSTORE_READY:
+            textstore.dedup_rows(sess, rows, DEDUP_MIN)
+        # конфликт по уникальному (chat_id, message_id[, date]) -> игнорируем дубликаты;
+        # RETURNING отдаёт только реально вставленные — они же уходят в ленту
+        inserted = storage.insert_ignore_returning(sess, Message.__table__, rows, MSG_CONFLICT_COLS,
+                                                   feed.FEED_COLS + ["user_id"])
+        saved = len(inserted)
+        if FEED_READY:
+            feed.publish(sess, inserted)
+        if STATS_READY:
+            stats.record_messages(sess, chat_id, inserted, new_users)
 
     sess.commit()
     write_heartbeat(last_action="save_messages", last_chat_id=chat_id, saved_messages_total=saved, mode="incremental")
@@ -228,7 +347,17 @@ async def save_messages(sess, entity, msgs, account_id: int):
 # -----------------------------
 # СБОР ИСТОРИИ
 # -----------------------------
-async def fetch_incremental(client, entity, sess, account_id: int):
+def log_page(mode: str, chat_id: int, batch: int, fetched: int, inserted: int, started: float):
+    """Структурированная запись о странице истории (только в JSONL-лог)."""
+    logger.bind(
+        event="page", chat_id=chat_id, mode=mode, batch=batch, inserted=inserted,
+        duration_ms=int((time.monotonic() - started) * 1000),
+    ).info(f"[{chat_id}] {mode} page: fetched {fetched}, inserted {inserted}")
+
+def log_flood_wait(mode: str, chat_id, seconds: int):
+    logger.bind(chat_id=chat_id, mode=mode, flood_wait=seconds).warning(f"FLOOD_WAIT {seconds}s on {mode}; sleeping")
+
+async def fetch_incremental(client, entity, sess, account_id: int, chat_ref=None):
     cur = sess.get(Cursor, entity.id)
     if not cur:
         cur = Cursor(chat_id=entity.id, oldest_fetched_id=0, newest_fetched_id=0)
@@ -240,8 +369,13 @@ async def fetch_incremental(client, entity, sess, account_id: int):
         min_id += 1
     got = 0
     while True:
+        maybe_reload_config()
+        if not is_scheduled(chat_ref):
+            logger.info(f"[{entity.id}] removed from config.yaml; stopping incremental")
+            break
         write_heartbeat(last_action="loop", mode="incremental", last_chat_id=entity.id)
         limit = random.randint(BATCH_MIN, BATCH_MAX)
+        started = time.monotonic()
         try:
             hist = await client(GetHistoryRequest(
                 peer=entity,
@@ -254,7 +388,7 @@ async def fetch_incremental(client, entity, sess, account_id: int):
                 hash=0
             ))
         except errors.FloodWaitError as e:
-            logger.warning(f"FLOOD_WAIT {e.seconds}s on incremental; sleeping")
+            log_flood_wait("incremental", entity.id, e.seconds)
             await asyncio.sleep(e.seconds + 5)
             continue
 
@@ -262,7 +396,9 @@ async def fetch_incremental(client, entity, sess, account_id: int):
         if not msgs:
             break
 
-        got += await save_messages(sess, entity, msgs, account_id)
+        saved = await save_messages(sess, entity, msgs, account_id)
+        log_page("incremental", entity.id, limit, len(msgs), saved, started)
+        got += saved
         cur.newest_fetched_id = max(cur.newest_fetched_id, max(m.id for m in msgs))
         sess.add(cur)
         sess.commit()
@@ -272,7 +408,7 @@ async def fetch_incremental(client, entity, sess, account_id: int):
         logger.info(f"[{entity.id}] incremental saved {got}")
     return got
 
-async def fetch_backfill(client, entity, sess, account_id: int, window=None):
+async def fetch_backfill(client, entity, sess, account_id: int, window=None, chat_ref=None):
     chat_id = entity.id
     cur = sess.get(Cursor, chat_id)
     if not cur:
@@ -285,8 +421,13 @@ async def fetch_backfill(client, entity, sess, account_id: int, window=None):
 
     total = 0
     while True:
+        maybe_reload_config()
+        if not is_scheduled(chat_ref):
+            logger.info(f"[{chat_id}] removed from config.yaml; stopping backfill")
+            break
         write_heartbeat(last_action="loop", mode="backfill", last_chat_id=chat_id)
         limit = random.randint(BATCH_MIN, BATCH_MAX)
+        started = time.monotonic()
         try:
             hist = await client(GetHistoryRequest(
                 peer=entity,
@@ -299,7 +440,7 @@ async def fetch_backfill(client, entity, sess, account_id: int, window=None):
                 hash=0
             ))
         except errors.FloodWaitError as e:
-            logger.warning(f"FLOOD_WAIT {e.seconds}s on backfill; sleeping")
+            log_flood_wait("backfill", chat_id, e.seconds)
             await asyncio.sleep(e.seconds + 5)
             continue
 
@@ -307,7 +448,9 @@ async def fetch_backfill(client, entity, sess, account_id: int, window=None):
         if not msgs:
             break
 
-        total += await save_messages(sess, entity, msgs, account_id)
+        saved = await save_messages(sess, entity, msgs, account_id)
+        log_page("backfill", chat_id, limit, len(msgs), saved, started)
+        total += saved
         new_oldest = min(m.id for m in msgs)
 
         if cur.oldest_fetched_id == 0 or new_oldest < cur.oldest_fetched_id:
@@ -353,6 +496,8 @@ async def scan_directs(client, sess, account_id: int):
                 sess.add(u)
                 # flush, чтобы FK на DirectPeer прошёл
                 sess.flush()
+                if STATS_READY:
+                    stats.record_users(sess, 1)
             else:
                 # актуализируем флаги/поля, если что-то поменялось
                 changed = False
@@ -371,24 +516,381 @@ async def scan_directs(client, sess, account_id: int):
     sess.commit()
     if count:
         logger.info(f"Direct peers discovered: {count}")
-    write_heartbeat(last_action="scan_directs", mode="scan_directs")
+    write_heartbeat(last_action="scan_directs", mode="scan_directs", changed=bool(count))
     return count
 
 
+# -----------------------------
+# УЧАСТНИКИ ЧАТОВ
+# -----------------------------
+# Telegram отдаёт по фильтру Recent не больше ~10k участников; для больших групп
+# добираем остальных поиском по первым буквам имени.
+RECENT_CAP = 10000
+SEARCH_ALPHABET = list("abcdefghijklmnopqrstuvwxyz0123456789") + list("абвгдеёжзийклмнопрстуфхцчшщэюяіїє")
+
+def _tl_hash(ids) -> int:
+    """Стандартный хэш Telegram для списков id (signed 64-bit)."""
+    h = 0
+    mask = (1 << 64) - 1
+    for i in ids:
+        h ^= h >> 21
+        h ^= (h << 35) & mask
+        h ^= h >> 4
+        h = (h + i) & mask
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def _participant_role(p) -> str:
+    if isinstance(p, (ChannelParticipantCreator, ChatParticipantCreator)):
+        return "creator"
+    if isinstance(p, (ChannelParticipantAdmin, ChatParticipantAdmin)):
+        return "admin"
+    if isinstance(p, ChannelParticipantBanned):
+        return "banned"
+    return "member"
+
+def _participant_user_id(p):
+    uid = getattr(p, "user_id", None)
+    if uid is None:  # ChannelParticipantBanned/Left хранят peer
+        uid = getattr(getattr(p, "peer", None), "user_id", None)
+    return uid
+
+def upsert_participants(sess, chat_id: int, participants, users, seen_at: str) -> int:
+    """Один батч: upsert User, ChatMember и ChatBot без построчных SELECT."""
+    user_rows = {}
+    for u in users:
+        if isinstance(u, TLUser):
+            user_rows[u.id] = {
+                "user_id": u.id,
+                "username": u.username,
+                "first_name": u.first_name,
+                "last_name": u.last_name,
+                "is_bot": bool(u.bot),
+            }
+    member_rows = {}
+    for p in participants:
+        uid = _participant_user_id(p)
+        if uid in user_rows:
+            member_rows[uid] = {"chat_id": chat_id, "user_id": uid, "role": _participant_role(p), "last_seen_at": seen_at}
+    if not member_rows:
+        return 0
+
+    if STATS_READY:
+        from sqlmodel import func, select as sql_select
+        known = sess.exec(sql_select(func.count()).select_from(User).where(User.user_id.in_(list(user_rows)))).one()
+        stats.record_users(sess, len(user_rows) - known)
+    storage.upsert(sess, User.__table__, list(user_rows.values()), ["user_id"],
+                   ("username", "first_name", "last_name", "is_bot"))
+    storage.upsert(sess, ChatMember.__table__, list(member_rows.values()), ["chat_id", "user_id"],
+                   ("role", "last_seen_at"))
+
+    bots = [{"chat_id": chat_id, "bot_user_id": uid} for uid, r in user_rows.items() if r["is_bot"] and uid in member_rows]
+    if bots:
+        storage.insert_ignore(sess, ChatBot.__table__, bots)
+    sess.commit()
+    return len(member_rows)
+
+async def _fetch_basic_chat_participants(client, entity, sess, seen_at: str) -> int:
+    # обычная группа: все участники приходят одним GetFullChat
+    full = await client(GetFullChatRequest(chat_id=entity.id))
+    parts = getattr(full.full_chat.participants, "participants", None) or []
+    return upsert_participants(sess, entity.id, parts, full.users, seen_at)
+
+async def _get_participants_page(client, channel, flt, offset: int, page_hash: int):
+    while True:
+        started = time.monotonic()
+        try:
+            page = await client(GetParticipantsRequest(
+                channel=channel, filter=flt, offset=offset, limit=PARTICIPANTS_PAGE, hash=page_hash
+            ))
+            log_page("participants", channel.id, PARTICIPANTS_PAGE,
+                     len(getattr(page, "participants", [])), 0, started)
+            return page
+        except errors.FloodWaitError as e:
+            log_flood_wait("participants", channel.id, e.seconds)
+            await asyncio.sleep(e.seconds + 5)
+
+async def fetch_participants(client, entity, sess) -> int:
+    """Собирает участников группы в User/ChatMember.
+    Обход пропускается, если число участников и хэш первой страницы не изменились.
+    """
+    chat_id = entity.id
+    if isinstance(entity, Channel) and not entity.megagroup and not (entity.creator or entity.admin_rights):
+        return 0  # подписчиков канала видят только админы
+
+    seen_at = datetime.now(BUCHAREST_TZ).isoformat()
+    write_heartbeat(last_action="participants", mode="participants", last_chat_id=chat_id)
+    try:
+        if isinstance(entity, TLChat):
+            total = await _fetch_basic_chat_participants(client, entity, sess, seen_at)
+            count, first_hash, complete = total, None, True
+        else:
+            state = sess.get(ParticipantsState, chat_id)
+            full = await client(GetFullChannelRequest(channel=entity))
+            count = full.full_chat.participants_count or 0
+
+            first = await _get_participants_page(
+                client, entity, ChannelParticipantsRecent(), 0, (state.first_page_hash or 0) if state else 0
+            )
+            if isinstance(first, ChannelParticipantsNotModified) and state and state.participants_count == count:
+                state.refreshed_at = seen_at
+                sess.add(state)
+                sess.commit()
+                logger.info(f"[{chat_id}] participants not modified ({count})")
+                return 0
+            if isinstance(first, ChannelParticipantsNotModified):
+                first = await _get_participants_page(client, entity, ChannelParticipantsRecent(), 0, 0)
+            first_hash = _tl_hash([_participant_user_id(p) or 0 for p in first.participants])
+
+            filters = [ChannelParticipantsRecent()]
+            if count > RECENT_CAP:
+                filters += [ChannelParticipantsSearch(q) for q in SEARCH_ALPHABET]
+
+            seen = set()
+            total = 0
+            for flt in filters:
+                offset = 0
+                page = first if isinstance(flt, ChannelParticipantsRecent) else None
+                while True:
+                    if page is None:
+                        page = await _get_participants_page(client, entity, flt, offset, 0)
+                        sleep_range(*PBATCH)
+                    if not page.participants:
+                        break
+                    total += upsert_participants(sess, chat_id, page.participants, page.users, seen_at)
+                    seen.update(_participant_user_id(p) for p in page.participants)
+                    offset += len(page.participants)
+                    write_heartbeat(last_action="participants", mode="participants", last_chat_id=chat_id,
+                                    changed=True)
+                    page = None
+                if len(seen) >= count:
+                    break
+            complete = len(seen) >= count
+
+        # ушедших удаляем только после полного обхода
+        if complete:
+            from sqlmodel import delete as sql_delete, or_
+            # все увиденные в этом обходе получили ровно seen_at
+            sess.exec(sql_delete(ChatMember).where(
+                ChatMember.chat_id == chat_id,
+                or_(ChatMember.last_seen_at.is_(None), ChatMember.last_seen_at != seen_at),
+            ))
+        sess.merge(ParticipantsState(
+            chat_id=chat_id, participants_count=count, first_page_hash=first_hash, refreshed_at=seen_at
+        ))
+        sess.commit()
+    except (errors.ChatAdminRequiredError, errors.ChannelPrivateError) as e:
+        logger.warning(f"[{chat_id}] participants unavailable: {e.__class__.__name__}")
+        return 0
+
+    logger.info(f"[{chat_id}] participants upserted {total} (count={count})")
+    return total
+
+
+# -----------------------------
+# МЕТАДАННЫЕ ЧАТОВ
+# -----------------------------
+async def _fetch_chat_entities(client, known: dict):
+    """Полные сущности для известных чатов пачками: GetChannels / GetChats.
+    known: chat_id -> type из таблицы chat (по нему выбираем запрос).
+    """
+    channel_inputs, chat_ids = [], []
+    for cid, ctype in known.items():
+        if (ctype or "").endswith(".Chat"):
+            chat_ids.append(cid)
+            continue
+        try:
+            # access_hash берём из кэша сессии — без сетевого запроса
+            inp = await client.get_input_entity(PeerChannel(cid))
+            channel_inputs.append(tl_utils.get_input_channel(inp))
+        except (ValueError, TypeError):
+            logger.debug(f"[{cid}] нет access_hash в сессии — пропускаем обновление метаданных")
+
+    entities = []
+    for i in range(0, len(channel_inputs), META_BATCH):
+        res = await client(GetChannelsRequest(id=channel_inputs[i:i + META_BATCH]))
+        entities.extend(res.chats)
+    for i in range(0, len(chat_ids), META_BATCH):
+        res = await client(GetChatsRequest(id=chat_ids[i:i + META_BATCH]))
+        entities.extend(res.chats)
+    # Forbidden-варианты (нас удалили/забанили) не перезаписывают тип и флаги
+    return [e for e in entities if isinstance(e, (Channel, TLChat))]
+
+async def refresh_chat_metadata(client, account_id: int) -> int:
+    """Сверяет title/type/is_group/is_channel с Telegram и применяет изменения одним upsert."""
+    from sqlmodel import select as sql_select
+    with get_session() as sess:
+        rows = sess.exec(
+            sql_select(Chat)
+            .join(AccountChat, AccountChat.chat_id == Chat.chat_id)
+            .where(AccountChat.account_id == account_id)
+        ).all()
+        current = {c.chat_id: c for c in rows}
+    if not current:
+        return 0
+
+    entities = await _fetch_chat_entities(client, {cid: c.type for cid, c in current.items()})
+
+    changed = []
+    for ent in entities:
+        new = chat_row(ent)
+        old = current.get(new["chat_id"])
+        if old is None:
+            continue
+        if any(getattr(old, k) != v for k, v in new.items()):
+            changed.append(new)
+
+    if changed:
+        with get_session() as sess:
+            storage.upsert(sess, Chat.__table__, changed, ["chat_id"], ("title", "type", "is_group", "is_channel"))
+            sess.commit()
+    logger.info(f"chat metadata refresh: checked {len(entities)}/{len(current)}, updated {len(changed)}")
+    return len(changed)
+
+def meta_refresh_wait(account_id: int) -> float:
+    """Сколько секунд до следующего обновления метаданных (0 — пора). Время прошлого
+    обновления хранится в account.meta_refreshed_at, так что перезапуск воркера его не сбрасывает."""
+    if not META_READY:
+        return 0
+    with get_session() as sess:
+        acc = sess.get(Account, account_id)
+    if acc is None or not acc.meta_refreshed_at:
+        return 0
+    age = (datetime.now(BUCHAREST_TZ) - datetime.fromisoformat(acc.meta_refreshed_at)).total_seconds()
+    return max(0.0, META_REFRESH_SEC - age)
+
+def mark_meta_refreshed(account_id: int) -> None:
+    if not META_READY:
+        return
+    with get_session() as sess:
+        acc = sess.get(Account, account_id)
+        if acc is not None:
+            acc.meta_refreshed_at = datetime.now(BUCHAREST_TZ).isoformat(timespec="seconds")
+            sess.commit()
+
+async def meta_refresh_loop(client, account_id: int):
+    """Фоновая задача: раз в META_REFRESH_SEC обновляет метаданные всех чатов аккаунта."""
+    while True:
+        try:
+            wait = await asyncio.to_thread(meta_refresh_wait, account_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            n = await refresh_chat_metadata(client, account_id)
+            await asyncio.to_thread(mark_meta_refreshed, account_id)
+            # версия данных панели меняется, только если названия/типы чатов действительно изменились
+            write_heartbeat(last_action="meta_refresh", mode="meta_refresh", changed=bool(n))
+        except errors.FloodWaitError as e:
+            log_flood_wait("meta_refresh", None, e.seconds)
+            await asyncio.sleep(e.seconds + 5)
+            continue
+        except Exception:
+            logger.exception("chat metadata refresh failed")
+        await asyncio.sleep(META_REFRESH_SEC)
+
+
+async def stats_reconcile_loop():
+    """Фоновая задача: раз в STATS_RECONCILE_SEC пересчитывает chatstats с нуля."""
+    while True:
+        try:
+            if await asyncio.to_thread(stats.reconcile_due, engine, STATS_RECONCILE_SEC):
+                n = await asyncio.to_thread(stats.reconcile, engine)
+                logger.info(f"stats reconciled: {n} chats")
+                write_heartbeat(last_action="stats_reconcile", mode="stats_reconcile", changed=True)
+        except Exception:
+            logger.exception("stats reconcile failed")
+        await asyncio.sleep(STATS_RECONCILE_SEC)
+
+
+async def rollup_loop():
+    """Фоновая задача: раз в ROLLUP_SEC дочитывает ленту и пересчитывает затронутые сутки."""
+    while True:
+        try:
+            n = await asyncio.to_thread(rollup.refresh, engine)
+            if n:
+                logger.info(f"rollup: refreshed {n} chat-days")
+                write_heartbeat(last_action="rollup", mode="rollup", changed=True)
+        except Exception:
+            logger.exception("rollup refresh failed")
+        await asyncio.sleep(ROLLUP_SEC)
+
+
+async def fts_reindex_loop():
+    """Фоновая задача: дочищает очередь переиндексации поиска (чаты со сменившимися языками),
+    если панель не успела — например, её перезапустили посреди переиндексации."""
+    while True:
+        try:
+            for chat_id, cfg, n in await asyncio.to_thread(search.reindex_pending, engine):
+                logger.info(f"[{chat_id}] fts: reindexed {n} messages ({cfg})")
+        except Exception:
+            logger.exception("fts reindex failed")
+        await asyncio.sleep(REINDEX_SEC)
+
+
 async def process_chat(client, chat_ref, account_id: int):
     entity = await client.get_entity(chat_ref)
     # единая сессия на чат
     with get_session() as sess:
         await ensure_chat_record(sess, entity, account_id)
-        await fetch_incremental(client, entity, sess, account_id)
-        await fetch_backfill(client, entity, sess, account_id)
+        await fetch_incremental(client, entity, sess, account_id, chat_ref=chat_ref)
+        await fetch_backfill(client, entity, sess, account_id, chat_ref=chat_ref)
+        if COLLECT_PARTICIPANTS and is_scheduled(chat_ref):
+            await fetch_participants(client, entity, sess)
 
 # -----------------------------
 # MAIN
 # -----------------------------
+async def run_schedule(client, acc_id: int):
+    """Обходит чаты из config.yaml. Список перечитывается после каждого чата:
+    добавленные в конфиг чаты попадают в этот же проход, удалённые — пропускаются.
+    """
+    done = set()
+    while True:
+        maybe_reload_config()
+        pending = [c for c in CHATS if str(c) not in done]
+        if not pending:
+            break
+        c = pending[0]
+        done.add(str(c))
+        try:
+            await process_chat(client, c, acc_id)
+        except Exception:
+            logger.exception(f"failed to process {c}")
+        sleep_range(*PCHAT)
+
 async def main():
+    global TEXTSTORE_READY, FEED_READY, STATS_READY, ROLLUP_READY, REINDEX_READY, META_READY
     write_heartbeat(last_action="start", mode="init")
-    chats = CFG.get("chats", []) or []
+    try:
+        if storage.is_sqlite(engine):
+            # однонодовая установка без Postgres: схема обновляется сразу при старте
+            migrations.upgrade(engine)
+            logger.info(f"SQLite storage: {engine.url.database}")
+        else:
+            todo = migrations.pending(engine)
+            if todo:
+                logger.warning(f"schema: не применены шаги {[v for v, _ in todo]} — выполните python migrations.py upgrade")
+        version = migrations.current_version(engine)
+        TEXTSTORE_READY = version >= 4
+        FEED_READY = version >= 5
+        STATS_READY = version >= 6
+        ROLLUP_READY = version >= 8
+        REINDEX_READY = version >= 10 and search.fts_available(engine)
+        META_READY = version >= 12
+    except Exception:
+        logger.exception("schema check failed")
+    try:
+        if FEED_READY:
+            trimmed = feed.trim(engine, feed.retention_days(CFG))
+            if trimmed:
+                logger.info(f"feed: trimmed {trimmed}")
+    except Exception:
+        logger.exception("feed trim failed")
+    try:
+        created, removed = partitions.maintain(engine, CFG)
+        if created or removed:
+            logger.info(f"partitions: created {created}, retention {removed}")
+    except Exception:
+        logger.exception("partition maintenance failed")
 
     async with TelegramClient(str(SESSION_PATH), API_ID, API_HASH) as client_ctx:
         # создаём/получаем аккаунт
@@ -396,6 +898,13 @@ async def main():
             acc = get_or_create_account(sess)
             acc_id = acc.id
 
+        # Метаданные чатов — в фоне, на длинном интервале
+        meta_task = asyncio.create_task(meta_refresh_loop(client_ctx, acc_id))
+        # сверка счётчиков панели — в потоке, чтобы полный проход по message не держал цикл
+        stats_task = asyncio.create_task(stats_reconcile_loop()) if STATS_READY else None
+        rollup_task = asyncio.create_task(rollup_loop()) if ROLLUP_READY else None
+        reindex_task = asyncio.create_task(fts_reindex_loop()) if REINDEX_READY else None
+
         # Личные диалоги (по желанию)
         if INCLUDE_DIALOGS:
             with get_session() as sess:
@@ -404,19 +913,26 @@ async def main():
         # Основной сбор
         if USE_TAKEOUT:
             async with client_ctx.takeout() as client:
-                for c in chats:
-                    try:
-                        await process_chat(client, c, acc_id)
-                    except Exception:
-                        logger.exception(f"failed to process {c}")
-                    sleep_range(*PCHAT)
+                await run_schedule(client, acc_id)
         else:
-            for c in chats:
-                try:
-                    await process_chat(client_ctx, c, acc_id)
-                except Exception:
-                    logger.exception(f"failed to process {c}")
-                sleep_range(*PCHAT)
+            await run_schedule(client_ctx, acc_id)
+
+        # сообщения последнего интервала — в агрегаты сейчас, а не при следующем запуске
+        if ROLLUP_READY:
+            try:
+                n = await asyncio.to_thread(rollup.refresh, engine)
+                if n:
+                    logger.info(f"rollup: refreshed {n} chat-days")
+            except Exception:
+                logger.exception("rollup refresh failed")
+
+        meta_task.cancel()
+        if stats_task:
+            stats_task.cancel()
+        if rollup_task:
+            rollup_task.cancel()
+        if reindex_task:
+            reindex_task.cancel()
 
     write_heartbeat(last_action="finish", mode="done")
 